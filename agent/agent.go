@@ -17,9 +17,10 @@ import (
 type DriftAgent struct {
 	Headless bool
 
-	AuthToken string
-	Domain    string
-	IsHttps   bool
+	AuthToken   string
+	Domain      string
+	IsHttps     bool
+	CallbackURL string
 
 	UserDataDirectory  string
 	RecordingDirectory string
@@ -41,6 +42,7 @@ type DraftAgentOptions struct {
 	AuthToken         string `json:"auth_token"`
 	BaseDataDirectory string `json:"base_data_directory"`
 	LetsEncryptEmail  string `json:"lets_encrypt_email"`
+	CallbackURL       string `json:"callback_url"`
 }
 
 func NewDriftAgent(options DraftAgentOptions) *DriftAgent {
@@ -67,6 +69,7 @@ func NewDriftAgent(options DraftAgentOptions) *DriftAgent {
 		Domain:             options.Domain,
 		IsHttps:            options.IsHttps,
 		AuthToken:          options.AuthToken,
+		CallbackURL:        options.CallbackURL,
 		Sessions:           make(map[string]*BrowserSession),
 		UserDataDirectory:  filepath.Join(options.BaseDataDirectory, "user_data"),
 		RecordingDirectory: filepath.Join(options.BaseDataDirectory, "recordings"),
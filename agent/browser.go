@@ -155,6 +155,9 @@ func (agent *DriftAgent) TerminateBrowserSession(sessionId string) error {
 		}
 
 		_ = os.RemoveAll(filepath.Join(agent.UserDataDirectory, sessionId))
+
+		// Videos are flushed to disk once the browser is closed
+		agent.NotifyRecordingFinalized(sessionId)
 	}()
 	return nil
 }
@@ -0,0 +1,54 @@
+package main
+
+import (
+	"bytes"
+	"encoding/json"
+	"fmt"
+	"net/http"
+	"time"
+)
+
+var callbackClient = &http.Client{Timeout: 10 * time.Second}
+
+// NotifyRecordingFinalized lets Drift know that the videos of a session have been written to disk,
+// so those can be downloaded right away
+func (agent *DriftAgent) NotifyRecordingFinalized(sessionId string) {
+	if agent.CallbackURL == "" {
+		return
+	}
+
+	payload, err := json.Marshal(map[string]interface{}{
+		"session_id": sessionId,
+		"videos":     agent.GetSessionVideos(sessionId),
+	})
+	if err != nil {
+		fmt.Printf("could not prepare recording finalized callback for session %s: %v\n", sessionId, err)
+		return
+	}
+
+	for attempt := 0; attempt < 3; attempt++ {
+		if attempt > 0 {
+			time.Sleep(time.Duration(attempt) * 2 * time.Second)
+		}
+
+		req, err := http.NewRequest(http.MethodPost, agent.CallbackURL, bytes.NewReader(payload))
+		if err != nil {
+			fmt.Printf("could not prepare recording finalized callback for session %s: %v\n", sessionId, err)
+			return
+		}
+		req.Header.Set("Content-Type", "application/json")
+		// Frappe treats the Authorization header as its own credentials, so the token is sent separately
+		req.Header.Set("X-Drift-Token", agent.AuthToken)
+
+		res, err := callbackClient.Do(req)
+		if err != nil {
+			fmt.Printf("recording finalized callback for session %s failed: %v\n", sessionId, err)
+			continue
+		}
+		res.Body.Close()
+		if res.StatusCode == http.StatusOK {
+			return
+		}
+		fmt.Printf("recording finalized callback for session %s failed with status %d\n", sessionId, res.StatusCode)
+	}
+}
@@ -0,0 +1,71 @@
+# Copyright (c) 2025, Tanmoy and contributors
+# For license information, please see license.txt
+
+import click
+import frappe
+from frappe.commands import get_site, pass_context
+
+
+@click.command("drift-executor")
+@click.option("--concurrency", type=int, help="Maximum number of tests to run at once")
+@click.option("--poll-interval", type=float, default=1.0, help="Seconds between looking for new tests")
+@pass_context
+def start_executor(context, concurrency=None, poll_interval=1.0):
+	"Run Drift Tests with the Async Executor execution mode"
+	from drift.drift.executor import DriftTestExecutor
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		concurrency = concurrency or frappe.conf.get("drift_executor_concurrency", 50)
+		DriftTestExecutor(concurrency=concurrency, poll_interval=poll_interval).run()
+	finally:
+		frappe.destroy()
+
+
+@click.command("drift-benchmark-scheduler")
+@click.option("--seed", is_flag=True, help="Seed the history before measuring")
+@click.option("--tests", type=int, default=1_000_000, help="Number of tests to seed")
+@click.option("--repeats", type=int, default=5, help="Times every query is run")
+@click.option("--keep", is_flag=True, help="Keep the seeded history, to measure it again without seeding")
+@click.option("--clear", is_flag=True, help="Remove a kept seeded history after measuring")
+@click.option("--fail-on-scan", is_flag=True, help="Exit with an error if a query reads a table in full")
+@pass_context
+def benchmark_scheduler(
+	context, seed=False, tests=1_000_000, repeats=5, keep=False, clear=False, fail_on_scan=False
+):
+	"Measure the query cost of every scheduler job per tick"
+	from drift.drift import benchmark
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		if not frappe.conf.allow_tests:
+			click.secho("Seeds a lot of data, set allow_tests in the site config to run it", fg="red")
+			raise SystemExit(1)
+
+		if seed:
+			click.echo(f"Seeding {tests} tests")
+			benchmark.seed(tests=tests)
+
+		results = benchmark.run(repeats=repeats)
+		click.echo(f"{'Job':<40}{'Median ms':>12}{'Rows':>12}  Full Scans")
+		for result in results:
+			click.echo(
+				f"{result['job']:<40}{result['median_ms']:>12}{result['rows'] or '-':>12}  "
+				+ ", ".join(result["scans"])
+			)
+
+		if fail_on_scan and any(result["scans"] for result in results):
+			raise SystemExit(1)
+	finally:
+		try:
+			if (seed and not keep) or clear:
+				benchmark.clear()
+		finally:
+			frappe.destroy()
+
+
+commands = [start_executor, benchmark_scheduler]
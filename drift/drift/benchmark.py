@@ -0,0 +1,224 @@
+# Copyright (c) 2025, Tanmoy and contributors
+# For license information, please see license.txt
+
+"""
+Query cost of the scheduler jobs on a site with a long history
+
+`seed` inserts a year worth of tests, sessions, steps and videos, almost all of them finished and
+cleaned up like on a busy site. `run` then measures the queries through which every scheduler job
+finds its work. Seeded rows are named with SEED_PREFIX, so `clear` removes them again.
+
+Nothing seeded is work for the live scheduler jobs of the site: definitions are disabled, the
+newest tests are Pending, sessions are stopped and no video is left to download, purge or evict.
+"""
+
+import statistics
+import time
+from collections.abc import Callable, Iterator
+from datetime import timedelta
+
+import frappe
+
+from drift.drift.doctype.drift_session.drift_session import (
+	get_downloading_sessions,
+	get_sessions_to_purge,
+	get_sessions_with_unreported_videos,
+)
+from drift.drift.doctype.drift_session_video.drift_session_video import get_sessions_with_pending_videos
+from drift.drift.doctype.drift_settings.drift_settings import get_warm_session_counts
+from drift.drift.doctype.drift_test.drift_test import (
+	get_deferred_steps,
+	get_tests_to_cleanup,
+	get_tests_to_garbage_collect,
+)
+from drift.drift.doctype.drift_test_definition.drift_test_definition import (
+	get_due_definitions,
+	get_reusable_sessions,
+)
+from drift.drift.doctype.drift_test_run.drift_test_run import get_test_runs_with_queued_shards
+from drift.drift.executor import get_queued_tests
+
+SEED_PREFIX = "bench-"
+
+# Tests of the history which haven't started yet, the rest are garbage collected and cleaned up
+UNFINISHED_TESTS = 200
+
+
+def seed(tests: int = 1_000_000, definitions: int = 1000, steps_per_test: int = 3, chunk_size: int = 10_000):
+	now = frappe.utils.now_datetime()
+	common = {"owner": "Administrator", "modified_by": "Administrator", "docstatus": 0}
+
+	def insert(doctype: str, rows: Iterator[dict]):
+		chunk = []
+		for row in rows:
+			chunk.append(row)
+			if len(chunk) >= chunk_size:
+				_insert_chunk(doctype, chunk, common)
+				chunk = []
+		if chunk:
+			_insert_chunk(doctype, chunk, common)
+
+	insert(
+		"Drift Test Definition",
+		(
+			{
+				"name": f"{SEED_PREFIX}{index}",
+				"creation": now,
+				"modified": now,
+				"test_setup": f"{SEED_PREFIX}setup",
+				"user_key": f"{SEED_PREFIX}user",
+				"execution_mode": "Step Per Job",
+				"enabled": 0,
+				"interval_minutes": 5 + index % 60,
+				"next_execution_on": now + timedelta(minutes=index % 60),
+			}
+			for index in range(definitions)
+		),
+	)
+
+	def history() -> Iterator[tuple[int, bool, object]]:
+		# Spread over a year, the newest ones are still being worked on
+		for index in range(tests):
+			creation = now - timedelta(seconds=(tests - index) * 365 * 24 * 60 * 60 // tests)
+			yield index, index >= tests - UNFINISHED_TESTS, creation
+
+	insert(
+		"Drift Session",
+		(
+			{
+				"name": f"{SEED_PREFIX}{index}",
+				"creation": creation,
+				"modified": creation,
+				"status": "Stopped",
+				"session_id": f"{SEED_PREFIX}{index}",
+				"server": f"{SEED_PREFIX}server",
+				"cdp_endpoint": "ws://localhost",
+				"started_on": creation,
+				"ended_on": creation + timedelta(minutes=2),
+				"duration": 120,
+				"video_download_status": "Draft" if unfinished else "Downloaded",
+				"purged_videos_from_server": 0 if unfinished else 1,
+			}
+			for index, unfinished, creation in history()
+		),
+	)
+	insert(
+		"Drift Session Video",
+		(
+			{
+				"name": f"{SEED_PREFIX}{index}",
+				"creation": creation,
+				"modified": creation,
+				"parent": f"{SEED_PREFIX}{index}",
+				"parenttype": "Drift Session",
+				"parentfield": "videos",
+				"idx": 1,
+				"id": f"{SEED_PREFIX}{index}",
+				"status": "Deleted" if index % 10 else "Download Failed",
+				"file_size": 0,
+			}
+			for index, unfinished, creation in history()
+			if not unfinished
+		),
+	)
+	insert(
+		"Drift Test",
+		(
+			{
+				"name": f"{SEED_PREFIX}{index}",
+				"creation": creation,
+				"modified": creation,
+				"definition": f"{SEED_PREFIX}{index % definitions}",
+				"session": f"{SEED_PREFIX}{index}",
+				"variables": "{}",
+				"execution_mode": "Step Per Job",
+				"status": "Pending" if unfinished else ("Failure" if index % 20 == 0 else "Success"),
+				"gc_completed": 0 if unfinished else 1,
+				"cleanup_completed": 0 if unfinished else 1,
+			}
+			for index, unfinished, creation in history()
+		),
+	)
+	insert(
+		"Drift Test Step",
+		(
+			{
+				"name": f"{SEED_PREFIX}{index}-{idx}",
+				"creation": creation,
+				"modified": creation,
+				"parent": f"{SEED_PREFIX}{index}",
+				"parenttype": "Drift Test",
+				"parentfield": "steps",
+				"idx": idx,
+				"step": f"{SEED_PREFIX}step",
+				"status": "Pending" if unfinished else "Success",
+			}
+			for index, unfinished, creation in history()
+			for idx in range(1, steps_per_test + 1)
+		),
+	)
+
+
+def clear():
+	for doctype in (
+		"Drift Test Step",
+		"Drift Test",
+		"Drift Session Video",
+		"Drift Session",
+		"Drift Test Definition",
+	):
+		frappe.db.delete(doctype, {"name": ("like", f"{SEED_PREFIX}%")})
+		frappe.db.commit()
+
+
+def run(repeats: int = 5) -> list[dict]:
+	"""
+	Median time and plan of the queries of every scheduler job
+
+	Plans are only read on MariaDB. `scans` lists the tables which are read in full.
+	"""
+	results = []
+	for job, get_query in get_scheduler_queries().items():
+		query = get_query()
+		timings = []
+		for _ in range(repeats):
+			started_at = time.perf_counter()
+			frappe.db.sql(query)
+			timings.append((time.perf_counter() - started_at) * 1000)
+
+		result = {"job": job, "median_ms": round(statistics.median(timings), 2), "rows": None, "scans": []}
+		if frappe.db.db_type == "mariadb":
+			plan = frappe.db.sql(f"EXPLAIN {query}", as_dict=True)
+			result["rows"] = sum(row.rows or 0 for row in plan)
+			result["scans"] = [row.table for row in plan if row.type == "ALL"]
+		results.append(result)
+	return results
+
+
+def get_scheduler_queries() -> dict[str, Callable[[], str]]:
+	"""Queries through which the scheduler jobs find their work, built by the jobs' own functions"""
+	return {
+		"auto_trigger_tests": lambda: get_due_definitions(run=False),
+		"bulk_garbage_collect_tests": lambda: get_tests_to_garbage_collect(run=False),
+		"bulk_cleanup_tests": lambda: get_tests_to_cleanup(run=False),
+		"resume_deferred_steps": lambda: get_deferred_steps(run=False),
+		"trigger_sync_video_ids_and_download": lambda: get_sessions_with_unreported_videos(run=False),
+		"sync_video_download_status": lambda: get_downloading_sessions(run=False),
+		"purge_downloaded_remote_videos": lambda: get_sessions_to_purge(run=False),
+		"download_session_videos": lambda: get_sessions_with_pending_videos(run=False),
+		"fill_warm_pools": lambda: get_warm_session_counts([f"{SEED_PREFIX}server"], run=False),
+		"destroy_expired_reusable_sessions": lambda: get_reusable_sessions(run=False),
+		"launch_queued_shards": lambda: get_test_runs_with_queued_shards(run=False),
+		"executor_claim_tests": lambda: get_queued_tests(run=False),
+	}
+
+
+def _insert_chunk(doctype: str, chunk: list[dict], common: dict):
+	fields = [*common, *chunk[0]]
+	frappe.db.bulk_insert(
+		doctype,
+		fields,
+		[[*common.values(), *row.values()] for row in chunk],
+		ignore_duplicates=True,
+	)
+	frappe.db.commit()
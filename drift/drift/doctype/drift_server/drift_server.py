@@ -2,6 +2,11 @@
 # For license information, please see license.txt
 
 import contextlib
+import hashlib
+import os
+import threading
+import time
+from collections.abc import Callable
 from datetime import datetime
 from typing import Literal
 
@@ -9,8 +14,167 @@ import frappe
 import requests
 from frappe.core.doctype.file.file import File
 from frappe.model.document import Document
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from drift.drift.doctype.drift_session.drift_session import DriftSession, bulk_stop_sessions
+from drift.drift.utils import get_stats, record_stats
+
+# Size of the chunks in which the videos are streamed to disk
+VIDEO_CHUNK_SIZE = 1024 * 1024
+
+# Interrupted video downloads are resumed these many times
+VIDEO_DOWNLOAD_ATTEMPTS = 3
+
+# Seconds before the first retry of a video download, doubled for every next retry
+VIDEO_DOWNLOAD_RETRY_BACKOFF = 1
+
+
+class VideoDownloadError(Exception):
+	pass
+
+
+class DriftServerClient:
+	"""
+	Process wide HTTP client of a Drift Server
+
+	Connections are pooled and kept alive between requests, idempotent requests are retried
+	with backoff and the authorization header is prepared once instead of on every request.
+	"""
+
+	def __init__(
+		self, base_url: str, auth_token: str, pool_size: int, max_retries: int, backoff_factor: float
+	):
+		self.base_url = base_url
+		self.session = requests.Session()
+		self.session.headers["Authorization"] = f"Bearer {auth_token}"
+		self.adapter = HTTPAdapter(
+			pool_connections=1,
+			pool_maxsize=pool_size,
+			max_retries=Retry(
+				total=max_retries,
+				backoff_factor=backoff_factor,
+				status_forcelist=(502, 503, 504),
+				allowed_methods=frozenset({"GET", "DELETE"}),
+				raise_on_status=False,
+			),
+		)
+		self.session.mount("http://", self.adapter)
+		self.session.mount("https://", self.adapter)
+
+	def request(self, method: str, path: str, **kwargs) -> requests.Response:
+		res, new_connections = self.send(method, path, **kwargs)
+		record_stats("http_client", requests=1, new_connections=new_connections)
+		return res
+
+	def send(self, method: str, path: str, **kwargs) -> tuple[requests.Response, int]:
+		"""
+		Send a request without touching the site, so it can be called from other threads
+
+		returns the response and the number of connections opened for it
+		"""
+		connections = self.connections
+		res = self.session.request(method=method, url=self.base_url + path, **kwargs)
+		return res, self.connections - connections
+
+	@property
+	def connections(self) -> int:
+		"""Number of connections opened by the client so far"""
+		pools = self.adapter.poolmanager.pools
+		return sum(pools[key].num_connections for key in pools.keys())
+
+	def close(self):
+		with contextlib.suppress(Exception):
+			self.session.close()
+
+	def fetch_video(
+		self, session_id: str, video_id: str, file_path: str, throttle: Callable[[int], None] | None = None
+	) -> tuple[str, int]:
+		"""
+		Stream a video of a session to `file_path`, safe to call from other threads
+
+		The video is written in chunks to a partial file, so memory usage doesn't depend on the size
+		of the video. A partial file left by an interrupted download is resumed with a Range request,
+		one which doesn't match the video on the server is dropped and the video is downloaded again.
+		Connection and server errors are retried with backoff.
+		`throttle` is called with the size of every chunk before it is written.
+
+		returns the md5 hash and size of the video
+		"""
+		part_path = f"{file_path}.part"
+		for attempt in range(VIDEO_DOWNLOAD_ATTEMPTS):
+			try:
+				content_hash, file_size = self._fetch_video_part(session_id, video_id, part_path, throttle)
+				break
+			except requests.RequestException as e:
+				if attempt == VIDEO_DOWNLOAD_ATTEMPTS - 1:
+					raise VideoDownloadError(str(e)) from e
+				time.sleep(VIDEO_DOWNLOAD_RETRY_BACKOFF * 2**attempt)
+
+		os.replace(part_path, file_path)
+		return content_hash, file_size
+
+	def _fetch_video_part(
+		self, session_id: str, video_id: str, part_path: str, throttle: Callable[[int], None] | None
+	) -> tuple[str, int]:
+		"""
+		Download the rest of the video into the partial file
+
+		returns the md5 hash and size of the complete video
+		"""
+		content_hash = hashlib.md5()
+		offset = 0
+		if os.path.exists(part_path):
+			with open(part_path, "rb") as f:
+				while chunk := f.read(VIDEO_CHUNK_SIZE):
+					content_hash.update(chunk)
+					offset += len(chunk)
+
+		headers = {"Range": f"bytes={offset}-"} if offset else {}
+		res, _ = self.send(
+			"GET", f"sessions/{session_id}/videos/{video_id}", headers=headers, stream=True, timeout=(5, 60)
+		)
+		with res:
+			if res.status_code == 416:
+				if offset and _get_total_size(res) == offset:
+					# Partial file is already complete
+					return content_hash.hexdigest(), offset
+				# Partial file is stale or larger than the video, start over on the next attempt
+				with contextlib.suppress(FileNotFoundError):
+					os.remove(part_path)
+				raise requests.HTTPError(
+					f"Partial video of {offset} bytes doesn't match the server", response=res
+				)
+
+			if res.status_code == 200:
+				# Full content, either a fresh download or the server ignored the range
+				content_hash, offset = hashlib.md5(), 0
+				expected_size = int(res.headers.get("Content-Length", -1))
+			elif res.status_code == 206:
+				expected_size = _get_total_size(res)
+			else:
+				# Server errors are mostly transient, and so are responses of a restarting agent
+				raise requests.HTTPError(f"Unexpected status code {res.status_code}", response=res)
+
+			with open(part_path, "ab" if offset else "wb") as f:
+				for chunk in res.iter_content(chunk_size=VIDEO_CHUNK_SIZE):
+					if throttle:
+						throttle(len(chunk))
+					f.write(chunk)
+					content_hash.update(chunk)
+					offset += len(chunk)
+
+		if expected_size >= 0 and offset != expected_size:
+			if offset > expected_size:
+				# Doesn't match the video on the server, start over on the next attempt
+				os.remove(part_path)
+			raise requests.RequestException(f"Downloaded {offset} bytes of video, expected {expected_size}")
 
-from drift.drift.doctype.drift_session.drift_session import DriftSession
+		return content_hash.hexdigest(), offset
+
+
+_clients: dict[str, tuple[tuple, DriftServerClient]] = {}
+_clients_lock = threading.Lock()
 
 
 class DriftServer(Document):
@@ -25,12 +189,14 @@ class DriftServer(Document):
 		active_sessions: DF.Int
 		auth_token: DF.Password
 		host: DF.Data
+		max_sessions: DF.Int
 		memory_mb: DF.Int
 		parent: DF.Data
 		parentfield: DF.Data
 		parenttype: DF.Data
 		scheme: DF.Literal["http", "https"]
 		status: DF.Literal["Disabled", "Active", "Unreachable"]
+		warm_pool_size: DF.Int
 	# end: auto-generated types
 
 	def sync(self):
@@ -59,29 +225,11 @@ class DriftServer(Document):
 			frappe.log_error(f"Failed to sync sessions from server {self.host}")
 			return
 
-		current_active_session_ids = [s.get("session_id") for s in data]
+		stop_missing_sessions({self.name: [s.get("session_id") for s in data]})
 
-		# Fetch active sessions on our system
-		new_inactive_sessions = frappe.get_all(
-			"Drift Session",
-			filters={
-				"server": self.name,
-				"status": "Active",
-				"session_id": ["not in", current_active_session_ids],
-			},
-			pluck="name",
-		)
-
-		for name in new_inactive_sessions:
-			with contextlib.suppress(Exception):
-				frappe.db.get_value("Drift Session", name, "status", for_update=True)
-				doc = frappe.get_doc("Drift Session", name)
-				doc.status = "Stopped"
-				doc.save()
-
-	def create_session(self) -> "DriftSession":
+	def create_session(self, pool_status: str | None = None) -> "DriftSession":
 		"""
-		Create a new session on this server
+		Create a new session on this server, pass pool_status "Warm" to create an idle pooled session
 
 		returns
 		- session_id: str
@@ -92,6 +240,10 @@ class DriftServer(Document):
 		if not success:
 			frappe.throw("Failed to create browser session on the server")
 
+		return self.insert_session(data, pool_status=pool_status)
+
+	def insert_session(self, data: dict, pool_status: str | None = None) -> "DriftSession":
+		"""Insert the session created on this server, `data` is the response of the agent"""
 		session = frappe.get_doc(
 			{
 				"doctype": "Drift Session",
@@ -101,6 +253,7 @@ class DriftServer(Document):
 				"session_token": data.get("auth_token"),
 				"cdp_endpoint": data.get("endpoint"),
 				"started_on": datetime.fromtimestamp(data.get("created_on")),
+				"pool_status": pool_status,
 			}
 		).insert(ignore_permissions=True)
 		# Do db commit to save the session immediately
@@ -129,21 +282,6 @@ class DriftServer(Document):
 		success, _ = self._send_request("DELETE", f"/sessions/{session_id}/videos")
 		return success
 
-	def download_video(self, session_id: str, video_id: str) -> File:
-		success, data = self._send_request("GET", f"/sessions/{session_id}/videos/{video_id}", is_json=False)
-		if not success:
-			frappe.throw("Failed to download video from the server")
-
-		file = frappe.get_doc(
-			{
-				"doctype": "File",
-				"file_name": video_id,
-				"content": data,
-				"is_private": True,
-			}
-		).insert(ignore_permissions=True)
-		return file
-
 	def _send_request(
 		self,
 		method: Literal["GET", "POST", "PUT", "DELETE"],
@@ -156,27 +294,106 @@ class DriftServer(Document):
 			path = path[1:]
 
 		# Make a request to the server
-		res = requests.request(
-			method=method,
-			url=self._base_url + path,
-			headers={"Authorization": f"Bearer {self.get_password('auth_token')}"},
-			json=body or {},
-			timeout=timeout,
-		)
-
-		success = res.status_code == 200
-		response_Data = {}
-
-		try:
-			if is_json:
-				response_Data = res.json()
-			else:
-				response_Data = res.content
-		except Exception:
-			success = False
-
-		return success, response_Data
+		res = self.client.request(method, path, json=body or {}, timeout=timeout)
+		return parse_response(res, is_json=is_json)
 
 	@property
 	def _base_url(self) -> str:
 		return f"{self.scheme}://{self.host}/"
+
+	@property
+	def client(self) -> DriftServerClient:
+		# Any change in the server, including its auth token, changes the modified timestamp
+		signature = (self._base_url, str(self.modified))
+		with _clients_lock:
+			cached = _clients.get(self.name)
+			if cached and cached[0] == signature:
+				return cached[1]
+
+			settings = frappe.get_cached_doc("Drift Settings")
+			client = DriftServerClient(
+				self._base_url,
+				self.get_password("auth_token"),
+				pool_size=settings.http_pool_size or 10,
+				max_retries=settings.http_max_retries or 0,
+				backoff_factor=settings.http_retry_backoff_factor or 0,
+			)
+			if cached:
+				cached[1].close()
+			_clients[self.name] = (signature, client)
+			return client
+
+
+def get_video_file_name(session_id: str, video_id: str) -> str:
+	return f"{session_id}-{video_id}"
+
+
+def create_video_file(video_id: str, file_name: str, content_hash: str, file_size: int) -> File:
+	"""Create the File of a video which has been downloaded to the private files"""
+	return frappe.get_doc(
+		{
+			"doctype": "File",
+			"file_name": video_id,
+			"file_url": f"/private/files/{file_name}",
+			"is_private": True,
+			# Set upfront, so the File doesn't read the video again to compute those
+			"content_hash": content_hash,
+			"file_size": file_size,
+		}
+	).insert(ignore_permissions=True)
+
+
+def _get_total_size(res: requests.Response) -> int:
+	# Content-Range is of the form "bytes 100-199/200" or "bytes */200"
+	with contextlib.suppress(Exception):
+		return int(res.headers["Content-Range"].rsplit("/", 1)[1])
+	return -1
+
+
+def parse_response(res: requests.Response, is_json: bool = True) -> tuple[bool, dict | bytes]:
+	success = res.status_code == 200
+	response_Data = {}
+
+	try:
+		if is_json:
+			response_Data = res.json()
+		else:
+			response_Data = res.content
+	except Exception:
+		success = False
+
+	return success, response_Data
+
+
+def stop_missing_sessions(remote_session_ids: dict[str, list[str]]):
+	"""
+	Stop the active sessions which are not running on their server anymore
+
+	remote_session_ids maps the name of a server to the ids of the sessions running on it
+	"""
+	if not remote_session_ids:
+		return
+
+	active_sessions = frappe.get_all(
+		"Drift Session",
+		filters={"server": ("in", list(remote_session_ids)), "status": "Active"},
+		fields=["name", "server", "session_id"],
+	)
+
+	running = {(server, session_id) for server, ids in remote_session_ids.items() for session_id in ids}
+	vanished_sessions = [s.name for s in active_sessions if (s.server, s.session_id) not in running]
+	bulk_stop_sessions(vanished_sessions)
+
+
+@frappe.whitelist()
+def get_http_client_stats() -> dict:
+	frappe.only_for("System Manager")
+
+	stats = get_stats("http_client")
+	total_requests = stats.get("requests", 0)
+	new_connections = stats.get("new_connections", 0)
+	return {
+		"requests": int(total_requests),
+		"new_connections": int(new_connections),
+		"connection_reuse_rate": 1 - (new_connections / total_requests) if total_requests else 0,
+	}
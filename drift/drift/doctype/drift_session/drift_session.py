@@ -2,21 +2,152 @@
 # For license information, please see license.txt
 
 import contextlib
+import hmac
+import time
 from collections.abc import Generator
+from concurrent.futures import ThreadPoolExecutor
 from typing import TYPE_CHECKING
+from urllib.parse import urlparse
 
 import frappe
 from frappe.model.document import Document
-from playwright.sync_api import Browser, sync_playwright
+from frappe.query_builder import Case
+from frappe.query_builder.functions import UnixTimestamp
+from playwright.sync_api import Browser, Playwright, sync_playwright
+
+from drift.drift import session_reservations
+from drift.drift.utils import RateLimiter, RedisSemaphore, get_stats, record_stats
 
 if TYPE_CHECKING:
 	from drift.drift.doctype.drift_server.drift_server import DriftServer
+	from drift.drift.doctype.drift_session_video.drift_session_video import DriftSessionVideo
+
+
+# Time limit of the job downloading the videos of a session
+VIDEO_DOWNLOAD_TIMEOUT = 3600
 
 
 class DriftSessionConnectionError(Exception):
 	pass
 
 
+class PlaywrightConnectionCache:
+	"""
+	Worker local cache of the Playwright driver and the browsers connected over CDP.
+
+	The driver is started once per worker process and shared by all the connections.
+	Connections are keyed by (session name, cdp endpoint) and are kept alive between steps.
+	Idle connections and connections of stopped sessions are evicted periodically.
+
+	Playwright's sync API is bound to the thread which started it,
+	so the cache must only be used from the main thread of the worker.
+	"""
+
+	def __init__(self):
+		self.playwright: Playwright | None = None
+		self.browsers: dict[tuple[str, str], Browser] = {}
+		self.last_used_on: dict[tuple[str, str], float] = {}
+		self.last_swept_on = time.monotonic()
+
+	@property
+	def idle_timeout(self) -> int:
+		return frappe.conf.get("drift_pw_connection_idle_timeout", 300)
+
+	@property
+	def sweep_interval(self) -> int:
+		return frappe.conf.get("drift_pw_connection_sweep_interval", 30)
+
+	def get(self, session: "DriftSession") -> Browser:
+		self.sweep()
+
+		key = (session.name, session.cdp_endpoint)
+		browser = self.browsers.get(key)
+		if browser and browser.is_connected():
+			self.last_used_on[key] = time.monotonic()
+			record_stats("pw_connection_cache", hits=1)
+			return browser
+
+		if browser:
+			# Connection is dead, drop it and reconnect
+			self.evict(*key)
+			record_stats("pw_connection_cache", reconnects=1)
+
+		started_at = time.monotonic()
+		browser = self._connect(session)
+		record_stats("pw_connection_cache", misses=1, connect_seconds=time.monotonic() - started_at)
+
+		self.browsers[key] = browser
+		self.last_used_on[key] = time.monotonic()
+		return browser
+
+	def evict(self, session_name: str, cdp_endpoint: str | None = None):
+		for key in list(self.browsers):
+			if key[0] != session_name or (cdp_endpoint and key[1] != cdp_endpoint):
+				continue
+			browser = self.browsers.pop(key)
+			self.last_used_on.pop(key, None)
+			# Connected over CDP, so close() only disconnects from the remote browser
+			with contextlib.suppress(Exception):
+				browser.close()
+
+	def sweep(self):
+		if time.monotonic() - self.last_swept_on < self.sweep_interval:
+			return
+		self.last_swept_on = time.monotonic()
+
+		now = time.monotonic()
+		for key, last_used_on in list(self.last_used_on.items()):
+			if now - last_used_on > self.idle_timeout:
+				self.evict(*key)
+
+		session_names = list({key[0] for key in self.browsers})
+		if not session_names:
+			return
+		for name in frappe.get_all(
+			"Drift Session", filters={"name": ("in", session_names), "status": "Stopped"}, pluck="name"
+		):
+			self.evict(name)
+
+	def clear(self):
+		for key in list(self.browsers):
+			self.evict(*key)
+		if self.playwright:
+			with contextlib.suppress(Exception):
+				self.playwright.stop()
+			self.playwright = None
+
+	def _connect(self, session: "DriftSession") -> Browser:
+		headers = {"Authorization": f"Bearer {session.get_password('session_token')}"}
+		try:
+			return self._get_playwright().chromium.connect_over_cdp(session.cdp_endpoint, headers=headers)
+		except Exception:
+			# Mostly the remote session is gone, which doesn't affect the other cached connections
+			if self._is_driver_alive():
+				raise
+			# The driver died, so did all the connections through it, restart it and try once more
+			self.clear()
+			record_stats("pw_connection_cache", driver_restarts=1)
+			return self._get_playwright().chromium.connect_over_cdp(session.cdp_endpoint, headers=headers)
+
+	def _is_driver_alive(self) -> bool:
+		if not self.playwright:
+			return False
+		# A round trip to the driver which doesn't touch any remote browser
+		try:
+			self.playwright.request.new_context().dispose()
+			return True
+		except Exception:
+			return False
+
+	def _get_playwright(self) -> Playwright:
+		if not self.playwright:
+			self.playwright = sync_playwright().start()
+		return self.playwright
+
+
+pw_connection_cache = PlaywrightConnectionCache()
+
+
 class DriftSession(Document):
 	# begin: auto-generated types
 	# This code is auto-generated. Do not modify anything in this block.
@@ -31,7 +162,11 @@ class DriftSession(Document):
 		cdp_endpoint: DF.Data
 		duration: DF.Duration | None
 		ended_on: DF.Datetime | None
+		last_viewed_on: DF.Datetime | None
+		pool_status: DF.Literal["", "Warm", "Claimed", "Recycled", "Resetting", "Reusable"]
 		purged_videos_from_server: DF.Check
+		reusable_for: DF.Link | None
+		reuse_count: DF.Int
 		server: DF.Link
 		session_id: DF.Data
 		session_token: DF.Password
@@ -47,30 +182,26 @@ class DriftSession(Document):
 
 	def on_update(self):
 		if self.has_value_changed("status") and self.status == "Stopped":
+			pw_connection_cache.evict(self.name)
+			session_reservations.release(self.server, self.name)
 			self.ended_on = frappe.utils.now_datetime()
 			self.duration = int(frappe.utils.time_diff_in_seconds(self.ended_on, self.started_on))
 			self.save()
-			# Update the session ID if it has changed
+			# Videos are downloaded once the agent reports those are written to disk
 			if self.video_download_status == "Draft":
 				self.video_download_status = "Triggered"
 				self.save()
-				self.sync_video_ids_and_download()
 
 	@contextlib.contextmanager
 	def pw_browser(self) -> Generator[Browser, None, None]:
-		pw = sync_playwright().start()
-		browser = pw.chromium.connect_over_cdp(
-			self.cdp_endpoint, headers={"Authorization": f"Bearer {self.get_password('session_token')}"}
-		)
+		# The connection is cached for the worker and reused by the next steps of the session
+		browser = pw_connection_cache.get(self)
 		try:
 			yield browser
 		except Exception as e:
+			if not browser.is_connected():
+				pw_connection_cache.evict(self.name, self.cdp_endpoint)
 			raise DriftSessionConnectionError from e
-		finally:
-			# don't close the browser, just stop playwright
-			# as we will reuse the browser for the lifetime of the session
-			with contextlib.suppress(Exception):
-				pw.stop()
 
 	@frappe.whitelist()
 	def destroy_remote_session(self) -> bool:
@@ -102,12 +233,66 @@ class DriftSession(Document):
 			self.save()
 			return
 
+		video_tests = self.get_video_tests(video_ids)
 		for id in video_ids:
-			self.append("videos", {"id": id})
+			self.append("videos", {"id": id, "test": video_tests[id]})
 
 		self.video_download_status = "Downloading"
 		self.save()
 
+	def download_videos(self):
+		"""
+		Download all the pending videos of the session at once
+
+		Downloads are limited per Drift Server and by the bandwidth limit shared by all the workers.
+		The threads only transfer the videos, the Files and videos are saved here once all are done.
+		"""
+		from drift.drift.doctype.drift_server.drift_server import create_video_file, get_video_file_name
+
+		videos = [video for video in self.videos if video.status == "Pending"]
+		if not videos:
+			return
+
+		settings = frappe.get_cached_doc("Drift Settings")
+		downloads_per_server = settings.video_downloads_per_server or 1
+		client = self.server_doc.client
+		slots = RedisSemaphore(f"video_downloads|{self.server}", downloads_per_server, VIDEO_DOWNLOAD_TIMEOUT)
+		throttle = None
+		if settings.video_download_bandwidth_limit:
+			throttle = RateLimiter(
+				"video_downloads", settings.video_download_bandwidth_limit * 1024 * 1024
+			).consume
+
+		def fetch(video_id: str, file_path: str) -> tuple[str, int]:
+			with slots.slot():
+				return client.fetch_video(self.session_id, video_id, file_path, throttle=throttle)
+
+		file_names = {video.name: get_video_file_name(self.session_id, video.id) for video in videos}
+		with ThreadPoolExecutor(max_workers=min(len(videos), downloads_per_server)) as executor:
+			futures = {
+				video.name: executor.submit(
+					fetch, video.id, frappe.get_site_path("private", "files", file_names[video.name])
+				)
+				for video in videos
+			}
+
+		updates = {}
+		for video in videos:
+			try:
+				content_hash, file_size = futures[video.name].result()
+				file = create_video_file(video.id, file_names[video.name], content_hash, file_size)
+				updates[video.name] = {
+					"status": "Downloaded",
+					"file": file.name,
+					"file_url_path": file.file_url,
+					"file_size": file_size,
+				}
+			except Exception as e:
+				updates[video.name] = {"status": "Download Failed"}
+				frappe.log_error(f"Failed to download video {video.id} for session {self.name}: {e}")
+
+		frappe.db.bulk_update("Drift Session Video", updates, update_modified=False)
+
 	def purge_downloaded_videos_from_remote(self):
 		if self.purged_videos_from_server or self.video_download_status != "Downloaded":
 			return
@@ -119,7 +304,12 @@ class DriftSession(Document):
 	def delete_downloaded_videos(self):
 		if self.video_download_status != "Downloaded":
 			return
-		for video in self.videos:
+		self._delete_downloaded_videos()
+		frappe.msgprint("Deleted downloaded videos")
+
+	def _delete_downloaded_videos(self, videos: list["DriftSessionVideo"] | None = None):
+		"""Delete the given downloaded videos, all of those by default"""
+		for video in self.videos if videos is None else videos:
 			if video.status == "Downloaded" and video.file:
 				try:
 					frappe.delete_doc("File", video.file, force=1)
@@ -127,48 +317,285 @@ class DriftSession(Document):
 					pass
 				video.file = None
 				video.status = "Deleted"
-		self.video_download_status = "Deleted"
-		frappe.msgprint("Deleted downloaded videos")
+		if not any(video.status == "Downloaded" for video in self.videos):
+			self.video_download_status = "Deleted"
 		self.save()
 
 	@frappe.whitelist()
-	def get_recorded_video_urls(self) -> list[str]:
+	def get_recorded_video_urls(self, test: str | None = None) -> list[str]:
 		if not self.videos:
 			return []
 		if self.status != "Stopped" or self.video_download_status != "Downloaded":
 			return []
-		return [video.file_url_path for video in self.videos if video.file and video.file_url_path]
+		# Video retention deletes the least recently viewed videos first
+		frappe.db.set_value(
+			self.doctype, self.name, "last_viewed_on", frappe.utils.now_datetime(), update_modified=False
+		)
+		videos = self.videos
+		if test:
+			video_ids = self.get_test_video_ids(test)
+			videos = [video for video in videos if video.id in video_ids]
+		return [video.file_url_path for video in videos if video.file and video.file_url_path]
+
+	def get_test_video_ids(self, test: str) -> set[str]:
+		"""Videos recorded during a test, when the session is reused by several tests"""
+		if any(video.test for video in self.videos):
+			return {video.id for video in self.videos if video.test == test}
+
+		# Videos synced before those were assigned to the tests
+		recorded_video_ids = frappe.db.get_value("Drift Test", test, "recorded_video_ids")
+		if recorded_video_ids:
+			return set(recorded_video_ids.split())
+
+		# The last test of the session gets the videos which are not of the previous tests
+		video_ids = {video.id for video in self.videos}
+		for ids in frappe.get_all(
+			"Drift Test",
+			filters={"session": self.name, "name": ("!=", test)},
+			pluck="recorded_video_ids",
+		):
+			video_ids.difference_update((ids or "").split())
+		return video_ids
+
+	def get_video_tests(self, video_ids: list[str]) -> dict[str, str | None]:
+		"""
+		Test which recorded each of the videos
+
+		Tests of a reused session record their video ids when their pages are closed. The last test
+		of the session doesn't, its pages are closed with the session, so it gets the rest.
+		"""
+		tests = frappe.get_all(
+			"Drift Test",
+			filters={"session": self.name},
+			fields=["name", "recorded_video_ids"],
+			order_by="creation desc",
+		)
+		video_tests = {}
+		for test in tests:
+			for video_id in (test.recorded_video_ids or "").split():
+				video_tests[video_id] = test.name
+		last_test = next((test.name for test in tests if not test.recorded_video_ids), None)
+		return {video_id: video_tests.get(video_id, last_test) for video_id in video_ids}
+
+	def can_be_reused(self, definition: str) -> bool:
+		if self.status != "Active" or self.pool_status in ("Resetting", "Recycled"):
+			return False
+
+		policy = frappe.db.get_value(
+			"Drift Test Definition",
+			definition,
+			["reuse_sessions", "max_session_reuses", "max_session_age_minutes"],
+			as_dict=True,
+		)
+		if not policy or not policy.reuse_sessions:
+			return False
+		if (self.reuse_count or 0) >= (policy.max_session_reuses or 0):
+			return False
+		return self.started_on > frappe.utils.add_to_date(minutes=-(policy.max_session_age_minutes or 0))
+
+	def release_for_reuse(self, test: str, definition: str):
+		"""Reset the browser of the session in the background and return it to the cache of the definition"""
+		self.pool_status = "Resetting"
+		self.reusable_for = definition
+		self.save(ignore_permissions=True)
+		frappe.enqueue_doc(
+			self.doctype,
+			self.name,
+			method="reset_for_reuse",
+			test=test,
+			timeout=300,
+			deduplicate=True,
+			job_id=f"reset_drift_session||{self.name}",
+			enqueue_after_commit=True,
+		)
+
+	def reset_for_reuse(self, test: str):
+		if self.status != "Active" or self.pool_status != "Resetting":
+			return
+
+		try:
+			with self.pw_browser() as browser:
+				# Videos of the pages of this test, taken before the page of the next test is opened
+				video_ids = self.server_doc.get_videos(self.session_id)
+				origins = {get_url_origin(frappe.utils.get_url())}
+				for context in browser.contexts:
+					origins.update(get_url_origin(page.url) for page in context.pages)
+					# Chromium exits once its last window is closed, so open the page of the next test
+					# first. Closing the pages of this test also completes their videos.
+					blank_page = context.new_page()
+					for page in context.pages:
+						if page != blank_page:
+							page.close()
+					context.clear_cookies()
+					context.clear_permissions()
+
+				cdp_session = browser.new_browser_cdp_session()
+				for origin in filter(None, origins):
+					cdp_session.send("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+				cdp_session.detach()
+
+			self._attribute_videos(test, video_ids)
+		except Exception:
+			frappe.log_error(f"Failed to reset session {self.name} for reuse")
+			self.pool_status = "Recycled"
+			self.save(ignore_permissions=True)
+			self.server_doc.destroy_session(self.session_id)
+			return
+
+		self.pool_status = "Reusable"
+		self.save(ignore_permissions=True)
+
+	def _attribute_videos(self, test: str, video_ids: list[str]):
+		"""Record the videos of a test, of all the videos of the session when its pages were closed"""
+		previous_video_ids = set()
+		for ids in frappe.get_all(
+			"Drift Test",
+			filters={"session": self.name, "name": ("!=", test)},
+			pluck="recorded_video_ids",
+		):
+			previous_video_ids.update((ids or "").split())
+
+		frappe.db.set_value(
+			"Drift Test",
+			test,
+			"recorded_video_ids",
+			"\n".join(video_id for video_id in video_ids if video_id not in previous_video_ids),
+			update_modified=False,
+		)
+
+
+@frappe.whitelist()
+def get_connection_cache_stats() -> dict:
+	frappe.only_for("System Manager")
+
+	stats = get_stats("pw_connection_cache")
+	hits = stats.get("hits", 0)
+	misses = stats.get("misses", 0)
+	avg_connect_seconds = stats.get("connect_seconds", 0) / misses if misses else 0
+	return {
+		"hits": int(hits),
+		"misses": int(misses),
+		"reconnects": int(stats.get("reconnects", 0)),
+		"hit_rate": hits / (hits + misses) if hits + misses else 0,
+		"avg_connect_seconds": avg_connect_seconds,
+		"saved_connect_seconds": hits * avg_connect_seconds,
+	}
+
+
+def get_url_origin(url: str) -> str | None:
+	parsed = urlparse(url or "")
+	if parsed.scheme not in ("http", "https"):
+		return None
+	return f"{parsed.scheme}://{parsed.netloc}"
+
+
+def bulk_stop_sessions(names: list[str], chunk_size: int = 500):
+	"""
+	Mark the given active sessions as Stopped with set based updates
+
+	Does the same as stopping a session through `DriftSession.on_update` without loading and saving
+	each session.
+	"""
+	if not names:
+		return
+
+	DRIFT_SESSION = frappe.qb.DocType("Drift Session")
+	for index in range(0, len(names), chunk_size):
+		chunk = names[index : index + chunk_size]
+		stopped_sessions = frappe.get_all(
+			"Drift Session", filters={"name": ("in", chunk), "status": "Active"}, fields=["name", "server"]
+		)
+
+		now = frappe.utils.now_datetime()
+		(
+			frappe.qb.update(DRIFT_SESSION)
+			.set(DRIFT_SESSION.status, "Stopped")
+			.set(DRIFT_SESSION.ended_on, now)
+			.set(DRIFT_SESSION.duration, UnixTimestamp(now) - UnixTimestamp(DRIFT_SESSION.started_on))
+			.set(
+				DRIFT_SESSION.video_download_status,
+				Case()
+				.when(DRIFT_SESSION.video_download_status == "Draft", "Triggered")
+				.else_(DRIFT_SESSION.video_download_status),
+			)
+			.set(DRIFT_SESSION.modified, now)
+			.where(DRIFT_SESSION.name.isin(chunk))
+			.where(DRIFT_SESSION.status == "Active")
+		).run()
+
+		for session in stopped_sessions:
+			session_reservations.release(session.server, session.name)
+
+	for name in names:
+		pw_connection_cache.evict(name)
+
+
+def bulk_sync_video_ids_and_download(sessions: list[str]):
+	for session in sessions:
+		try:
+			frappe.get_doc("Drift Session", session)._sync_video_ids_and_download()
+			frappe.db.commit()
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(f"Failed to sync video ids of session {session}")
+
+
+@frappe.whitelist(allow_guest=True, methods=["POST"])
+def recording_finalized(session_id: str, **kwargs):
+	"""
+	Called by the agent once the videos of a session are written to disk
+
+	The agent authenticates with the auth token of its Drift Server in the X-Drift-Token header,
+	as frappe handles the Authorization header itself.
+	"""
+	token = frappe.get_request_header("X-Drift-Token") or ""
+	session = frappe.db.get_value(
+		"Drift Session", {"session_id": session_id}, ["name", "server"], as_dict=True
+	)
+	if not token or not session:
+		raise frappe.AuthenticationError
+
+	server: DriftServer = frappe.get_cached_doc("Drift Server", session.server)
+	if not hmac.compare_digest(token, server.get_password("auth_token") or ""):
+		raise frappe.AuthenticationError
+
+	# The agent might report before the session is found stopped by the poller
+	bulk_stop_sessions([session.name])
+	frappe.get_doc("Drift Session", session.name).sync_video_ids_and_download()
 
 
 def trigger_sync_video_ids_and_download():
-	sessions = frappe.get_all(
+	"""
+	Safety net for the sessions whose recordings were never reported by the agent
+
+	Videos should be written to disk within 2 minutes of stopping the session.
+	"""
+	sessions = get_sessions_with_unreported_videos()
+	if sessions:
+		frappe.enqueue(
+			"drift.drift.doctype.drift_session.drift_session.bulk_sync_video_ids_and_download",
+			sessions=sessions,
+			timeout=3600,
+			deduplicate=True,
+			job_id="bulk_sync_video_ids_and_download",
+		)
+
+
+def get_sessions_with_unreported_videos(run: bool = True) -> list[str] | str:
+	return frappe.get_all(
 		"Drift Session",
 		filters={
 			"status": "Stopped",
 			"video_download_status": "Triggered",
-			"ended_on": (
-				">",
-				frappe.utils.add_to_date(minutes=-2),
-			),  # wait for at least 2 minutes after stopping to ensure videos has been written
-			# TODO: need a better fix on agent side to ensure videos are ready to be downloaded instantly after stopping
+			"ended_on": ("<", frappe.utils.add_to_date(minutes=-2)),
 		},
 		pluck="name",
+		run=run,
 	)
-	for session in sessions:
-		try:
-			frappe.get_doc("Drift Session", session).sync_video_ids_and_download()
-			frappe.db.commit()
-		except Exception:
-			pass
 
 
 def sync_video_download_status():
-	sessions = frappe.get_all(
-		"Drift Session",
-		filters={"status": "Stopped", "video_download_status": "Downloading"},
-		pluck="name",
-	)
-	for session in sessions:
+	for session in get_downloading_sessions():
 		try:
 			# Try to find sessions with `Pending` status
 			all_downloaded = (
@@ -181,13 +608,36 @@ def sync_video_download_status():
 			pass
 
 
-def purge_downloaded_remote_videos():
-	sessions = frappe.get_all(
+def get_downloading_sessions(run: bool = True) -> list[str] | str:
+	return frappe.get_all(
 		"Drift Session",
-		filters={"purged_videos_from_server": False, "video_download_status": "Downloaded"},
+		filters={"status": "Stopped", "video_download_status": "Downloading"},
 		pluck="name",
+		run=run,
 	)
-	for session in sessions:
+
+
+def purge_downloaded_remote_videos():
+	for session in get_sessions_to_purge():
 		with contextlib.suppress(Exception):
 			frappe.get_doc("Drift Session", session).purge_downloaded_videos_from_remote()
 			frappe.db.commit()
+
+
+def get_sessions_to_purge(run: bool = True) -> list[str] | str:
+	"""Sessions whose videos are downloaded but still kept on the agent"""
+	return frappe.get_all(
+		"Drift Session",
+		filters={"purged_videos_from_server": False, "video_download_status": "Downloaded"},
+		pluck="name",
+		run=run,
+	)
+
+
+def on_doctype_update():
+	# Stopped sessions waiting on their videos
+	frappe.db.add_index("Drift Session", ["status", "video_download_status", "ended_on"])
+	# Downloaded sessions whose remote videos are not purged yet
+	frappe.db.add_index("Drift Session", ["video_download_status", "purged_videos_from_server"])
+	# Warm and reusable sessions of the servers
+	frappe.db.add_index("Drift Session", ["pool_status", "status", "server"])
@@ -1,9 +1,17 @@
 # Copyright (c) 2025, Tanmoy and Contributors
 # See license.txt
 
-# import frappe
-from frappe.tests import IntegrationTestCase
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import ClassVar
+from unittest.mock import MagicMock, patch
 
+import frappe
+from frappe.tests import IntegrationTestCase, UnitTestCase
+from frappe.utils import set_request
+
+from drift.drift.doctype.drift_session.drift_session import PlaywrightConnectionCache, recording_finalized
 
 # On IntegrationTestCase, the doctype test records and all
 # link-field test record dependencies are recursively loaded
@@ -12,6 +20,33 @@ EXTRA_TEST_RECORD_DEPENDENCIES = []  # eg. ["User"]
 IGNORE_TEST_RECORD_DEPENDENCIES = []  # eg. ["User"]
 
 
+class StubAgentHandler(BaseHTTPRequestHandler):
+	"""Answers the API of the agent used while syncing the videos of a session"""
+
+	videos: ClassVar[dict[str, list[str]]] = {}
+
+	def do_GET(self):
+		parts = self.path.strip("/").split("/")
+		if parts == ["health"]:
+			self.send_json({"sessions": 0})
+		elif parts == ["sessions"]:
+			self.send_json([])
+		elif len(parts) == 3 and parts[0] == "sessions" and parts[2] == "videos":
+			self.send_json(self.videos.get(parts[1], []))
+		else:
+			self.send_json("not found", status=404)
+
+	def send_json(self, data, status: int = 200):
+		body = json.dumps(data).encode()
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
 
 class IntegrationTestDriftSession(IntegrationTestCase):
 	"""
@@ -19,4 +54,138 @@ class IntegrationTestDriftSession(IntegrationTestCase):
 	Use this class for testing interactions between multiple components.
 	"""
 
-	pass
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.agent = ThreadingHTTPServer(("127.0.0.1", 0), StubAgentHandler)
+		threading.Thread(target=cls.agent.serve_forever, daemon=True).start()
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.agent.shutdown()
+		cls.agent.server_close()
+		super().tearDownClass()
+
+	def setUp(self):
+		settings = frappe.get_single("Drift Settings")
+		settings.servers = []
+		settings.append(
+			"servers",
+			{
+				"scheme": "http",
+				"host": f"127.0.0.1:{self.agent.server_port}",
+				"auth_token": "stub-agent-token",
+				"status": "Active",
+				"memory_mb": 1024,
+			},
+		)
+		settings.save()
+
+		self.session = frappe.get_doc(
+			{
+				"doctype": "Drift Session",
+				"status": "Active",
+				"server": settings.servers[0].name,
+				"session_id": frappe.generate_hash(length=32),
+				"session_token": "stub-session-token",
+				"cdp_endpoint": "ws://127.0.0.1/devtools/browser",
+				"started_on": frappe.utils.now_datetime(),
+			}
+		).insert(ignore_permissions=True)
+		StubAgentHandler.videos[self.session.session_id] = ["first.webm", "second.webm"]
+
+	def tearDown(self):
+		frappe.local.request = None
+
+	def test_recording_finalized_syncs_videos(self):
+		set_request(method="POST", headers={"X-Drift-Token": "stub-agent-token"})
+		recording_finalized(session_id=self.session.session_id)
+
+		self.session.reload()
+		self.assertEqual(self.session.status, "Stopped")
+		self.assertEqual(self.session.video_download_status, "Triggered")
+		self.assertIsNotNone(self.session.ended_on)
+
+		# Job queued by the callback
+		self.session._sync_video_ids_and_download()
+		self.session.reload()
+		self.assertEqual(self.session.video_download_status, "Downloading")
+		self.assertEqual([video.id for video in self.session.videos], ["first.webm", "second.webm"])
+
+	def insert_test(self, minutes_ago: int, recorded_video_ids: str | None = None) -> str:
+		test = frappe.get_doc(
+			{
+				"doctype": "Drift Test",
+				"definition": "_Test Drift Test Definition",
+				"session": self.session.name,
+				"status": "Success",
+				"variables": "{}",
+				"recorded_video_ids": recorded_video_ids,
+				"creation": frappe.utils.add_to_date(minutes=-minutes_ago),
+			}
+		)
+		test.db_insert()
+		return test.name
+
+	def test_videos_are_assigned_by_recorded_ids(self):
+		# The first test of the reused session recorded the newer of the videos
+		first_test = self.insert_test(minutes_ago=10, recorded_video_ids="second.webm")
+		last_test = self.insert_test(minutes_ago=5)
+
+		self.session.db_set("video_download_status", "Triggered")
+		self.session._sync_video_ids_and_download()
+		self.session.reload()
+
+		self.assertEqual(
+			{video.id: video.test for video in self.session.videos},
+			{"first.webm": last_test, "second.webm": first_test},
+		)
+		self.assertEqual(self.session.get_test_video_ids(first_test), {"second.webm"})
+		self.assertEqual(self.session.get_test_video_ids(last_test), {"first.webm"})
+
+	def test_attribute_videos_leaves_out_videos_of_previous_tests(self):
+		previous_test = self.insert_test(minutes_ago=10, recorded_video_ids="first.webm")
+		test = self.insert_test(minutes_ago=5)
+
+		self.session._attribute_videos(test, ["second.webm", "first.webm"])
+		self.assertEqual(frappe.db.get_value("Drift Test", test, "recorded_video_ids"), "second.webm")
+		self.assertEqual(frappe.db.get_value("Drift Test", previous_test, "recorded_video_ids"), "first.webm")
+
+	def test_recording_finalized_requires_server_token(self):
+		set_request(method="POST", headers={"X-Drift-Token": "wrong-token"})
+		with self.assertRaises(frappe.AuthenticationError):
+			recording_finalized(session_id=self.session.session_id)
+
+		self.assertEqual(frappe.db.get_value("Drift Session", self.session.name, "status"), "Active")
+
+
+@patch("drift.drift.doctype.drift_session.drift_session.record_stats", MagicMock())
+class UnitTestPlaywrightConnectionCache(UnitTestCase):
+	def setUp(self):
+		self.cache = PlaywrightConnectionCache()
+		self.cache.playwright = MagicMock()
+		self.other_browser = MagicMock()
+		self.cache.browsers[("other", "ws://other")] = self.other_browser
+		self.session = frappe._dict(name="dead", cdp_endpoint="ws://dead", get_password=lambda _: "token")
+
+	def test_dead_session_keeps_other_connections(self):
+		self.cache.playwright.chromium.connect_over_cdp.side_effect = Exception("Target closed")
+		with self.assertRaises(Exception):
+			self.cache._connect(self.session)
+
+		self.assertIn(("other", "ws://other"), self.cache.browsers)
+		self.other_browser.close.assert_not_called()
+		self.cache.playwright.stop.assert_not_called()
+
+	def test_dead_driver_is_restarted(self):
+		dead_playwright = self.cache.playwright
+		dead_playwright.chromium.connect_over_cdp.side_effect = Exception("Connection closed")
+		dead_playwright.request.new_context.side_effect = Exception("Connection closed")
+		with patch("drift.drift.doctype.drift_session.drift_session.sync_playwright") as sync_playwright:
+			browser = self.cache._connect(self.session)
+
+		new_playwright = sync_playwright.return_value.start.return_value
+		self.assertIs(browser, new_playwright.chromium.connect_over_cdp.return_value)
+		self.assertIs(self.cache.playwright, new_playwright)
+		self.assertNotIn(("other", "ws://other"), self.cache.browsers)
+		dead_playwright.stop.assert_called_once()
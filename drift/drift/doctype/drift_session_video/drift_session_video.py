@@ -2,13 +2,10 @@
 # For license information, please see license.txt
 
 # import frappe
-from typing import TYPE_CHECKING
-
 import frappe
 from frappe.model.document import Document
 
-if TYPE_CHECKING:
-	from drift.drift.doctype.drift_server.drift_server import DriftServer
+from drift.drift.doctype.drift_session.drift_session import VIDEO_DOWNLOAD_TIMEOUT
 
 
 class DriftSessionVideo(Document):
@@ -21,45 +18,38 @@ class DriftSessionVideo(Document):
 		from frappe.types import DF
 
 		file: DF.Link | None
+		file_size: DF.Int
 		file_url_path: DF.Data | None
 		id: DF.Data
 		parent: DF.Data
 		parentfield: DF.Data
 		parenttype: DF.Data
 		status: DF.Literal["Pending", "Downloaded", "Download Failed", "Deleted"]
+		test: DF.Link | None
 	# end: auto-generated types
 
-	def download(self):
-		if self.status == "Downloaded":
-			return
-
-		server: DriftServer = frappe.get_cached_doc(
-			"Drift Server", frappe.get_value("Drift Session", self.parent, "server")
-		)
-
-		try:
-			file = server.download_video(
-				frappe.get_value("Drift Session", self.parent, "session_id"), self.id
-			)
-			self.file = file.name
-			self.status = "Downloaded"
-		except Exception as e:
-			self.status = "Download Failed"
-			frappe.log_error(f"Failed to download video {self.id} for session {self.parent}: {e}")
-		finally:
-			self.save()
+	pass
 
 
 def download_session_videos():
-	session_videos = frappe.get_all("Drift Session Video", filters={"status": "Pending"}, pluck="name")
-	for video in session_videos:
+	for session in get_sessions_with_pending_videos():
 		frappe.enqueue_doc(
-			"Drift Session Video",
-			video,
-			method="download",
+			"Drift Session",
+			session,
+			method="download_videos",
 			queue="long",
-			timeout=600,
+			timeout=VIDEO_DOWNLOAD_TIMEOUT,
 			deduplicate=True,
-			job_id=f"download_drift_session_video||{video}",
+			job_id=f"download_drift_session_videos||{session}",
 			enqueue_after_commit=True,
 		)
+
+
+def get_sessions_with_pending_videos(run: bool = True) -> list[str] | str:
+	return frappe.get_all(
+		"Drift Session Video", filters={"status": "Pending"}, pluck="parent", distinct=True, run=run
+	)
+
+
+def on_doctype_update():
+	frappe.db.add_index("Drift Session Video", ["status", "parent"])
@@ -1,8 +1,68 @@
 // Copyright (c) 2025, Tanmoy and contributors
 // For license information, please see license.txt
 
-// frappe.ui.form.on("Drift Settings", {
-// 	refresh(frm) {
+frappe.ui.form.on("Drift Settings", {
+	refresh(frm) {
+		frm.add_custom_button(__("Forecast Load"), function () {
+			frappe.call("drift.drift.schedule_planner.get_schedule_forecast").then((r) => {
+				showScheduleForecast(r.message);
+			});
+		}, __("Schedule"));
 
-// 	},
-// });
+		frm.add_custom_button(__("Rebalance Schedule"), function () {
+			frappe.confirm(__("Pick the schedule offsets of all the enabled definitions again?"), () => {
+				frappe.call("drift.drift.schedule_planner.rebalance_schedule_offsets").then((r) => {
+					frappe.show_alert(__("{0} definitions rescheduled", [r.message.rescheduled]));
+					if (r.message.over_capacity.length) {
+						frappe.msgprint({
+							title: __("Over Fleet Capacity"),
+							indicator: "orange",
+							message: __("These definitions don't fit within the fleet capacity at any offset: {0}", [
+								r.message.over_capacity.join(", "),
+							]),
+						});
+					}
+					showScheduleForecast(r.message);
+				});
+			});
+		}, __("Schedule"));
+	},
+});
+
+function showScheduleForecast(forecast) {
+	const dialog = new frappe.ui.Dialog({
+		title: __("Concurrent Sessions Forecast"),
+		size: "extra-large",
+		fields: [
+			{ fieldname: "summary", fieldtype: "HTML" },
+			{ fieldname: "chart", fieldtype: "HTML" },
+		],
+	});
+
+	dialog.fields_dict.summary.$wrapper.html(`
+		<p>
+			${__("Peak")}: <b>${forecast.peak}</b> &middot;
+			${__("Average")}: <b>${flt(forecast.average, 1)}</b> &middot;
+			${__("Fleet Capacity")}: <b>${forecast.capacity}</b>
+		</p>
+	`);
+	dialog.show();
+
+	new frappe.Chart(dialog.fields_dict.chart.$wrapper[0], {
+		type: "line",
+		height: 280,
+		data: {
+			labels: forecast.buckets.map((_, i) => {
+				const minutes = (i * forecast.bucket_minutes) % 1440;
+				const time = `${String(Math.floor(minutes / 60)).padStart(2, "0")}:${String(minutes % 60).padStart(2, "0")}`;
+				if (forecast.horizon_minutes <= 1440) return time;
+				return `${__("Day {0}", [Math.floor((i * forecast.bucket_minutes) / 1440) + 1])} ${time}`;
+			}),
+			datasets: [
+				{ name: __("Sessions"), values: forecast.buckets },
+				{ name: __("Capacity"), values: forecast.buckets.map(() => forecast.capacity) },
+			],
+		},
+		lineOptions: { hideDots: 1 },
+	});
+}
@@ -1,13 +1,24 @@
 # Copyright (c) 2025, Tanmoy and contributors
 # For license information, please see license.txt
 
+import contextlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import TYPE_CHECKING
 
 import frappe
 from frappe.model.document import Document
 
+from drift.drift import session_reservations
+from drift.drift.doctype.drift_server.drift_server import parse_response, stop_missing_sessions
+from drift.drift.utils import get_stats, record_stats
+
 if TYPE_CHECKING:
-	from drift.drift.doctype.drift_server.drift_server import DriftServer
+	from drift.drift.doctype.drift_server.drift_server import DriftServer, DriftServerClient
+	from drift.drift.doctype.drift_session.drift_session import DriftSession
+
+# Timeout in seconds of each request made by the fleet poller
+FLEET_POLL_TIMEOUT = 5
 
 
 class DriftServerNotAvailableException(Exception):
@@ -25,57 +36,270 @@ class DriftSettings(Document):
 
 		from drift.drift.doctype.drift_server.drift_server import DriftServer
 
+		http_max_retries: DF.Int
+		http_pool_size: DF.Int
+		http_retry_backoff_factor: DF.Float
+		launcher_max_workers: DF.Int
+		max_launches_per_second: DF.Int
 		servers: DF.Table[DriftServer]
+		video_download_bandwidth_limit: DF.Int
+		video_downloads_per_server: DF.Int
+		video_storage_budget_gb: DF.Float
+		warm_session_idle_timeout: DF.Int
 	# end: auto-generated types
 
 
-def get_random_session_server() -> "DriftServer":
-	# Chose a random server from the list of active servers
-	# Try to find the server with lowest score = (active_sessions / memory_mb)
-
-	DRIFT_SERVER = frappe.qb.DocType("Drift Server")
-	query = (
-		frappe.qb.from_(DRIFT_SERVER)
-		.select(DRIFT_SERVER.name)
-		.select((DRIFT_SERVER.active_sessions / DRIFT_SERVER.memory_mb).as_("score"))
-		.where(DRIFT_SERVER.status != "Disabled")
-		.orderby("score")
-		.limit(1)
-	)
+def create_session() -> "DriftSession":
+	"""
+	Claim a warm session if one is available, else create a session on the least loaded Drift Server
+	"""
+	session = claim_warm_session()
+	if session:
+		record_stats("warm_pool", hits=1)
+		return session
 
-	results = query.run(as_dict=True)
-	if not results:
+	record_stats("warm_pool", misses=1)
+	servers: dict[str, DriftServer] = {
+		server.name: server
+		for server in frappe.get_cached_doc("Drift Settings").servers
+		if server.status == "Active"
+	}
+	if not servers:
 		frappe.throw(
 			"No active Drift Server found. Please check the configured Drift Servers.",
 			exc=DriftServerNotAvailableException,
 		)
 
-	return frappe.get_doc("Drift Server", results[0].name)
+	session = reserve_and_create_session(servers)
+	if not session:
+		frappe.throw(
+			"All the Drift Servers are running at their capacity. Please try again later.",
+			exc=DriftServerNotAvailableException,
+		)
+	return session
+
+
+def reserve_and_create_session(
+	servers: dict[str, "DriftServer"], pool_status: str | None = None
+) -> "DriftSession | None":
+	"""
+	Create a session on the least loaded of the given servers
+
+	A slot is reserved on the server before the session is created, so a burst of new sessions
+	is spread over the servers instead of being placed on the one which looked least loaded at
+	the last poll.
+
+	returns None if all the servers are at capacity
+	"""
+	reservation = session_reservations.reserve(
+		{name: server.max_sessions or 0 for name, server in servers.items()}
+	)
+	if not reservation:
+		record_stats("session_placement", rejections=1)
+		return None
+
+	server_name, token = reservation
+	try:
+		session = servers[server_name].create_session(pool_status=pool_status)
+	except Exception:
+		session_reservations.release(server_name, token)
+		raise
+
+	session_reservations.confirm(server_name, token, session.name)
+	record_stats("session_placement", reservations=1)
+	return session
+
+
+def claim_warm_session() -> "DriftSession | None":
+	DRIFT_SESSION = frappe.qb.DocType("Drift Session")
+	result = (
+		frappe.qb.from_(DRIFT_SESSION)
+		.select(DRIFT_SESSION.name)
+		.where(DRIFT_SESSION.pool_status == "Warm")
+		.where(DRIFT_SESSION.status == "Active")
+		.orderby(DRIFT_SESSION.started_on)
+		.limit(1)
+		.for_update(skip_locked=True)
+	).run()
+	if not result:
+		return None
 
+	frappe.db.set_value("Drift Session", result[0][0], "pool_status", "Claimed", update_modified=False)
+	# Replace the claimed session in the background
+	frappe.enqueue(
+		"drift.drift.doctype.drift_settings.drift_settings.fill_warm_pools",
+		deduplicate=True,
+		job_id="fill_warm_pools",
+		enqueue_after_commit=True,
+	)
+	return frappe.get_doc("Drift Session", result[0][0])
+
+
+def fill_warm_pools():
+	"""
+	Keep the configured number of warm sessions on every Drift Server
 
-def sync_servers():
-	servers = frappe.get_all("Drift Server", filters={"status": ("!=", "Disabled")}, pluck="name")
+	Warm sessions which are idle for too long are recycled, as the browsers shouldn't sit around
+	forever.
+	"""
+	recycle_idle_warm_sessions()
+
+	servers = [
+		server
+		for server in frappe.get_cached_doc("Drift Settings").servers
+		if server.status == "Active" and server.warm_pool_size
+	]
+	if not servers:
+		return
+
+	warm_sessions = dict(get_warm_session_counts([s.name for s in servers]))
 	for server in servers:
-		frappe.enqueue_doc(
-			"Drift Server",
-			server,
-			method="sync",
-			timeout=300,
-			deduplicate=True,
-			job_id=f"sync_server||{server}",
-			enqueue_after_commit=True,
-		)
+		for _ in range(server.warm_pool_size - warm_sessions.get(server.name, 0)):
+			try:
+				if not reserve_and_create_session({server.name: server}, pool_status="Warm"):
+					# Server is at capacity
+					break
+			except Exception:
+				frappe.db.rollback()
+				frappe.log_error(f"Failed to create warm session on server {server.host}")
+				break
 
 
-def sync_sessions():
-	servers = frappe.get_all("Drift Server", filters={"status": ("!=", "Disabled")}, pluck="name")
+def get_warm_session_counts(servers: list[str], run: bool = True) -> list[list] | str:
+	"""Warm sessions of every server, as (server, count) pairs"""
+	return frappe.get_all(
+		"Drift Session",
+		filters={"pool_status": "Warm", "status": "Active", "server": ("in", servers)},
+		fields=["server", "count(name) as count"],
+		group_by="server",
+		as_list=True,
+		run=run,
+	)
+
+
+def recycle_idle_warm_sessions():
+	idle_timeout = frappe.db.get_single_value("Drift Settings", "warm_session_idle_timeout") or 10
+	sessions = frappe.get_all(
+		"Drift Session",
+		filters={
+			"pool_status": "Warm",
+			"status": "Active",
+			"started_on": ("<", frappe.utils.add_to_date(minutes=-idle_timeout)),
+		},
+		pluck="name",
+	)
+	for name in sessions:
+		try:
+			session: DriftSession = frappe.get_doc("Drift Session", name, for_update=True)
+			if session.pool_status != "Warm":
+				continue
+			session.server_doc.destroy_session(session.session_id)
+			session.pool_status = "Recycled"
+			# Nothing was recorded, the remote videos are purged without being downloaded
+			session.video_download_status = "Downloaded"
+			session.status = "Stopped"
+			session.save(ignore_permissions=True)
+			frappe.db.commit()
+			record_stats("warm_pool", recycled=1)
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(f"Failed to recycle warm session {name}")
+
+
+@frappe.whitelist()
+def get_warm_pool_stats() -> dict:
+	frappe.only_for("System Manager")
+
+	stats = get_stats("warm_pool")
+	hits = stats.get("hits", 0)
+	misses = stats.get("misses", 0)
+	first_steps = stats.get("first_steps", 0)
+	return {
+		"hits": int(hits),
+		"misses": int(misses),
+		"recycled": int(stats.get("recycled", 0)),
+		"hit_rate": hits / (hits + misses) if hits + misses else 0,
+		"avg_time_to_first_step": stats.get("time_to_first_step", 0) / first_steps if first_steps else 0,
+	}
+
+
+def poll_fleet():
+	"""
+	Sync the status, active sessions count and running sessions of all the Drift Servers
+
+	All the servers are queried at once from a thread pool, so a tick takes about as long as the
+	slowest server, no matter how large the fleet is. The threads only make the HTTP requests,
+	everything touching the site is done here.
+	"""
+	started_at = time.monotonic()
+	servers: list[DriftServer] = [
+		server for server in frappe.get_cached_doc("Drift Settings").servers if server.status != "Disabled"
+	]
+	if not servers:
+		return
+
+	clients = {server.name: server.client for server in servers}
+	max_workers = min(len(servers), frappe.conf.drift_fleet_poller_max_workers or 32)
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		results = dict(zip(clients, executor.map(_poll_server, clients.values()), strict=True))
+
+	server_updates = {}
+	remote_session_ids = {}
 	for server in servers:
-		frappe.enqueue_doc(
-			"Drift Server",
-			server,
-			method="sync_sessions",
-			timeout=600,
-			deduplicate=True,
-			job_id=f"sync_sessions||{server}",
-			enqueue_after_commit=True,
-		)
+		health, sessions = results[server.name]
+		status = "Active" if health is not None else "Unreachable"
+		active_sessions = health.get("sessions", 0) if health is not None else server.active_sessions
+
+		if status != server.status or active_sessions != server.active_sessions:
+			server_updates[server.name] = {"status": status, "active_sessions": active_sessions}
+
+		if sessions is None:
+			frappe.log_error(f"Failed to sync sessions from server {server.host}")
+		else:
+			remote_session_ids[server.name] = [s.get("session_id") for s in sessions]
+
+	if server_updates:
+		frappe.db.bulk_update("Drift Server", server_updates, update_modified=False)
+		frappe.clear_document_cache("Drift Settings", "Drift Settings")
+
+	stop_missing_sessions(remote_session_ids)
+
+	active_sessions = {server.name: [] for server in servers}
+	for session in frappe.get_all(
+		"Drift Session",
+		filters={"server": ("in", list(active_sessions)), "status": "Active"},
+		fields=["name", "server"],
+	):
+		active_sessions[session.server].append(session.name)
+	session_reservations.sync(active_sessions)
+
+	record_stats(
+		"http_client",
+		requests=sum(result[2] for result in results.values()),
+		new_connections=sum(result[3] for result in results.values()),
+	)
+	record_stats("fleet_poller", ticks=1, servers=len(servers), tick_seconds=time.monotonic() - started_at)
+
+
+def _poll_server(client: "DriftServerClient") -> tuple[dict | None, list | None, int, int]:
+	"""
+	Runs in a thread of the fleet poller
+
+	returns the health and sessions of the server (None if the request failed),
+	along with the number of requests made and connections opened
+	"""
+	results = []
+	requests = 0
+	new_connections = 0
+	for path in ("health", "sessions"):
+		data = None
+		with contextlib.suppress(Exception):
+			requests += 1
+			res, connections = client.send("GET", path, json={}, timeout=FLEET_POLL_TIMEOUT)
+			new_connections += connections
+			success, response_data = parse_response(res)
+			if success:
+				data = response_data
+		results.append(data)
+
+	return results[0], results[1], requests, new_connections
@@ -10,5 +10,65 @@ frappe.ui.form.on("Drift Test", {
                 frm.add_custom_button(label, () => frm.call(action));
             }
         });
+
+        if (frm.doc.event_count) {
+            frm.add_custom_button(__("Events"), () => showTestEvents(frm.doc.name));
+        }
 	},
 });
+
+function showTestEvents(test) {
+    const dialog = new frappe.ui.Dialog({
+        title: __("Events of {0}", [test]),
+        size: "extra-large",
+        fields: [{ fieldname: "events", fieldtype: "HTML" }],
+        primary_action_label: __("Load More"),
+        primary_action: () => loadPage(),
+    });
+    const $table = $(`
+        <table class="table table-bordered table-sm">
+            <thead>
+                <tr>
+                    <th>#</th>
+                    <th>${__("Time")}</th>
+                    <th>${__("Event")}</th>
+                    <th>${__("Step")}</th>
+                    <th>${__("Attempt")}</th>
+                    <th>${__("Status")}</th>
+                    <th>${__("Duration")}</th>
+                    <th>${__("Error")}</th>
+                </tr>
+            </thead>
+            <tbody></tbody>
+        </table>
+    `);
+    dialog.fields_dict.events.$wrapper.html($table);
+
+    // Events are appended only, so paging from the last seen sequence also picks up new events
+    let after = 0;
+    function loadPage() {
+        frappe
+            .call("drift.drift.doctype.drift_test_event.drift_test_event.get_test_events", { test, after })
+            .then((r) => {
+                const { events, next } = r.message;
+                after = next;
+                events.forEach((e) => {
+                    $table.find("tbody").append(`
+                        <tr>
+                            <td>${e.sequence}</td>
+                            <td>${frappe.datetime.str_to_user(e.creation)}</td>
+                            <td>${e.event}</td>
+                            <td>${e.step_idx ? `${e.step_idx}. ${frappe.utils.escape_html(e.step_title || "")}` : ""}</td>
+                            <td>${e.attempt || ""}</td>
+                            <td>${e.status || ""}</td>
+                            <td>${e.duration ? `${flt(e.duration, 2)}s` : ""}</td>
+                            <td>${frappe.utils.escape_html(e.error || "")}</td>
+                        </tr>
+                    `);
+                });
+            });
+    }
+
+    dialog.show();
+    loadPage();
+}
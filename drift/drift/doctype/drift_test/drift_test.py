@@ -2,22 +2,42 @@
 # For license information, please see license.txt
 
 import contextlib
-import json
+import time
+from collections.abc import Callable
 from typing import TYPE_CHECKING, Optional
 
 import frappe
 from frappe.model.document import Document
+from frappe.query_builder.functions import IfNull
 from frappe.utils.safe_exec import safe_exec
 
-from drift.drift.utils import prepare_safe_exec_locals
+from drift.drift.doctype.drift_test_event.drift_test_event import get_last_sequence, insert_events
+from drift.drift.doctype.drift_test_run.drift_test_run import update_shard
+from drift.drift.doctype.drift_test_step_definition.drift_test_step_definition import (
+	NATIVE_STEP_TYPES,
+	DriftStepTimeoutError,
+)
+from drift.drift.parallel_steps import Branch, get_branches, get_group_steps, run_branches_in_thread
+from drift.drift.utils import prepare_safe_exec_locals, record_stats, safe_exec_cached
+from drift.drift.variable_store import VariableStore
 
 if TYPE_CHECKING:
+	from playwright.sync_api import Browser
+
 	from drift.drift.doctype.drift_session.drift_session import DriftSession
 	from drift.drift.doctype.drift_test_step.drift_test_step import DriftTestStep
 	from drift.drift.doctype.drift_test_step_definition.drift_test_step_definition import (
 		DriftTestStepDefinition,
 	)
 
+# A batch can run past its time budget by the duration of its last step
+BATCH_JOB_TIMEOUT = 900
+
+FINISHED_STATUSES = ("Success", "Failure", "Stopped", "Cancelled")
+
+# Fields of the test which are changed by running steps, see `DriftTest.persist`
+STEP_RESULT_FIELDS = ("status", "variables", "session_user", "session_user_sid", "step_cursor")
+
 
 class DriftTest(Document):
 	# begin: auto-generated types
@@ -34,37 +54,72 @@ class DriftTest(Document):
 		cleanup_completed: DF.Check
 		definition: DF.Link
 		documents: DF.Table[DriftTestDocument]
+		event_count: DF.Int
+		execution_mode: DF.Data | None
 		gc_completed: DF.Check
+		recorded_video_ids: DF.SmallText | None
 		session: DF.Link | None
 		session_user: DF.Data | None
 		session_user_sid: DF.Data | None
 		status: DF.Literal["Pending", "Running", "Success", "Failure", "Cancelled", "Stopped"]
+		step_cursor: DF.Int
 		steps: DF.Table[DriftTestStep]
+		test_run: DF.Link | None
 		variables: DF.SmallText
 	# end: auto-generated types
 
 	@property
-	def variables_dict(self):
-		if not self.variables:
-			return frappe._dict()
-		try:
-			return frappe._dict(frappe.json.loads(self.variables))
-		except json.JSONDecodeError:
-			return frappe._dict()
+	def variables_dict(self) -> VariableStore:
+		# Parsed once, and again only if `variables` is set to something else
+		if not hasattr(self, "_variable_store") or self._variables_source != self.variables:
+			self._variable_store = VariableStore.loads(self.variables)
+			self._variables_source = self.variables
+		return self._variable_store
+
+	def _store_variables(self, variables: dict):
+		store = self.variables_dict
+		if variables is not store:
+			# Replaced by the step, everything has changed
+			store = VariableStore(variables)
+
+		if store.is_dirty:
+			self.variables = store.dumps(self.name)
+			self._variable_store = store
+			self._variables_source = self.variables
+
+	@property
+	def cursor_step(self) -> Optional["DriftTestStep"]:
+		"""Step which runs next, all the steps before it have succeeded"""
+		if not self.step_cursor:
+			# Tests which were started before the cursor was kept
+			self.step_cursor = next(
+				(step.idx for step in self.steps if step.status != "Success"), len(self.steps) + 1
+			)
+		if self.step_cursor > len(self.steps):
+			return None
+		return self.steps[self.step_cursor - 1]
 
 	@property
 	def current_running_step(self) -> Optional["DriftTestStep"]:
-		for step in self.steps:
-			if step.status == "Running":
-				return step
-		return None
+		step = self.cursor_step
+		return step if step and step.status == "Running" else None
 
 	@property
 	def next_step(self) -> Optional["DriftTestStep"]:
-		for step in self.steps:
-			if step.status == "Pending":
-				return step
-		return None
+		step = self.cursor_step
+		return step if step and step.status == "Pending" else None
+
+	@property
+	def is_batched(self) -> bool:
+		return self.execution_mode == "Batched"
+
+	@property
+	def is_async(self) -> bool:
+		return self.execution_mode == "Async Executor"
+
+	@property
+	def batch_time_budget(self) -> int:
+		return frappe.db.get_value("Drift Test Definition", self.definition, "batch_time_budget_sec") or 60
 
 	@property
 	def session_doc(self) -> Optional["DriftSession"]:
@@ -73,84 +128,337 @@ class DriftTest(Document):
 		return None
 
 	def on_update(self):
-		if self.has_value_changed("status") and self.status in ["Success", "Failure", "Stopped", "Cancelled"]:
-			session = self.session_doc
-			if session and session.status == "Active":
+		if self.has_value_changed("status") and self.status in FINISHED_STATUSES:
+			self._log_event("Test Finished", status=self.status)
+			current_count = frappe.db.get_value(self.doctype, self.name, "event_count", for_update=True)
+			self.db_set("event_count", self._flush_events(current_count), update_modified=False)
+			self._on_finish()
+
+	def _on_finish(self):
+		self._release_session()
+		if self.test_run:
+			update_shard(self)
+
+	def _release_session(self):
+		session = self.session_doc
+		if session and session.status == "Active":
+			if session.can_be_reused(self.definition):
+				session.release_for_reuse(self.name, self.definition)
+			elif self.flags.destroy_session_in_background:
+				# Keeps the request to the agent off the async executor, see `drift.drift.executor`
+				frappe.enqueue_doc(
+					"Drift Session",
+					session.name,
+					"destroy_remote_session",
+					deduplicate=True,
+					job_id=f"destroy_drift_session||{session.name}",
+					enqueue_after_commit=True,
+				)
+			else:
 				session.destroy_remote_session()
 
-	def execute_step(self, step_name: str):
-		step = self._get_step(step_name)
-		step_definition: DriftTestStepDefinition = frappe.get_doc("Drift Test Step Definition", step.step)
+	def persist(self, *steps: "DriftTestStep") -> bool:
+		"""
+		Write the given steps and the changed step result fields of the test
 
-		with self.session_doc.pw_browser() as browser:
-			safe_exec_locals = prepare_safe_exec_locals(self.variables_dict)
-			try:
-				if not step.started_at:
-					step.started_at = frappe.utils.now_datetime()
+		Used instead of `save` while the test runs, so every step writes its own row and a few fields
+		of the test instead of all the rows of the test. The test row is locked first, a stop or
+		cancel which happened meanwhile is kept and returns False.
+		"""
+		current = frappe.db.get_value(
+			self.doctype, self.name, (*STEP_RESULT_FIELDS, "event_count"), as_dict=True, for_update=True
+		)
+		interrupted = current.status in ("Stopped", "Cancelled") and current.status != self.status
+		if interrupted:
+			self.status = current.status
+
+		for step in steps:
+			step.db_update()
+
+		changes = {
+			field: self.get(field)
+			for field in STEP_RESULT_FIELDS
+			if (self.get(field) or None) != (current.get(field) or None)
+		}
+		if changes.get("status") in FINISHED_STATUSES:
+			self._log_event("Test Finished", status=self.status)
+		event_count = self._flush_events(current.event_count)
+		if event_count != (current.event_count or 0):
+			changes["event_count"] = event_count
+
+		if changes:
+			self.modified = frappe.utils.now()
+			frappe.db.set_value(
+				self.doctype, self.name, {**changes, "modified": self.modified}, update_modified=False
+			)
+			# Written without `save`, so the open forms and list views are told here
+			self.notify_update()
+			if changes.get("status") in FINISHED_STATUSES:
+				self._on_finish()
+
+		return not interrupted
+
+	def _log_event(self, event: str, step: Optional["DriftTestStep"] = None, **details):
+		"""Queue an event for the event log, those are written by the next `persist`"""
+		if step:
+			details.update(step=step.name, step_idx=step.idx, step_title=step.step_title)
+		self.__dict__.setdefault("_events", []).append(
+			{"event": event, "creation": frappe.utils.now(), **details}
+		)
 
-				step.last_attempted_at = frappe.utils.now_datetime()
+	def _flush_events(self, event_count: int | None) -> int:
+		"""
+		Append the queued events after the last logged one, returns the new count
+
+		Called with the test row locked, so writers take their sequences one after another.
+		"""
+		events = self.__dict__.pop("_events", [])
+		if not events:
+			self.event_count = event_count or 0
+			return self.event_count
+
+		last_sequence = get_last_sequence(self.name)
+		for sequence, event in enumerate(events, start=last_sequence + 1):
+			event.update(test=self.name, sequence=sequence)
+		insert_events(events, owner=self.owner)
+		self.event_count = last_sequence + len(events)
+		return self.event_count
+
+	def _log_attempt(self, step: "DriftTestStep", attempt: int, duration: float):
+		failed = step.status == "Failure"
+		self._log_event(
+			"Attempt",
+			step,
+			status=step.status,
+			attempt=attempt,
+			duration=duration,
+			error=step.error if failed else None,
+			traceback=step.traceback if failed else None,
+		)
+		if step.status == "Success":
+			# Steps run one after another, so the cursor only moves forward
+			self.step_cursor = step.idx + 1
+			self._log_event("Step Succeeded", step, status=step.status, duration=step.duration)
+		elif failed:
+			self._log_event("Step Failed", step, status=step.status, duration=step.duration, error=step.error)
+
+	def execute_step(self, step_name: str):
+		step = self._get_step(step_name)
+		batch_deadline = None
+		if self.is_batched:
+			batch_deadline = time.monotonic() + self.batch_time_budget
+
+		attempted_steps = []
+		with contextlib.ExitStack() as stack:
+			browser = None
+
+			def get_browser() -> "Browser":
+				# Connect only when a step needs the browser, deferred steps don't
+				nonlocal browser
+				if not browser:
+					browser = stack.enter_context(self.session_doc.pw_browser())
+				return browser
+
+			while True:
+				if step.parallel_group:
+					group_steps, step = self._run_parallel_group(step)
+					attempted_steps.extend(group_steps)
+				else:
+					self._run_step(step, get_browser)
+					attempted_steps.append(step)
+				if step.status != "Success" or batch_deadline is None:
+					break
+
+				# Continue with the next step in this job while the batch has time left
+				step = self.next_step
+				if (
+					not step
+					or time.monotonic() >= batch_deadline
+					or frappe.db.get_value(self.doctype, self.name, "status") != "Running"
+				):
+					break
+
+		failed = step and step.status == "Failure"
+		if failed:
+			self.finish(save=False)
+
+		# Move to the next step, unless the test is finished or was stopped meanwhile
+		if self.persist(*attempted_steps) and not failed:
+			self.next()
 
-				# Prepare Playwright context and page
-				pw_context = browser.contexts[0] if browser.contexts else browser.new_context()
-				pw_page = pw_context.pages[0] if pw_context.pages else pw_context.new_page()
-				safe_exec_locals.update({"pw_ctx": pw_context, "pw_page": pw_page, "doc": self})
+	def _run_step(self, step: "DriftTestStep", get_browser: Callable[[], "Browser"]):
+		step_definition: DriftTestStepDefinition = frappe.get_doc("Drift Test Step Definition", step.step)
+		if step_definition.type == "Wait":
+			self._run_wait_step(step, step_definition)
+			return
 
+		browser = get_browser()
+		safe_exec_locals = self._begin_attempt(step)
+		try:
+			# Prepare Playwright context and page
+			pw_context = browser.contexts[0] if browser.contexts else browser.new_context()
+			pw_page = pw_context.pages[0] if pw_context.pages else pw_context.new_page()
+			safe_exec_locals.update({"pw_ctx": pw_context, "pw_page": pw_page, "doc": self})
+
+			if step_definition.is_native:
+				# Built-in step types are mapped directly to Playwright calls
+				safe_exec_locals["result"] = step_definition.execute_native(
+					pw_page, safe_exec_locals, elapsed_seconds=self._get_elapsed_seconds(step)
+				)
+			else:
 				# Generate the code
 				code = step_definition.get_code(safe_exec_locals).strip()
 				if frappe.conf.developer_mode:
 					print(f"Executing step {step.name} of test {self.name}:\n{code}\n---")
 
-				# Execute the code
-				safe_exec(code, _locals=safe_exec_locals)
+				# Execute the code, compiled code is reused while the definition is unchanged
+				safe_exec_cached(code, safe_exec_locals, step_definition.cache_key)
+
+			self._complete_attempt(step, step_definition, safe_exec_locals)
+		except Exception as e:
+			self._fail_attempt(step, e)
+		finally:
+			self._end_attempt(step)
+
+	def _run_parallel_group(self, first: "DriftTestStep") -> tuple[list["DriftTestStep"], "DriftTestStep"]:
+		# The branches connect on their own, the sync connection of the worker can't be shared
+		session = self.session_doc
+		steps, branches = self._prepare_parallel_group(first)
+		started_at = (frappe.utils.now_datetime(), time.monotonic())
+		results = run_branches_in_thread(
+			session.cdp_endpoint,
+			{"Authorization": f"Bearer {session.get_password('session_token')}"},
+			branches,
+		)
+		return steps, self._complete_parallel_group(steps, results, started_at)
+
+	def _prepare_parallel_group(self, first: "DriftTestStep") -> tuple[list["DriftTestStep"], list[Branch]]:
+		steps = get_group_steps(self.steps, first)
+		local_context = prepare_safe_exec_locals(self.variables_dict)
+		local_context["doc"] = self
+		branches = []
+		for branch_steps in get_branches(steps).values():
+			branch = []
+			for step in branch_steps:
+				step_definition: DriftTestStepDefinition = frappe.get_doc(
+					"Drift Test Step Definition", step.step
+				)
+				branch.append(
+					(
+						step.name,
+						step_definition.get_playwright_call(local_context),
+						step_definition.handle_playwright_timeout,
+					)
+				)
+			branches.append(branch)
+		return steps, branches
+
+	def _complete_parallel_group(
+		self, steps: list["DriftTestStep"], results: dict[str, dict], started_at: tuple
+	) -> "DriftTestStep":
+		"""Record the results of the branches on the steps, returns the first failed or the last step"""
+		started_on, started_monotonic = started_at
+
+		def to_datetime(seconds: float):
+			return frappe.utils.add_to_date(started_on, seconds=seconds - started_monotonic)
+
+		for branch_steps in get_branches(steps).values():
+			if branch_steps[0].name not in results:
+				results[branch_steps[0].name] = {
+					"started_at": started_monotonic,
+					"ended_at": started_monotonic,
+					"status": "Failure",
+					"error": "Failed to open a page for the branch",
+				}
+
+		for step in steps:
+			result = results.get(step.name)
+			if not result:
+				# An earlier step of the branch failed
+				continue
+			step.started_at = step.last_attempted_at = to_datetime(result["started_at"])
+			step.ended_at = to_datetime(result["ended_at"])
+			step.duration = int(result["ended_at"] - result["started_at"])
+			step.no_of_attempts = (step.no_of_attempts or 0) + 1
+			step.status = result["status"]
+			step.error = result.get("error")
+			step.traceback = result.get("traceback")
+			self._log_event("Step Started", step)
+			self._log_attempt(step, step.no_of_attempts, round(result["ended_at"] - result["started_at"], 3))
+
+		# The steps after the group run only once all the branches have succeeded
+		failed_step = next((step for step in steps if step.status == "Failure"), None)
+		self.step_cursor = failed_step.idx if failed_step else steps[-1].idx + 1
+		return failed_step or steps[-1]
+
+	def _begin_attempt(self, step: "DriftTestStep") -> dict:
+		self._attempt = ((step.no_of_attempts or 0) + 1, time.monotonic())
+		if not step.started_at:
+			step.started_at = frappe.utils.now_datetime()
+			self._log_event("Step Started", step)
+			if step.idx == 1:
+				record_stats(
+					"warm_pool",
+					first_steps=1,
+					time_to_first_step=frappe.utils.time_diff_in_seconds(step.started_at, self.creation),
+				)
+		step.last_attempted_at = frappe.utils.now_datetime()
+		return prepare_safe_exec_locals(self.variables_dict)
 
-				# Extract variables and store those
-				self.variables = json.dumps(safe_exec_locals.get("variables", {}), indent=2)
-				step.no_of_attempts = (step.no_of_attempts or 0) + 1
+	def _get_elapsed_seconds(self, step: "DriftTestStep") -> int:
+		return int(frappe.utils.time_diff_in_seconds(step.last_attempted_at, step.started_at))
 
-				if not step_definition.wait_for_completion:
-					step.status = "Success"
-				else:
-					result = safe_exec_locals.get("result", (True, False))
-					if (isinstance(result, tuple) or isinstance(result, list)) and len(result) == 2:
-						if result[0]:
-							step.status = "Success"
-						elif result[1]:
-							step.status = "Failure"
-							step.error = "Step failed as per the 'result' variable"
-						else:
-							# Check for timeout
-							duration = int(
-								frappe.utils.time_diff_in_seconds(
-									frappe.utils.now_datetime(), step.started_at
-								)
-							)
-							if duration > step_definition.timeout_seconds:
-								step.status = "Failure"
-								step.error = "Step timed out after {} seconds".format(
-									step_definition.timeout_seconds
-								)
-							else:
-								step.status = "Running"
-			except Exception as e:
-				import traceback
+	def _complete_attempt(
+		self, step: "DriftTestStep", step_definition: "DriftTestStepDefinition", safe_exec_locals: dict
+	):
+		# Extract variables and store those, only if the step changed those
+		self._store_variables(safe_exec_locals.get("variables", {}))
+		step.no_of_attempts = (step.no_of_attempts or 0) + 1
 
+		if not step_definition.wait_for_completion:
+			step.status = "Success"
+			return
+
+		result = safe_exec_locals.get("result", (True, False))
+		if (isinstance(result, tuple) or isinstance(result, list)) and len(result) == 2:
+			if result[0]:
+				step.status = "Success"
+			elif result[1]:
 				step.status = "Failure"
-				step.error = str(e).splitlines()[0][:120]
-				step.traceback = traceback.format_exc()
+				step.error = "Step failed as per the 'result' variable"
+			else:
+				# Check for timeout
+				duration = int(
+					frappe.utils.time_diff_in_seconds(frappe.utils.now_datetime(), step.started_at)
+				)
+				if duration > step_definition.timeout_seconds:
+					step.status = "Failure"
+					step.error = "Step timed out after {} seconds".format(step_definition.timeout_seconds)
+				else:
+					step.status = "Running"
 
-			finally:
-				if step.status in ("Success", "Failure"):
-					if not step.started_at:
-						step.started_at = frappe.utils.now_datetime()
-					if not step.last_attempted_at:
-						step.last_attempted_at = frappe.utils.now_datetime()
+	def _fail_attempt(self, step: "DriftTestStep", e: Exception):
+		step.status = "Failure"
+		if isinstance(e, DriftStepTimeoutError):
+			step.error = str(e)
+			return
 
-					step.ended_at = frappe.utils.now_datetime()
-					step.duration = int(frappe.utils.time_diff_in_seconds(step.ended_at, step.started_at))
+		import traceback
 
-		if step.status == "Failure":
-			self.finish(save=True)
-		else:
+		step.error = str(e).splitlines()[0][:120]
+		step.traceback = traceback.format_exc()
+
+	def _end_attempt(self, step: "DriftTestStep"):
+		if step.status in ("Success", "Failure"):
+			if not step.started_at:
+				step.started_at = frappe.utils.now_datetime()
+			if not step.last_attempted_at:
+				step.last_attempted_at = frappe.utils.now_datetime()
+
+			step.ended_at = frappe.utils.now_datetime()
+			step.duration = int(frappe.utils.time_diff_in_seconds(step.ended_at, step.started_at))
+
+		if step.status != "Failure":
 			# Check if session user or sid has been updated in variables
 			variables = self.variables_dict
 			if (
@@ -162,24 +470,53 @@ class DriftTest(Document):
 				self.session_user = variables.get("session_user")
 				self.session_user_sid = variables.get("session_user_sid")
 
-			# Save the test and move to next step
-			self.save(ignore_version=True)
-			self.next()
+		attempt, started_at = self._attempt
+		self._log_attempt(step, attempt, round(time.monotonic() - started_at, 3))
+
+	def _run_wait_step(self, step: "DriftTestStep", step_definition: "DriftTestStepDefinition"):
+		# Wait steps don't hold the worker, the first attempt records when the step is due
+		# and `resume_deferred_steps` queues the step again once that time is reached
+		now = frappe.utils.now_datetime()
+		if not step.started_at:
+			step.started_at = now
+			self._log_event("Step Started", step)
+		step.last_attempted_at = now
+		step.no_of_attempts = (step.no_of_attempts or 0) + 1
+
+		if not step.resume_at:
+			step.resume_at = frappe.utils.add_to_date(now, seconds=step_definition.wait_duration_sec or 0)
+
+		if frappe.utils.get_datetime(step.resume_at) > now:
+			step.status = "Running"
+		else:
+			step.status = "Success"
+			step.ended_at = now
+			step.duration = int(frappe.utils.time_diff_in_seconds(step.ended_at, step.started_at))
+
+		self._log_attempt(step, step.no_of_attempts, 0)
 
 	@frappe.whitelist()
 	def next(self):
-		if self.status != "Running" and self.status not in ("Success", "Failure", "Stopped", "Cancelled"):
+		if self.status != "Running" and self.status not in FINISHED_STATUSES:
 			self.status = "Running"
-			self.save(ignore_version=True)
+			if not self.persist():
+				return
 
 		if frappe.db.get_value("Drift Session", self.session, "status") != "Active":
 			self.status = "Stopped"
-			self.save(ignore_version=True)
+			if not self.persist():
+				return
 
 		next_step_to_run = None
 
 		current_running_step = self.current_running_step
 		if current_running_step:
+			if (
+				current_running_step.resume_at
+				and frappe.utils.get_datetime(current_running_step.resume_at) > frappe.utils.now_datetime()
+			):
+				# Deferred step, `resume_deferred_steps` will queue it once it is due
+				return
 			next_step_to_run = current_running_step
 		elif self.next_step:
 			next_step_to_run = self.next_step
@@ -189,35 +526,44 @@ class DriftTest(Document):
 			self.finish()
 			return
 
-		frappe.enqueue_doc(
-			self.doctype,
+		if (
+			self.is_async
+			and frappe.db.get_value("Drift Test Step Definition", next_step_to_run.step, "type")
+			in NATIVE_STEP_TYPES
+		):
+			# Picked up by the async executor, see `drift.drift.executor`
+			return
+
+		enqueue_step(
 			self.name,
-			"execute_step",
-			step_name=next_step_to_run.name,
-			enqueue_after_commit=True,
+			next_step_to_run.name,
+			batched=self.is_batched,
 			deduplicate=frappe.db.get_value(
 				"Drift Test Step Definition", next_step_to_run.step, "wait_for_completion"
 			)
 			is False,  # Don't deduplicate if wait_for_completion is True
-			job_id=f"drift_test||{self.name}||{next_step_to_run.name}",
 		)
 
 	def _get_step(self, step_name: str) -> "DriftTestStep":
+		step = self.cursor_step
+		if step and step.name == step_name:
+			return step
 		for step in self.steps:
 			if step.name == step_name:
 				return step
 		frappe.throw(f"Step {step_name} not found in test {self.name}")
 
 	def finish(self, save: bool = True):
-		if self.status in ("Success", "Failure", "Stopped", "Cancelled"):
+		if self.status in FINISHED_STATUSES:
 			return
-		if any(step.status == "Failure" for step in self.steps):
+		step = self.cursor_step
+		if step and step.status == "Failure":
 			self.status = "Failure"
 		else:
 			self.status = "Success"
 
 		if save:
-			self.save(ignore_version=True)
+			self.persist()
 
 	@frappe.whitelist()
 	def garbage_collect(self):
@@ -328,25 +674,81 @@ class DriftTest(Document):
 			)
 
 
-def bulk_garbage_collect_tests():
-	tests = frappe.get_all(
+def enqueue_step(test: str, step: str, batched: bool = False, deduplicate: bool = False):
+	frappe.enqueue_doc(
 		"Drift Test",
-		filters={"gc_completed": 0, "status": ["in", ["Success", "Failure", "Stopped", "Cancelled"]]},
-		pluck="name",
+		test,
+		"execute_step",
+		step_name=step,
+		enqueue_after_commit=True,
+		deduplicate=deduplicate,
+		job_id=f"drift_test||{test}||{step}",
+		timeout=BATCH_JOB_TIMEOUT if batched else None,
+	)
+
+
+def resume_deferred_steps():
+	for step in get_deferred_steps():
+		# The step stays Running till its job completes, so deduplicate to not queue it twice
+		enqueue_step(step.parent, step.name, batched=step.execution_mode == "Batched", deduplicate=True)
+
+
+def get_deferred_steps(run: bool = True) -> list[dict] | str:
+	"""Deferred steps which are due, `run=False` returns the query instead"""
+	DRIFT_TEST = frappe.qb.DocType("Drift Test")
+	DRIFT_TEST_STEP = frappe.qb.DocType("Drift Test Step")
+	query = (
+		frappe.qb.from_(DRIFT_TEST_STEP)
+		.join(DRIFT_TEST)
+		.on(DRIFT_TEST.name == DRIFT_TEST_STEP.parent)
+		.select(DRIFT_TEST_STEP.parent, DRIFT_TEST_STEP.name, DRIFT_TEST.execution_mode)
+		.where(DRIFT_TEST_STEP.parenttype == "Drift Test")
+		.where(DRIFT_TEST_STEP.status == "Running")
+		.where(DRIFT_TEST_STEP.resume_at <= frappe.utils.now_datetime())
+		.where(DRIFT_TEST.status == "Running")
+		# The async executor resumes its own deferred steps
+		.where(IfNull(DRIFT_TEST.execution_mode, "") != "Async Executor")
 	)
-	for test in tests:
+	return query.run(as_dict=True) if run else str(query)
+
+
+def bulk_garbage_collect_tests():
+	for test in get_tests_to_garbage_collect():
 		with contextlib.suppress(frappe.DoesNotExistError):
 			frappe.get_doc("Drift Test", test)._garbage_collect()
 			frappe.db.commit()
 
 
-def bulk_cleanup_tests():
-	tests = frappe.get_all(
+def get_tests_to_garbage_collect(run: bool = True) -> list[str] | str:
+	return frappe.get_all(
 		"Drift Test",
-		filters={"cleanup_completed": 0, "gc_completed": 1},
+		filters={"gc_completed": 0, "status": ["in", FINISHED_STATUSES]},
 		pluck="name",
+		run=run,
 	)
-	for test in tests:
+
+
+def bulk_cleanup_tests():
+	for test in get_tests_to_cleanup():
 		with contextlib.suppress(frappe.DoesNotExistError):
 			frappe.get_doc("Drift Test", test)._cleanup()
 			frappe.db.commit()
+
+
+def get_tests_to_cleanup(run: bool = True) -> list[str] | str:
+	return frappe.get_all(
+		"Drift Test",
+		filters={"cleanup_completed": 0, "gc_completed": 1},
+		pluck="name",
+		run=run,
+	)
+
+
+def on_doctype_update():
+	# Garbage collection and cleanup jobs only look at the few tests which are still pending
+	frappe.db.add_index("Drift Test", ["gc_completed", "status"])
+	frappe.db.add_index("Drift Test", ["cleanup_completed", "gc_completed"])
+	# Running tests of an execution mode, oldest first
+	frappe.db.add_index("Drift Test", ["status", "execution_mode", "creation"])
+	# Latest tests of a definition by status, for the video retention rules
+	frappe.db.add_index("Drift Test", ["definition", "status", "creation"])
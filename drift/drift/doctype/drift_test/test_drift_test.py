@@ -1,9 +1,12 @@
 # Copyright (c) 2025, Tanmoy and Contributors
 # See license.txt
 
-# import frappe
+from unittest.mock import patch
+
+import frappe
 from frappe.tests import IntegrationTestCase
 
+from drift.drift.doctype.drift_test.drift_test import DriftTest
 
 # On IntegrationTestCase, the doctype test records and all
 # link-field test record dependencies are recursively loaded
@@ -12,11 +15,75 @@ EXTRA_TEST_RECORD_DEPENDENCIES = []  # eg. ["User"]
 IGNORE_TEST_RECORD_DEPENDENCIES = []  # eg. ["User"]
 
 
-
 class IntegrationTestDriftTest(IntegrationTestCase):
 	"""
 	Integration tests for DriftTest.
 	Use this class for testing interactions between multiple components.
 	"""
 
-	pass
+	def insert_test(self, statuses: list[str], step_cursor: int = 1) -> DriftTest:
+		test = frappe.get_doc(
+			{
+				"doctype": "Drift Test",
+				"definition": "_Test Drift Test Definition",
+				"status": "Running",
+				"variables": "{}",
+				"step_cursor": step_cursor,
+				"steps": [
+					{"step": f"step-{idx}", "status": status} for idx, status in enumerate(statuses, 1)
+				],
+			}
+		)
+		test.db_insert()
+		for step in test.steps:
+			step.db_insert()
+		return frappe.get_doc("Drift Test", test.name)
+
+	def test_cursor_step(self):
+		test = self.insert_test(["Success", "Running", "Pending"], step_cursor=2)
+		self.assertEqual(test.cursor_step.idx, 2)
+		self.assertEqual(test.current_running_step.idx, 2)
+		self.assertIsNone(test.next_step)
+
+		test.step_cursor = 4
+		self.assertIsNone(test.cursor_step)
+
+	def test_cursor_of_tests_started_without_it(self):
+		test = self.insert_test(["Success", "Success", "Pending"], step_cursor=0)
+		self.assertEqual(test.next_step.idx, 3)
+		self.assertEqual(test.step_cursor, 3)
+
+	def test_persist_writes_only_the_given_steps(self):
+		test = self.insert_test(["Running", "Pending"])
+		modified = test.modified
+		first, second = test.steps
+		first.status = "Success"
+		second.status = "Running"
+		test.step_cursor = 2
+
+		with patch.object(test, "notify_update") as notify_update:
+			self.assertTrue(test.persist(first))
+		notify_update.assert_called_once()
+
+		self.assertEqual(frappe.db.get_value("Drift Test Step", first.name, "status"), "Success")
+		self.assertEqual(frappe.db.get_value("Drift Test Step", second.name, "status"), "Pending")
+		step_cursor, saved_modified = frappe.db.get_value(
+			"Drift Test", test.name, ["step_cursor", "modified"]
+		)
+		self.assertEqual(step_cursor, 2)
+		self.assertGreater(saved_modified, modified)
+
+	def test_persist_without_changes_doesnt_notify(self):
+		test = self.insert_test(["Running"])
+		with patch.object(test, "notify_update") as notify_update:
+			self.assertTrue(test.persist(test.steps[0]))
+		notify_update.assert_not_called()
+
+	def test_persist_keeps_a_stop_made_meanwhile(self):
+		test = self.insert_test(["Running", "Pending"])
+		frappe.db.set_value("Drift Test", test.name, "status", "Stopped")
+
+		test.step_cursor = 2
+		self.assertFalse(test.persist(test.steps[0]))
+		self.assertEqual(test.status, "Stopped")
+		self.assertEqual(frappe.db.get_value("Drift Test", test.name, "status"), "Stopped")
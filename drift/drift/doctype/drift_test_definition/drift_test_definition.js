@@ -8,5 +8,9 @@ frappe.ui.form.on("Drift Test Definition", {
         ].forEach(([label, method]) => {
             frm.add_custom_button(label, () => frm.call(method));
         });
+
+        if (frm.doc.parameter_source) {
+            frm.add_custom_button("Run Matrix", () => frm.call("create_test_run"));
+        }
 	},
 });
@@ -1,15 +1,32 @@
 # Copyright (c) 2025, Tanmoy and contributors
 # For license information, please see license.txt
 
+import json
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from typing import TYPE_CHECKING
 
 import frappe
+import requests
 from frappe.model.document import Document
+from frappe.utils.safe_exec import safe_exec
 
-from drift.drift.doctype.drift_settings.drift_settings import get_random_session_server
+from drift.drift import schedule_planner, session_reservations
+from drift.drift.doctype.drift_server.drift_server import parse_response
+from drift.drift.doctype.drift_settings.drift_settings import claim_warm_session, create_session
+from drift.drift.parallel_steps import PARALLEL_STEP_TYPES
+from drift.drift.utils import RateLimiter, get_stats, prepare_safe_exec_locals, record_stats
 
 if TYPE_CHECKING:
+	from drift.drift.doctype.drift_server.drift_server import DriftServer, DriftServerClient
+	from drift.drift.doctype.drift_session.drift_session import DriftSession
 	from drift.drift.doctype.drift_test.drift_test import DriftTest
+	from drift.drift.doctype.drift_test_run.drift_test_run import DriftTestRun
+
+# Upper bound of the parameter sets of a single test run
+MAX_PARAMETER_SETS = 1000
 
 
 class DriftTestDefinition(Document):
@@ -25,10 +42,26 @@ class DriftTestDefinition(Document):
 			DriftTestStepDefinition,
 		)
 
+		batch_time_budget_sec: DF.Int
+		delete_videos_after_days: DF.Int
 		enabled: DF.Check
+		execution_mode: DF.Literal["Step Per Job", "Batched", "Async Executor"]
 		interval_minutes: DF.Int
+		keep_last_failed_videos: DF.Int
+		keep_last_successful_videos: DF.Int
 		last_executed_on: DF.Datetime | None
+		max_parallel_runs: DF.Int
+		max_session_age_minutes: DF.Int
+		max_session_reuses: DF.Int
 		next_execution_on: DF.Datetime | None
+		parameter_doctype: DF.Link | None
+		parameter_fields: DF.Data | None
+		parameter_filters: DF.Code | None
+		parameter_script: DF.Code | None
+		parameter_sets: DF.Code | None
+		parameter_source: DF.Literal["", "List", "Query", "Server Script"]
+		reuse_sessions: DF.Check
+		schedule_offset_minutes: DF.Int
 		steps: DF.Table[DriftTestStepDefinition]
 		test_setup: DF.Link
 		user_key: DF.Data
@@ -38,24 +71,111 @@ class DriftTestDefinition(Document):
 		if self.interval_minutes is not None and self.interval_minutes < 2:
 			frappe.throw("Interval Minutes cannot be less than 2 minutes")
 
-		if self.interval_minutes and not self.next_execution_on:
-			self.next_execution_on = frappe.utils.add_to_date(None, minutes=self.interval_minutes)
+		if self.interval_minutes and self.enabled and self.is_rescheduled():
+			self.schedule_offset_minutes = schedule_planner.assign_offset(self.name, self.interval_minutes)
+			self.next_execution_on = self.get_next_execution_on(frappe.utils.now_datetime())
 
 		if not self.steps:
 			frappe.throw("Please add at least one step")
 
+		if self.execution_mode == "Batched" and not (10 <= (self.batch_time_budget_sec or 0) <= 600):
+			frappe.throw("Batch Time Budget should be between 10 and 600 seconds")
+
+		self.validate_parallel_groups()
+
+		if self.parameter_source:
+			if (self.max_parallel_runs or 0) < 1:
+				frappe.throw("Max Parallel Runs should be at least 1")
+			if self.parameter_source == "List" and not isinstance(
+				frappe.parse_json(self.parameter_sets), list
+			):
+				frappe.throw("Parameter Sets should be a list")
+
+	def validate_parallel_groups(self):
+		finished_groups = set()
+		previous_group = None
+		for step in self.steps:
+			if step.parallel_group and step.type not in PARALLEL_STEP_TYPES:
+				frappe.throw(
+					f"Row #{step.idx}: Only {', '.join(PARALLEL_STEP_TYPES)} steps can be in a parallel group"
+				)
+			if step.parallel_group in finished_groups:
+				frappe.throw(
+					f"Row #{step.idx}: Steps of parallel group {step.parallel_group} should be together"
+				)
+			if previous_group and previous_group != step.parallel_group:
+				finished_groups.add(previous_group)
+			previous_group = step.parallel_group
+
+	def is_rescheduled(self) -> bool:
+		if self.is_new() or not self.next_execution_on:
+			return True
+		before = self.get_doc_before_save()
+		return bool(before and (before.interval_minutes != self.interval_minutes or not before.enabled))
+
+	def get_next_execution_on(self, after) -> datetime:
+		return schedule_planner.get_next_execution_on(
+			frappe.utils.get_datetime(after), self.interval_minutes, self.schedule_offset_minutes or 0
+		)
+
+	def claim_reusable_session(self) -> "DriftSession | None":
+		DRIFT_SESSION = frappe.qb.DocType("Drift Session")
+		result = (
+			frappe.qb.from_(DRIFT_SESSION)
+			.select(DRIFT_SESSION.name)
+			.where(DRIFT_SESSION.pool_status == "Reusable")
+			.where(DRIFT_SESSION.reusable_for == self.name)
+			.where(DRIFT_SESSION.status == "Active")
+			.where(DRIFT_SESSION.reuse_count < (self.max_session_reuses or 0))
+			.where(
+				DRIFT_SESSION.started_on
+				> frappe.utils.add_to_date(minutes=-(self.max_session_age_minutes or 0))
+			)
+			.orderby(DRIFT_SESSION.started_on)
+			.limit(1)
+			.for_update(skip_locked=True)
+		).run()
+		if not result:
+			record_stats("session_reuse", misses=1)
+			return None
+
+		session: DriftSession = frappe.get_doc("Drift Session", result[0][0])
+		session.pool_status = "Claimed"
+		session.reuse_count = (session.reuse_count or 0) + 1
+		session.save(ignore_permissions=True)
+		record_stats("session_reuse", hits=1)
+		return session
+
 	@frappe.whitelist()
 	def create_test(self) -> "DriftTest":
-		session = get_random_session_server().create_session()
+		session = (self.reuse_sessions and self.claim_reusable_session()) or create_session()
+		test = self.insert_test(session)
+		test.next()
+		self.last_executed_on = frappe.utils.now_datetime()
+		self.next_execution_on = self.get_next_execution_on(self.last_executed_on)
+		self.save(ignore_permissions=True, ignore_version=True)
+		frappe.msgprint(f"Test <a href='/app/drift-test/{test.name}'>{test.name}</a> created successfully")
+		return test
+
+	def insert_test(
+		self, session: "DriftSession", parameters: dict | None = None, test_run: str | None = None
+	) -> "DriftTest":
+		variables = frappe.db.get_value("Drift Test Setup", self.test_setup, "default_local_variables")
+		if parameters:
+			# Each parameter is a variable, and all of those together are the `parameters` variable
+			variables = json.dumps(
+				{**(frappe.parse_json(variables) or {}), **parameters, "parameters": parameters}
+			)
+
 		test = frappe.get_doc(
 			{
 				"doctype": "Drift Test",
 				"definition": self.name,
+				"execution_mode": self.execution_mode,
 				"session": session.name,
 				"session_user": None,
-				"variables": frappe.db.get_value(
-					"Drift Test Setup", self.test_setup, "default_local_variables"
-				),
+				"variables": variables,
+				"test_run": test_run,
 				"steps": [],
 			}
 		)
@@ -65,30 +185,297 @@ class DriftTestDefinition(Document):
 				{
 					"step": step.name,
 					"step_title": step.title,
+					"parallel_group": step.parallel_group,
+					"parallel_branch": step.parallel_branch,
 					"status": "Pending",
 				},
 			)
 		test.insert(ignore_permissions=True)
-		test.next()
+		return test
+
+	@frappe.whitelist()
+	def create_test_run(self) -> "DriftTestRun":
+		test_run = self.insert_test_run()
 		self.last_executed_on = frappe.utils.now_datetime()
-		self.next_execution_on = frappe.utils.add_to_date(
-			self.last_executed_on, minutes=self.interval_minutes
-		)
+		self.next_execution_on = self.get_next_execution_on(self.last_executed_on)
 		self.save(ignore_permissions=True, ignore_version=True)
-		frappe.msgprint(f"Test <a href='/app/drift-test/{test.name}'>{test.name}</a> created successfully")
-		return test
+		frappe.msgprint(
+			f"Test Run <a href='/app/drift-test-run/{test_run.name}'>{test_run.name}</a> created successfully"
+		)
+		return test_run
+
+	def insert_test_run(self) -> "DriftTestRun":
+		"""Queue a run of the test for every parameter set, those are launched in the background"""
+		parameter_sets = self.get_parameter_sets()
+		if not parameter_sets:
+			frappe.throw("No parameter sets to run the test with")
+
+		return frappe.get_doc(
+			{
+				"doctype": "Drift Test Run",
+				"definition": self.name,
+				"max_parallel_runs": self.max_parallel_runs,
+				"total_shards": len(parameter_sets),
+				"shards": [
+					{"status": "Queued", "parameters": json.dumps(parameters, default=str)}
+					for parameters in parameter_sets
+				],
+			}
+		).insert(ignore_permissions=True)
+
+	def get_parameter_sets(self) -> list[dict]:
+		if self.parameter_source == "List":
+			parameter_sets = frappe.parse_json(self.parameter_sets) or []
+		elif self.parameter_source == "Query":
+			parameter_sets = frappe.get_all(
+				self.parameter_doctype,
+				filters=frappe.parse_json(self.parameter_filters) or {},
+				fields=[
+					field.strip() for field in (self.parameter_fields or "name").split(",") if field.strip()
+				],
+				limit=MAX_PARAMETER_SETS + 1,
+			)
+		elif self.parameter_source == "Server Script":
+			safe_exec_locals = prepare_safe_exec_locals({})
+			safe_exec_locals["doc"] = self
+			safe_exec(self.parameter_script or "", _locals=safe_exec_locals)
+			parameter_sets = safe_exec_locals.get("parameter_sets") or []
+		else:
+			return []
+
+		if not isinstance(parameter_sets, list) or not all(isinstance(p, dict) for p in parameter_sets):
+			frappe.throw("Parameter sets should be a list of dicts")
+		if len(parameter_sets) > MAX_PARAMETER_SETS:
+			frappe.throw(f"A test can be run with at most {MAX_PARAMETER_SETS} parameter sets at once")
+		return parameter_sets
+
+
+def destroy_expired_reusable_sessions():
+	"""Destroy the cached sessions which can't be reused anymore"""
+	for session in get_reusable_sessions():
+		if (
+			session.reuse_sessions
+			and (session.reuse_count or 0) < (session.max_session_reuses or 0)
+			and session.started_on > frappe.utils.add_to_date(minutes=-(session.max_session_age_minutes or 0))
+		):
+			continue
+
+		try:
+			doc: DriftSession = frappe.get_doc("Drift Session", session.name, for_update=True)
+			if doc.pool_status != "Reusable":
+				continue
+			doc.pool_status = "Recycled"
+			doc.save(ignore_permissions=True)
+			doc.server_doc.destroy_session(doc.session_id)
+			frappe.db.commit()
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(f"Failed to destroy reusable session {session.name}")
+
+
+def get_reusable_sessions(run: bool = True) -> list[dict] | str:
+	"""Active sessions cached for reuse, with the reuse limits of their definition"""
+	DRIFT_SESSION = frappe.qb.DocType("Drift Session")
+	DRIFT_TEST_DEFINITION = frappe.qb.DocType("Drift Test Definition")
+	query = (
+		frappe.qb.from_(DRIFT_SESSION)
+		.left_join(DRIFT_TEST_DEFINITION)
+		.on(DRIFT_TEST_DEFINITION.name == DRIFT_SESSION.reusable_for)
+		.select(DRIFT_SESSION.name, DRIFT_SESSION.started_on, DRIFT_SESSION.reuse_count)
+		.select(
+			DRIFT_TEST_DEFINITION.reuse_sessions,
+			DRIFT_TEST_DEFINITION.max_session_reuses,
+			DRIFT_TEST_DEFINITION.max_session_age_minutes,
+		)
+		.where(DRIFT_SESSION.pool_status == "Reusable")
+		.where(DRIFT_SESSION.status == "Active")
+	)
+	return query.run(as_dict=True) if run else str(query)
 
 
 def auto_trigger_tests():
-	for definition in frappe.get_all(
-		"Drift Test Definition",
-		filters={"enabled": 1, "next_execution_on": ["<=", frappe.utils.now_datetime()]},
-		pluck="name",
-	):
+	"""
+	Launch the tests of all the due definitions
+
+	Sessions are claimed from the reuse caches and warm pools first. The rest are created at once
+	from a bounded thread pool, at the launch rate allowed by Drift Settings. The threads only make
+	the requests to the agents, the sessions and tests are inserted here.
+	"""
+	started_at = time.monotonic()
+	due_definitions = get_due_definitions()
+	if not due_definitions:
+		return
+
+	definitions: dict[str, DriftTestDefinition] = {
+		name: frappe.get_doc("Drift Test Definition", name) for name in due_definitions
+	}
+	now = frappe.utils.now_datetime()
+	definition_updates = {}
+	for name, definition in list(definitions.items()):
+		if not definition.parameter_source:
+			continue
+		# Definitions with a parameter matrix launch a test run, whose shards get their own sessions
+		definitions.pop(name)
+		try:
+			definition.insert_test_run()
+			frappe.db.commit()
+		except Exception as e:
+			frappe.db.rollback()
+			frappe.log_error("Failed to auto trigger test run: " + name, e)
+			continue
+		definition_updates[name] = {
+			"last_executed_on": now,
+			"next_execution_on": definition.get_next_execution_on(now),
+		}
+
+	sessions: dict[str, DriftSession] = {}
+	for name, definition in definitions.items():
 		try:
-			test = frappe.get_doc("Drift Test Definition", definition).create_test()
+			session = definition.reuse_sessions and definition.claim_reusable_session()
+			if not session:
+				session = claim_warm_session()
+				record_stats("warm_pool", **{"hits" if session else "misses": 1})
+		except Exception:
+			frappe.log_error(f"Failed to claim a session for definition {name}")
+			session = None
+		if session:
+			sessions[name] = session
+	# Release the row locks of the claimed sessions
+	frappe.db.commit()
+
+	sessions.update(_launch_sessions([name for name in definitions if name not in sessions]))
+
+	for name, session in sessions.items():
+		definition = definitions[name]
+		try:
+			test = definition.insert_test(session)
 			test.next()
 			frappe.db.commit()
 		except Exception as e:
-			frappe.log_error("Failed to auto trigger test: " + definition, e)
+			frappe.db.rollback()
+			frappe.log_error("Failed to auto trigger test: " + name, e)
+			continue
+
+		record_stats(
+			"launcher",
+			launches=1,
+			launch_latency_seconds=frappe.utils.time_diff_in_seconds(now, definition.next_execution_on),
+		)
+		definition_updates[name] = {
+			"last_executed_on": now,
+			"next_execution_on": definition.get_next_execution_on(now),
+		}
+
+	if definition_updates:
+		frappe.db.bulk_update("Drift Test Definition", definition_updates, update_modified=False)
+		frappe.db.commit()
+
+	record_stats(
+		"launcher",
+		ticks=1,
+		due=len(due_definitions),
+		failures=len(due_definitions) - len(definition_updates),
+		tick_seconds=time.monotonic() - started_at,
+	)
+
+
+def get_due_definitions(run: bool = True) -> list[str] | str:
+	return frappe.get_all(
+		"Drift Test Definition",
+		filters={"enabled": 1, "next_execution_on": ["<=", frappe.utils.now_datetime()]},
+		order_by="next_execution_on asc",
+		pluck="name",
+		run=run,
+	)
+
+
+def _launch_sessions(keys: list[str]) -> dict[str, "DriftSession"]:
+	"""
+	Create a new session for each of the keys, the definitions or test run shards to launch
+
+	returns the sessions by key, keys which didn't get one are left out
+	"""
+	if not keys:
+		return {}
+
+	settings = frappe.get_cached_doc("Drift Settings")
+	servers: dict[str, DriftServer] = {
+		server.name: server for server in settings.servers if server.status == "Active"
+	}
+	capacities = {name: server.max_sessions or 0 for name, server in servers.items()}
+
+	reservations = {}
+	for name in keys:
+		reservation = session_reservations.reserve(capacities)
+		if not reservation:
+			record_stats("session_placement", rejections=len(keys) - len(reservations))
+			frappe.log_error(f"No capacity left to launch {len(keys) - len(reservations)} due tests")
+			break
+		reservations[name] = reservation
+	if not reservations:
+		return {}
+
+	clients = {server_name: servers[server_name].client for server_name, _ in reservations.values()}
+	throttle = None
+	if settings.max_launches_per_second:
+		throttle = RateLimiter("session_launches", settings.max_launches_per_second).consume
+
+	max_workers = min(len(reservations), settings.launcher_max_workers or 16)
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		futures = {
+			name: executor.submit(_launch_session, clients[server_name], throttle)
+			for name, (server_name, _) in reservations.items()
+		}
+
+	sessions = {}
+	for name, (server_name, token) in reservations.items():
+		success, data = futures[name].result()
+		if not success:
+			session_reservations.release(server_name, token)
+			frappe.log_error(f"Failed to create browser session for {name} on server {server_name}")
+			continue
+
+		try:
+			session = servers[server_name].insert_session(data)
+		except Exception:
+			frappe.db.rollback()
+			session_reservations.release(server_name, token)
+			frappe.log_error(f"Failed to save browser session for {name}")
 			continue
+
+		session_reservations.confirm(server_name, token, session.name)
+		record_stats("session_placement", reservations=1)
+		sessions[name] = session
+
+	return sessions
+
+
+def _launch_session(client: "DriftServerClient", throttle: Callable[[int], None] | None) -> tuple[bool, dict]:
+	"""Runs in a thread of the launcher, creates a session on the agent"""
+	if throttle:
+		throttle(1)
+	try:
+		res, _ = client.send("POST", "sessions", json={}, timeout=5)
+	except requests.RequestException:
+		return False, {}
+	return parse_response(res)
+
+
+@frappe.whitelist()
+def get_launcher_stats() -> dict:
+	frappe.only_for("System Manager")
+
+	stats = get_stats("launcher")
+	ticks = stats.get("ticks", 0)
+	launches = stats.get("launches", 0)
+	return {
+		"ticks": int(ticks),
+		"launches": int(launches),
+		"failures": int(stats.get("failures", 0)),
+		"avg_tick_seconds": stats.get("tick_seconds", 0) / ticks if ticks else 0,
+		"avg_launch_latency_seconds": stats.get("launch_latency_seconds", 0) / launches if launches else 0,
+	}
+
+
+def on_doctype_update():
+	frappe.db.add_index("Drift Test Definition", ["enabled", "next_execution_on"])
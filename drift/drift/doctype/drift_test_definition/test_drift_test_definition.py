@@ -1,9 +1,13 @@
 # Copyright (c) 2025, Tanmoy and Contributors
 # See license.txt
 
-# import frappe
+import json
+from unittest.mock import patch
+
+import frappe
 from frappe.tests import IntegrationTestCase
 
+from drift.drift.doctype.drift_test_definition.drift_test_definition import MAX_PARAMETER_SETS
 
 # On IntegrationTestCase, the doctype test records and all
 # link-field test record dependencies are recursively loaded
@@ -12,11 +16,45 @@ EXTRA_TEST_RECORD_DEPENDENCIES = []  # eg. ["User"]
 IGNORE_TEST_RECORD_DEPENDENCIES = []  # eg. ["User"]
 
 
-
 class IntegrationTestDriftTestDefinition(IntegrationTestCase):
 	"""
 	Integration tests for DriftTestDefinition.
 	Use this class for testing interactions between multiple components.
 	"""
 
-	pass
+	def get_definition(self, **parameter_matrix):
+		return frappe.get_doc({"doctype": "Drift Test Definition", **parameter_matrix})
+
+	def test_parameter_sets_from_list(self):
+		parameter_sets = [{"company": "A"}, {"company": "B"}]
+		definition = self.get_definition(parameter_source="List", parameter_sets=json.dumps(parameter_sets))
+		self.assertEqual(definition.get_parameter_sets(), parameter_sets)
+
+	def test_parameter_sets_from_query(self):
+		definition = self.get_definition(
+			parameter_source="Query",
+			parameter_doctype="User",
+			parameter_filters=json.dumps({"name": "Administrator"}),
+			parameter_fields="name, enabled",
+		)
+		self.assertEqual(definition.get_parameter_sets(), [{"name": "Administrator", "enabled": 1}])
+
+	def test_parameter_sets_from_server_script(self):
+		definition = self.get_definition(parameter_source="Server Script", parameter_script="...")
+
+		def safe_exec(script, _locals):
+			_locals["parameter_sets"] = [{"user": _locals["doc"].parameter_source}]
+
+		with patch("drift.drift.doctype.drift_test_definition.drift_test_definition.safe_exec", safe_exec):
+			self.assertEqual(definition.get_parameter_sets(), [{"user": "Server Script"}])
+
+	def test_parameter_sets_without_source(self):
+		self.assertEqual(self.get_definition().get_parameter_sets(), [])
+
+	def test_invalid_parameter_sets(self):
+		for parameter_sets in ({"company": "A"}, ["A", "B"], [{}] * (MAX_PARAMETER_SETS + 1)):
+			definition = self.get_definition(
+				parameter_source="List", parameter_sets=json.dumps(parameter_sets)
+			)
+			with self.assertRaises(frappe.ValidationError):
+				definition.get_parameter_sets()
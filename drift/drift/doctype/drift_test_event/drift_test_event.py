@@ -0,0 +1,109 @@
+# Copyright (c) 2025, Tanmoy and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.query_builder.functions import Max
+
+EVENT_FIELDS = (
+	"test",
+	"sequence",
+	"event",
+	"step",
+	"step_idx",
+	"step_title",
+	"status",
+	"attempt",
+	"duration",
+	"error",
+	"traceback",
+)
+
+
+class DriftTestEvent(Document):
+	# begin: auto-generated types
+	# This code is auto-generated. Do not modify anything in this block.
+
+	from typing import TYPE_CHECKING
+
+	if TYPE_CHECKING:
+		from frappe.types import DF
+
+		attempt: DF.Int
+		duration: DF.Float
+		error: DF.Data | None
+		event: DF.Literal["Step Started", "Attempt", "Step Succeeded", "Step Failed", "Test Finished"]
+		sequence: DF.Int
+		status: DF.Data | None
+		step: DF.Data | None
+		step_idx: DF.Int
+		step_title: DF.Data | None
+		test: DF.Link
+		traceback: DF.Code | None
+	# end: auto-generated types
+
+	pass
+
+
+def insert_events(events: list[dict], owner: str | None = None):
+	"""
+	Append events to the log in one query, events are never updated afterwards
+
+	Every event is stamped with its own `creation`, the time it was logged. The unique index on
+	(test, sequence) rejects the whole batch if another writer took one of its sequences.
+	"""
+	if not events:
+		return
+
+	now = frappe.utils.now()
+	owner = owner or frappe.session.user
+	frappe.db.bulk_insert(
+		"Drift Test Event",
+		("name", "creation", "modified", "owner", "modified_by", "docstatus", *EVENT_FIELDS),
+		[
+			(
+				frappe.generate_hash(length=12),
+				event.get("creation") or now,
+				event.get("creation") or now,
+				owner,
+				owner,
+				0,
+				*(event.get(field) for field in EVENT_FIELDS),
+			)
+			for event in events
+		],
+	)
+
+
+def get_last_sequence(test: str) -> int:
+	DRIFT_TEST_EVENT = frappe.qb.DocType("Drift Test Event")
+	sequence = (
+		frappe.qb.from_(DRIFT_TEST_EVENT)
+		.select(Max(DRIFT_TEST_EVENT.sequence))
+		.where(DRIFT_TEST_EVENT.test == test)
+	).run()
+	return sequence[0][0] or 0
+
+
+@frappe.whitelist()
+def get_test_events(test: str, after: int = 0, limit: int = 100) -> dict:
+	"""
+	Page through the events of a test in order
+
+	Pass the `next` of a page as `after` to get the next page, which also returns the events logged
+	since the last call.
+	"""
+	frappe.has_permission("Drift Test", "read", test, throw=True)
+
+	events = frappe.get_all(
+		"Drift Test Event",
+		filters={"test": test, "sequence": (">", frappe.utils.cint(after))},
+		fields=["sequence", "creation", *EVENT_FIELDS[2:]],
+		order_by="sequence asc",
+		limit=min(frappe.utils.cint(limit) or 100, 500),
+	)
+	return {"events": events, "next": events[-1].sequence if events else frappe.utils.cint(after)}
+
+
+def on_doctype_update():
+	frappe.db.add_unique("Drift Test Event", ["test", "sequence"], constraint_name="unique_test_sequence")
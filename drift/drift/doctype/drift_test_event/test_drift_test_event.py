@@ -0,0 +1,75 @@
+# Copyright (c) 2025, Tanmoy and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests import IntegrationTestCase
+
+from drift.drift.doctype.drift_test_event.drift_test_event import get_test_events, insert_events
+
+# On IntegrationTestCase, the doctype test records and all
+# link-field test record dependencies are recursively loaded
+# Use these module variables to add/remove to/from that list
+EXTRA_TEST_RECORD_DEPENDENCIES = []  # eg. ["User"]
+IGNORE_TEST_RECORD_DEPENDENCIES = []  # eg. ["User"]
+
+
+class IntegrationTestDriftTestEvent(IntegrationTestCase):
+	"""
+	Integration tests for DriftTestEvent.
+	Use this class for testing interactions between multiple components.
+	"""
+
+	def setUp(self):
+		self.test = frappe.get_doc(
+			{
+				"doctype": "Drift Test",
+				"definition": "_Test Drift Test Definition",
+				"status": "Running",
+				"variables": "{}",
+			}
+		)
+		self.test.db_insert()
+
+	def log_events(self, *events: str):
+		for event in events:
+			self.test._log_event(event)
+		self.test._flush_events(self.test.event_count)
+
+	def test_events_are_paged_in_order(self):
+		self.log_events("Step Started", "Attempt", "Step Succeeded")
+		self.log_events("Step Started", "Attempt")
+
+		first = get_test_events(self.test.name, limit=3)
+		self.assertEqual([e.sequence for e in first["events"]], [1, 2, 3])
+		self.assertEqual([e.event for e in first["events"]], ["Step Started", "Attempt", "Step Succeeded"])
+		self.assertEqual(first["next"], 3)
+
+		second = get_test_events(self.test.name, after=first["next"], limit=3)
+		self.assertEqual([e.sequence for e in second["events"]], [4, 5])
+		self.assertEqual(second["next"], 5)
+
+		# Nothing new yet, the cursor stays put
+		self.assertEqual(get_test_events(self.test.name, after=second["next"]), {"events": [], "next": 5})
+
+		# Events logged since are picked up from the same cursor
+		self.log_events("Test Finished")
+		third = get_test_events(self.test.name, after=second["next"])
+		self.assertEqual([e.event for e in third["events"]], ["Test Finished"])
+
+	def test_events_keep_the_time_they_were_logged(self):
+		self.log_events("Step Started", "Attempt")
+		first, second = get_test_events(self.test.name)["events"]
+		self.assertLess(first.creation, second.creation)
+
+	def test_sequence_is_only_taken_once(self):
+		self.log_events("Step Started")
+		self.assertEqual(self.test.event_count, 1)
+
+		# Another writer which started from a stale count continues after the last logged event
+		self.log_events("Attempt")
+		self.test.event_count = 0
+		self.log_events("Step Succeeded")
+		self.assertEqual(self.test.event_count, 3)
+
+		with self.assertRaises(frappe.db.IntegrityError):
+			insert_events([{"test": self.test.name, "sequence": 3, "event": "Attempt"}])
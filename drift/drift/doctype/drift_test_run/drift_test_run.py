@@ -0,0 +1,176 @@
+# Copyright (c) 2025, Tanmoy and contributors
+# For license information, please see license.txt
+
+import contextlib
+import json
+from typing import TYPE_CHECKING
+
+import frappe
+from frappe.model.document import Document
+
+from drift.drift import session_reservations
+
+if TYPE_CHECKING:
+	from drift.drift.doctype.drift_session.drift_session import DriftSession
+	from drift.drift.doctype.drift_test.drift_test import DriftTest
+	from drift.drift.doctype.drift_test_definition.drift_test_definition import DriftTestDefinition
+
+
+class DriftTestRun(Document):
+	"""
+	Runs of a test definition for every set of its parameter matrix
+
+	Every parameter set is a shard, which gets its own test and session. Shards are launched in
+	batches of at most `max_parallel_runs` running at once, and the next batch is launched as the
+	running ones finish.
+	"""
+
+	# begin: auto-generated types
+	# This code is auto-generated. Do not modify anything in this block.
+
+	from typing import TYPE_CHECKING
+
+	if TYPE_CHECKING:
+		from frappe.types import DF
+
+		from drift.drift.doctype.drift_test_run_shard.drift_test_run_shard import DriftTestRunShard
+
+		definition: DF.Link
+		ended_on: DF.Datetime | None
+		failed_shards: DF.Int
+		max_parallel_runs: DF.Int
+		running_shards: DF.Int
+		shards: DF.Table[DriftTestRunShard]
+		started_on: DF.Datetime | None
+		status: DF.Literal["Queued", "Running", "Success", "Failure"]
+		successful_shards: DF.Int
+		total_shards: DF.Int
+	# end: auto-generated types
+
+	def after_insert(self):
+		enqueue_launch(self.name)
+
+	def launch_shards(self):
+		"""Launch the queued shards which fit in `max_parallel_runs`, all their sessions at once"""
+		from drift.drift.doctype.drift_test_definition.drift_test_definition import _launch_sessions
+
+		running = sum(shard.status == "Running" for shard in self.shards)
+		queued = [shard for shard in self.shards if shard.status == "Queued"]
+		queued = queued[: max(0, (self.max_parallel_runs or 1) - running)]
+		if queued:
+			definition: DriftTestDefinition = frappe.get_doc("Drift Test Definition", self.definition)
+			# Placed on the least loaded servers, shards which get no session are launched later
+			sessions = _launch_sessions([shard.name for shard in queued])
+			for shard in queued:
+				session = sessions.get(shard.name)
+				if not session:
+					continue
+				try:
+					test = definition.insert_test(
+						session, parameters=json.loads(shard.parameters or "{}"), test_run=self.name
+					)
+					test.next()
+				except Exception:
+					frappe.db.rollback()
+					frappe.log_error(f"Failed to launch shard {shard.idx} of test run {self.name}")
+					# The session was created for this shard alone, the shard gets a new one next time
+					discard_session(session)
+					continue
+
+				shard.status = "Running"
+				shard.test = test.name
+				shard.server = session.server
+				shard.started_on = frappe.utils.now_datetime()
+				shard.db_update()
+				frappe.db.commit()
+
+		# Shards which finished meanwhile were written by their tests, count those too
+		frappe.db.get_value(self.doctype, self.name, "name", for_update=True)
+		self.reload()
+		self.update_summary()
+		frappe.db.commit()
+
+	def update_summary(self):
+		"""Count the shards by status, the shards should be read with the test run locked"""
+		statuses = [shard.status for shard in self.shards]
+		summary = {
+			"running_shards": statuses.count("Running"),
+			"successful_shards": statuses.count("Success"),
+			"failed_shards": sum(status in ("Failure", "Stopped", "Cancelled") for status in statuses),
+		}
+		if summary["running_shards"] and not self.started_on:
+			summary["started_on"] = frappe.utils.now_datetime()
+		if summary["successful_shards"] + summary["failed_shards"] == len(statuses):
+			summary["status"] = "Failure" if summary["failed_shards"] else "Success"
+			summary["ended_on"] = frappe.utils.now_datetime()
+		elif summary["running_shards"] or summary["successful_shards"] or summary["failed_shards"]:
+			summary["status"] = "Running"
+		self.db_set(summary, notify=True)
+
+
+def discard_session(session: "DriftSession"):
+	"""Stop a launched session which no test was started on, and free its slot on the server"""
+	from drift.drift.doctype.drift_session.drift_session import bulk_stop_sessions
+
+	try:
+		with contextlib.suppress(Exception):
+			session.server_doc.destroy_session(session.session_id)
+		bulk_stop_sessions([session.name])
+		frappe.db.commit()
+	except Exception:
+		frappe.db.rollback()
+		frappe.log_error(f"Failed to stop unused session {session.name}")
+	finally:
+		# Stopping releases it too, unless the session was already stopped
+		session_reservations.release(session.server, session.name)
+
+
+def update_shard(test: "DriftTest"):
+	"""
+	Record the result of a finished test on its shard, and launch the next shards
+
+	The summary is updated here, as the launch job might be running already and a new one is
+	deduplicated away.
+	"""
+	DRIFT_TEST_RUN_SHARD = frappe.qb.DocType("Drift Test Run Shard")
+	(
+		frappe.qb.update(DRIFT_TEST_RUN_SHARD)
+		.set(DRIFT_TEST_RUN_SHARD.status, test.status)
+		.set(DRIFT_TEST_RUN_SHARD.ended_on, frappe.utils.now_datetime())
+		.where(DRIFT_TEST_RUN_SHARD.parent == test.test_run)
+		.where(DRIFT_TEST_RUN_SHARD.test == test.name)
+	).run()
+	test_run: DriftTestRun = frappe.get_doc("Drift Test Run", test.test_run, for_update=True)
+	test_run.update_summary()
+	enqueue_launch(test.test_run)
+
+
+def launch_queued_shards():
+	"""Retry the shards which couldn't be launched for lack of capacity"""
+	for name in get_test_runs_with_queued_shards():
+		enqueue_launch(name)
+
+
+def get_test_runs_with_queued_shards(run: bool = True) -> list[str] | str:
+	return frappe.get_all(
+		"Drift Test Run",
+		filters=[
+			["Drift Test Run", "status", "in", ["Queued", "Running"]],
+			["Drift Test Run Shard", "status", "=", "Queued"],
+		],
+		pluck="name",
+		distinct=True,
+		run=run,
+	)
+
+
+def enqueue_launch(test_run: str):
+	frappe.enqueue_doc(
+		"Drift Test Run",
+		test_run,
+		"launch_shards",
+		queue="long",
+		deduplicate=True,
+		job_id=f"drift_test_run||{test_run}",
+		enqueue_after_commit=True,
+	)
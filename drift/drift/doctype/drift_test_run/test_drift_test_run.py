@@ -0,0 +1,126 @@
+# Copyright (c) 2025, Tanmoy and Contributors
+# See license.txt
+
+import json
+from unittest.mock import MagicMock, patch
+
+import frappe
+from frappe.tests import IntegrationTestCase
+
+from drift.drift.doctype.drift_test_definition.drift_test_definition import DriftTestDefinition
+from drift.drift.doctype.drift_test_run.drift_test_run import update_shard
+
+# On IntegrationTestCase, the doctype test records and all
+# link-field test record dependencies are recursively loaded
+# Use these module variables to add/remove to/from that list
+EXTRA_TEST_RECORD_DEPENDENCIES = []  # eg. ["User"]
+IGNORE_TEST_RECORD_DEPENDENCIES = []  # eg. ["User"]
+
+
+class IntegrationTestDriftTestRun(IntegrationTestCase):
+	"""
+	Integration tests for DriftTestRun.
+	Use this class for testing interactions between multiple components.
+	"""
+
+	def setUp(self):
+		definition = frappe.get_doc(
+			{"doctype": "Drift Test Definition", "name": frappe.generate_hash(length=10), "steps": []}
+		)
+		definition.db_insert()
+		test_run = frappe.get_doc(
+			{
+				"doctype": "Drift Test Run",
+				"definition": definition.name,
+				"status": "Queued",
+				"max_parallel_runs": 2,
+				"total_shards": 3,
+				"shards": [
+					{"status": "Queued", "parameters": json.dumps({"shard": index})} for index in range(3)
+				],
+			}
+		)
+		# Launched by the tests, not by a background job
+		test_run.db_insert()
+		for shard in test_run.shards:
+			shard.db_insert()
+		# Launching commits and rolls back failed shards, so these are committed and cleaned up after
+		frappe.db.commit()
+		self.test_run = frappe.get_doc("Drift Test Run", test_run.name)
+
+		def cleanup():
+			frappe.db.delete("Drift Test Run Shard", {"parent": test_run.name})
+			frappe.db.delete("Drift Test Run", test_run.name)
+			frappe.db.delete("Drift Test Definition", definition.name)
+			frappe.db.commit()
+
+		self.addCleanup(cleanup)
+
+	def get_session(self, name: str) -> MagicMock:
+		session = MagicMock(session_id=f"{name}-id", server="_Test Drift Server")
+		session.name = name
+		return session
+
+	def launch_shards(self, sessions: dict, insert_test: MagicMock) -> MagicMock:
+		with (
+			patch(
+				"drift.drift.doctype.drift_test_definition.drift_test_definition._launch_sessions",
+				return_value=sessions,
+			) as launch_sessions,
+			patch.object(DriftTestDefinition, "insert_test", insert_test),
+		):
+			self.test_run.launch_shards()
+		self.test_run.reload()
+		return launch_sessions
+
+	def test_shards_are_launched_up_to_max_parallel_runs(self):
+		first, second, third = self.test_run.shards
+		test = MagicMock()
+		test.name = "_Test Drift Test"
+		launch_sessions = self.launch_shards(
+			{first.name: self.get_session("first"), second.name: self.get_session("second")},
+			MagicMock(return_value=test),
+		)
+
+		launch_sessions.assert_called_once_with([first.name, second.name])
+		self.assertEqual([shard.status for shard in self.test_run.shards], ["Running", "Running", "Queued"])
+		self.assertEqual(self.test_run.shards[0].test, "_Test Drift Test")
+		self.assertEqual(self.test_run.shards[0].server, "_Test Drift Server")
+		self.assertEqual(self.test_run.running_shards, 2)
+		self.assertEqual(self.test_run.status, "Running")
+		test.next.assert_called()
+
+	def test_shard_without_session_stays_queued(self):
+		first, _, _ = self.test_run.shards
+		self.launch_shards({first.name: self.get_session("first")}, MagicMock())
+		self.assertEqual([shard.status for shard in self.test_run.shards], ["Running", "Queued", "Queued"])
+
+	def test_session_of_a_failed_shard_is_stopped(self):
+		first, _, _ = self.test_run.shards
+		session = self.get_session("first")
+		with (
+			patch("drift.drift.doctype.drift_session.drift_session.bulk_stop_sessions") as bulk_stop_sessions,
+			patch("drift.drift.session_reservations.release") as release,
+		):
+			self.launch_shards({first.name: session}, MagicMock(side_effect=frappe.ValidationError))
+
+		session.server_doc.destroy_session.assert_called_once_with("first-id")
+		bulk_stop_sessions.assert_called_once_with(["first"])
+		release.assert_called_once_with("_Test Drift Server", "first")
+		self.assertEqual(self.test_run.shards[0].status, "Queued")
+
+	def test_last_finished_shard_finishes_the_run(self):
+		for shard, status in zip(self.test_run.shards, ("Success", "Failure", "Running"), strict=True):
+			shard.db_set({"status": status, "test": f"_Test Drift Test {shard.idx}"})
+
+		# Finished while a launch job was running, whose own summary only counted the shard as running
+		test = frappe._dict(name="_Test Drift Test 3", status="Success", test_run=self.test_run.name)
+		with patch("drift.drift.doctype.drift_test_run.drift_test_run.enqueue_launch") as enqueue_launch:
+			update_shard(test)
+		enqueue_launch.assert_called_once_with(self.test_run.name)
+
+		self.test_run.reload()
+		self.assertEqual([shard.status for shard in self.test_run.shards], ["Success", "Failure", "Success"])
+		self.assertEqual(self.test_run.running_shards, 0)
+		self.assertEqual(self.test_run.status, "Failure")
+		self.assertIsNotNone(self.test_run.ended_on)
@@ -0,0 +1,28 @@
+# Copyright (c) 2025, Tanmoy and contributors
+# For license information, please see license.txt
+
+# import frappe
+from frappe.model.document import Document
+
+
+class DriftTestRunShard(Document):
+	# begin: auto-generated types
+	# This code is auto-generated. Do not modify anything in this block.
+
+	from typing import TYPE_CHECKING
+
+	if TYPE_CHECKING:
+		from frappe.types import DF
+
+		ended_on: DF.Datetime | None
+		parameters: DF.Code | None
+		parent: DF.Data
+		parentfield: DF.Data
+		parenttype: DF.Data
+		server: DF.Link | None
+		started_on: DF.Datetime | None
+		status: DF.Literal["Queued", "Running", "Success", "Failure", "Stopped", "Cancelled"]
+		test: DF.Link | None
+	# end: auto-generated types
+
+	pass
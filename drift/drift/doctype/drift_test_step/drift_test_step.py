@@ -1,7 +1,7 @@
 # Copyright (c) 2025, Tanmoy and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 
@@ -19,9 +19,12 @@ class DriftTestStep(Document):
 		error: DF.Data | None
 		last_attempted_at: DF.Datetime | None
 		no_of_attempts: DF.Int
+		parallel_branch: DF.Data | None
+		parallel_group: DF.Data | None
 		parent: DF.Data
 		parentfield: DF.Data
 		parenttype: DF.Data
+		resume_at: DF.Datetime | None
 		started_at: DF.Datetime | None
 		status: DF.Literal["Pending", "Running", "Success", "Failure"]
 		step: DF.Data | None
@@ -30,3 +33,8 @@ class DriftTestStep(Document):
 	# end: auto-generated types
 
 	pass
+
+
+def on_doctype_update():
+	# Deferred steps which are due
+	frappe.db.add_index("Drift Test Step", ["status", "resume_at"])
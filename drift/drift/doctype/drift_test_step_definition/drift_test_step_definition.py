@@ -1,8 +1,70 @@
 # Copyright (c) 2025, Tanmoy and contributors
 # For license information, please see license.txt
 
+import contextlib
+from typing import TYPE_CHECKING, Optional
+
+import frappe
 from frappe.model.document import Document
 from frappe.utils import get_url
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+
+from drift.drift.utils import compiled_code_cache, get_stats, jinja_template_cache, render_template_cached
+
+if TYPE_CHECKING:
+	from playwright.sync_api import Page
+
+# Step types executed directly instead of going through safe_exec
+NATIVE_STEP_TYPES = ("Playwright Action", "UI Navigation", "Playwright Wait", "Wait", "Setup User Session")
+
+# Native step types which don't interact with the page
+PAGELESS_STEP_TYPES = ("Wait", "Setup User Session")
+
+NAVIGATION_METHODS = {"Reload": "reload", "Forward": "go_forward", "Backward": "go_back"}
+
+LOAD_STATES = {"Load": "load", "DOM Content Loaded": "domcontentloaded", "Network Idle": "networkidle"}
+
+LOCATOR_METHODS = {
+	"Get By Label": "get_by_label",
+	"Get By Text": "get_by_text",
+	"Get By Placeholder": "get_by_placeholder",
+}
+
+ACTION_METHODS = {
+	"Click": "click",
+	"Double Click": "dblclick",
+	"Mark Checkbox": "check",
+	"Unmark Checkbox": "uncheck",
+	"Fill Text": "fill",
+	"Select Option": "select_option",
+	"Clear Field": "clear",
+}
+
+
+class DriftStepTimeoutError(Exception):
+	pass
+
+
+class PlaywrightCall:
+	"""
+	A Playwright method call on the page, or on a locator of the page
+
+	Calling it with a page of the sync API performs the call,
+	with a page of the async API it returns the awaitable instead.
+	"""
+
+	def __init__(self, method: str, *args, locator: tuple[str, tuple, dict] | None = None, **kwargs):
+		self.method = method
+		self.args = args
+		self.kwargs = kwargs
+		self.locator = locator
+
+	def __call__(self, pw_page):
+		target = pw_page
+		if self.locator:
+			method, args, kwargs = self.locator
+			target = getattr(pw_page, method)(*args, **kwargs)
+		return getattr(target, self.method)(*self.args, **self.kwargs)
 
 
 class DriftTestStepDefinition(Document):
@@ -14,6 +76,8 @@ class DriftTestStepDefinition(Document):
 	if TYPE_CHECKING:
 		from frappe.types import DF
 
+		parallel_branch: DF.Data | None
+		parallel_group: DF.Data | None
 		parent: DF.Data
 		parentfield: DF.Data
 		parenttype: DF.Data
@@ -45,8 +109,15 @@ class DriftTestStepDefinition(Document):
 
 	def db_update(self):
 		self.auto_set_fields()
+		# Compiled templates and code of the old version are of no use anymore
+		jinja_template_cache.discard(self.name)
+		compiled_code_cache.discard(self.name)
 		return super().db_update()
 
+	@property
+	def cache_key(self) -> tuple:
+		return (self.name, str(self.modified))
+
 	def auto_set_fields(self):
 		if self.type == "Playwright Action":
 			if not self.playwright_action_timeout_sec:
@@ -60,114 +131,129 @@ class DriftTestStepDefinition(Document):
 			self.wait_for_completion = True
 			self.timeout_seconds = max(self.timeout_seconds, self.playwright_wait_timeout_sec)
 
+	@property
+	def is_native(self) -> bool:
+		return self.type in NATIVE_STEP_TYPES
+
 	def get_code(self, local_context: dict) -> str:
+		# Only server scripts are executed through safe_exec, rest of the steps are dispatched natively
 		if self.type == "Server Script":
 			return self.server_script or ""
+		return ""
+
+	def execute_native(self, pw_page: "Page", local_context: dict, elapsed_seconds: int = 0) -> tuple[bool, bool]:
+		"""
+		Execute a built-in step type directly, without generating code
 
-		if self.type == "Wait":
-			return f"""
-sleep({self.wait_duration_sec})
-"""
+		Returns the result as (success, failure), same as the `result` variable of server scripts.
+		`elapsed_seconds` is the time spent on the step by the previous attempts.
+		"""
+		if self.type in PAGELESS_STEP_TYPES:
+			return self.execute_without_page(local_context)
 
+		call = self.get_playwright_call(local_context, elapsed_seconds)
+		if not call:
+			return (True, False)
+
+		with self.handle_playwright_timeout():
+			call(pw_page)
+		return (True, False)
+
+	def execute_without_page(self, local_context: dict) -> tuple[bool, bool]:
 		if self.type == "Setup User Session":
-			return """
-setup = frappe.get_doc("Drift Test Setup", frappe.db.get_value("Drift Test Definition", doc.definition, "test_setup"))
-user = setup.get_user(variables)
+			self.setup_user_session(local_context)
+
+		# Wait steps are deferred by the test instead, see `DriftTest._run_wait_step`
+		return (True, False)
+
+	@contextlib.contextmanager
+	def handle_playwright_timeout(self):
+		try:
+			yield
+		except PlaywrightTimeoutError:
+			if self.type == "Playwright Wait":
+				# The wait was given all the time left for the step, nothing to retry
+				raise DriftStepTimeoutError(f"Step timed out after {self.playwright_wait_timeout_sec} seconds")
+			raise
 
-variables["session_user"] = user
-variables["session_user_sid"] = get_login_sid(user)
-"""
+	def setup_user_session(self, local_context: dict):
+		from drift.drift.utils import get_login_sid
 
+		doc = local_context["doc"]
+		variables = local_context["variables"]
+		setup = frappe.get_doc(
+			"Drift Test Setup", frappe.db.get_value("Drift Test Definition", doc.definition, "test_setup")
+		)
+		user = setup.get_user(variables)
+
+		variables["session_user"] = user
+		variables["session_user_sid"] = get_login_sid(user)
+
+	def get_playwright_call(self, local_context: dict, elapsed_seconds: int = 0) -> Optional["PlaywrightCall"]:
 		if self.type == "UI Navigation":
 			if self.ui_navigation_type == "Goto" and self.ui_navigation_goto_url:
 				url = get_url(self.render_jinja(self.ui_navigation_goto_url, local_context))
-				return f"""pw_page.goto("{url}",wait_until="domcontentloaded")"""
-			elif self.ui_navigation_type == "Reload":
-				return """pw_page.reload(wait_until="domcontentloaded")"""
-			elif self.ui_navigation_type == "Forward":
-				return """pw_page.go_forward(wait_until="domcontentloaded")"""
-			elif self.ui_navigation_type == "Backward":
-				return """pw_page.go_back(wait_until="domcontentloaded")"""
+				return PlaywrightCall("goto", url, wait_until="domcontentloaded")
+			if self.ui_navigation_type in NAVIGATION_METHODS:
+				return PlaywrightCall(NAVIGATION_METHODS[self.ui_navigation_type], wait_until="domcontentloaded")
 
 		if self.type == "Playwright Wait":
+			# Playwright resolves the wait on the page's load state or navigation events,
+			# so wait once for the rest of the timeout instead of polling in short attempts.
+			# Timeout of 0 disables it in Playwright, so always leave at least a millisecond.
+			timeout = max(1, (self.playwright_wait_timeout_sec - elapsed_seconds) * 1000)
 			if self.playwright_wait_type == "Load State":
-				load_state = {
-					"Load": "load",
-					"DOM Content Loaded": "domcontentloaded",
-					"Network Idle": "networkidle",
-				}[self.playwright_wait_for_load_state]
-				return f"""
-try:
-	pw_page.wait_for_load_state("{load_state}", timeout={min(5000, self.playwright_wait_timeout_sec * 1000)})
-	result = (True, False)
-except pw.TimeoutError:
-	result = (False, False)
-except Exception as e:
-	raise e
-"""
+				load_state = LOAD_STATES[self.playwright_wait_for_load_state]
+				return PlaywrightCall("wait_for_load_state", load_state, timeout=timeout)
 			if self.playwright_wait_type == "URL Pattern":
 				url = get_url(self.render_jinja(self.playwright_wait_for_url_pattern or "", local_context))
-
-				return f"""
-try:
-	pw_page.wait_for_url("{url}", timeout={min(5000, self.playwright_wait_timeout_sec * 1000)})
-	result = (True, False)
-except pw.TimeoutError:
-	result = (False, False)
-except Exception as e:
-	raise e
-"""
+				return PlaywrightCall("wait_for_url", url, timeout=timeout)
 
 		if self.type == "Playwright Action":
-			# Prepare locator code
-			locator_code = ""
-			locator_text = self.render_jinja(self.playwright_locator_text or "", local_context)
-			if self.playwright_locator_type == "Get By Label":
-				locator_code = f'pw_page.get_by_label("{locator_text}", exact={self.bool_to_str(self.playwright_locator_exact_match)})'
-			elif self.playwright_locator_type == "Get By Text":
-				locator_code = f'pw_page.get_by_text("{locator_text}", exact={self.bool_to_str(self.playwright_locator_exact_match)})'
-			elif self.playwright_locator_type == "Get By Role":
-				locator_code = f'pw_page.get_by_role("{self.playwright_locator_role}", name="{locator_text}", exact={self.bool_to_str(self.playwright_locator_exact_match)})'
-			elif self.playwright_locator_type == "Get By Placeholder":
-				locator_code = f'pw_page.get_by_placeholder("{locator_text}", exact={self.bool_to_str(self.playwright_locator_exact_match)})'
-			elif self.playwright_locator_type == "Custom Locator":
-				locator_code = (
-					f'pw_page.locator("{self.render_jinja(self.playwright_custom_locator, local_context)}")'
-				)
-
-			if not locator_code:
-				return ""
-
-			# Prepare action code
-			action_code = ""
-			if self.playwright_action == "Click":
-				action_code = f"click(timeout={self.playwright_action_timeout_sec * 1000})"
-			elif self.playwright_action == "Double Click":
-				action_code = f"dblclick(timeout={self.playwright_action_timeout_sec * 1000})"
-			elif self.playwright_action == "Mark Checkbox":
-				action_code = f"check(timeout={self.playwright_action_timeout_sec * 1000})"
-			elif self.playwright_action == "Unmark Checkbox":
-				action_code = f"uncheck(timeout={self.playwright_action_timeout_sec * 1000})"
-			elif self.playwright_action == "Fill Text":
-				value = self.render_jinja(self.playwright_action_value or "", local_context)
-				action_code = f'fill("{value}", timeout={self.playwright_action_timeout_sec * 1000})'
-			elif self.playwright_action == "Select Option":
-				value = self.render_jinja(self.playwright_action_value or "", local_context)
-				action_code = f'select_option("{value}", timeout={self.playwright_action_timeout_sec * 1000})'
-			elif self.playwright_action == "Clear Field":
-				action_code = f"clear(timeout={self.playwright_action_timeout_sec * 1000})"
-
-			if not action_code:
-				return ""
-
-			return f"{locator_code}.{action_code}"
+			locator = self.get_locator(local_context)
+			if not locator or self.playwright_action not in ACTION_METHODS:
+				return None
 
-		return ""
+			args = ()
+			if self.playwright_action in ("Fill Text", "Select Option"):
+				args = (self.render_jinja(self.playwright_action_value or "", local_context),)
+			return PlaywrightCall(
+				ACTION_METHODS[self.playwright_action],
+				*args,
+				locator=locator,
+				timeout=self.playwright_action_timeout_sec * 1000,
+			)
+
+		return None
+
+	def get_locator(self, local_context: dict) -> tuple[str, tuple, dict] | None:
+		if self.playwright_locator_type == "Custom Locator":
+			return ("locator", (self.render_jinja(self.playwright_custom_locator or "", local_context),), {})
+
+		locator_text = self.render_jinja(self.playwright_locator_text or "", local_context)
+		exact = bool(self.playwright_locator_exact_match)
+		if self.playwright_locator_type == "Get By Role":
+			return ("get_by_role", (self.playwright_locator_role,), {"name": locator_text, "exact": exact})
+		if self.playwright_locator_type in LOCATOR_METHODS:
+			return (LOCATOR_METHODS[self.playwright_locator_type], (locator_text,), {"exact": exact})
+		return None
 
 	def render_jinja(self, template: str, context: dict) -> str:
-		from frappe.utils.jinja import render_template
+		return render_template_cached(template, context, self.cache_key)
+
 
-		return render_template(template, context)
+@frappe.whitelist()
+def get_compile_cache_stats() -> dict:
+	frappe.only_for("System Manager")
 
-	def bool_to_str(self, value: bool) -> str:
-		return "True" if value else "False"
+	stats = {}
+	for cache in (jinja_template_cache, compiled_code_cache):
+		bucket = get_stats(cache.name)
+		hits = bucket.get("hits", 0)
+		misses = bucket.get("misses", 0)
+		stats[cache.name] = {
+			"hits": int(hits),
+			"misses": int(misses),
+			"hit_rate": hits / (hits + misses) if hits + misses else 0,
+		}
+	return stats
@@ -0,0 +1,372 @@
+# Copyright (c) 2025, Tanmoy and contributors
+# For license information, please see license.txt
+
+import asyncio
+import contextlib
+import contextvars
+import functools
+import signal
+import time
+import traceback
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any
+
+import frappe
+from playwright.async_api import Browser, Playwright, async_playwright
+
+from drift.drift.doctype.drift_test_step_definition.drift_test_step_definition import (
+	NATIVE_STEP_TYPES,
+	PAGELESS_STEP_TYPES,
+)
+from drift.drift.parallel_steps import run_branches
+
+if TYPE_CHECKING:
+	from drift.drift.doctype.drift_test.drift_test import DriftTest
+	from drift.drift.doctype.drift_test_step.drift_test_step import DriftTestStep
+	from drift.drift.doctype.drift_test_step_definition.drift_test_step_definition import (
+		DriftTestStepDefinition,
+	)
+
+# Claims of crashed executors expire after this many seconds
+CLAIM_TTL = 120
+
+# Tests whose run failed with an error are looked at again after this many seconds
+RETRY_AFTER_ERROR_SECONDS = 5
+
+
+class DriftTestExecutor:
+	"""
+	Runs many Drift Tests concurrently in one process with Playwright's async API.
+
+	Tests with the "Async Executor" execution mode are claimed through a lock in redis,
+	so several executors can run side by side. Each claimed test is driven by its own task
+	which runs the steps one after another, so steps of a test never run concurrently.
+
+	The event loop only drives the browsers. Database and other frappe work runs on a single
+	thread, as the connection to the database can't be used by two threads at once, and every
+	piece of work queued to it is a transaction of its own. Server Script steps are left to the
+	background jobs, as those use the sync API, and the test is picked up again as soon as the
+	job has moved the step cursor.
+	"""
+
+	claim_page_length = 100
+
+	def __init__(self, concurrency: int = 50, poll_interval: float = 1.0):
+		self.concurrency = concurrency
+		self.poll_interval = poll_interval
+		self.executor_id = frappe.generate_hash(length=12)
+		self.playwright: Playwright | None = None
+		self.tasks: dict[str, asyncio.Task] = {}
+		# Tests waiting on the background job of a step, with their step cursor when handed off
+		self.handed_off: dict[str, int] = {}
+		self.retry_after: dict[str, float] = {}
+		self.stopping: asyncio.Event | None = None
+		self.db_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="drift_executor_db")
+		# The work on the thread shares one context, so what it sets on frappe.local is kept
+		self.db_context = contextvars.copy_context()
+
+	def run(self):
+		try:
+			asyncio.run(self.main())
+		finally:
+			self.db_thread.shutdown()
+
+	async def main(self):
+		self.stopping = asyncio.Event()
+		loop = asyncio.get_running_loop()
+		for sig in (signal.SIGINT, signal.SIGTERM):
+			loop.add_signal_handler(sig, self.stopping.set)
+
+		async with async_playwright() as playwright:
+			self.playwright = playwright
+			while not self.stopping.is_set():
+				try:
+					await self.claim_tests()
+				except Exception:
+					await self.db(
+						frappe.log_error, "Drift executor failed to claim tests", traceback.format_exc()
+					)
+
+				with contextlib.suppress(asyncio.TimeoutError):
+					await asyncio.wait_for(self.stopping.wait(), timeout=self.poll_interval)
+
+			# Interrupted steps are not saved, those will be attempted again once the claims expire
+			for task in self.tasks.values():
+				task.cancel()
+			await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+	async def db(self, method: Callable, *args, **kwargs) -> Any:
+		"""Run `method` on the database thread as a transaction of its own"""
+		return await asyncio.get_running_loop().run_in_executor(
+			self.db_thread,
+			functools.partial(self.db_context.run, self.in_transaction, method, *args, **kwargs),
+		)
+
+	@staticmethod
+	def in_transaction(method: Callable, *args, **kwargs) -> Any:
+		try:
+			result = method(*args, **kwargs)
+		except BaseException:
+			frappe.db.rollback()
+			raise
+		frappe.db.commit()
+		return result
+
+	async def claim_tests(self):
+		free_slots = self.concurrency - len(self.tasks)
+		if free_slots <= 0:
+			return
+
+		now = time.monotonic()
+		self.retry_after = {name: until for name, until in self.retry_after.items() if until > now}
+		self.handed_off = await self.db(self.get_handed_off_tests, dict(self.handed_off))
+
+		exclude = [*self.tasks, *self.retry_after, *self.handed_off]
+		for name in await self.db(self.claim_queued_tests, free_slots, exclude):
+			task = asyncio.create_task(self.run_test(name))
+			task.add_done_callback(lambda _, name=name: self.tasks.pop(name, None))
+			self.tasks[name] = task
+
+	def get_handed_off_tests(self, handed_off: dict[str, int]) -> dict[str, int]:
+		"""Tests which are still waiting on the background job of their step"""
+		if not handed_off:
+			return {}
+		tests = frappe.get_all(
+			"Drift Test",
+			filters={"name": ("in", list(handed_off)), "status": "Running"},
+			fields=["name", "step_cursor"],
+		)
+		return {test.name: test.step_cursor for test in tests if test.step_cursor == handed_off[test.name]}
+
+	def claim_queued_tests(self, limit: int, exclude: list[str]) -> list[str]:
+		"""
+		Claim up to `limit` of the oldest running tests which no executor holds
+
+		Tests claimed by other executors are skipped over page by page, so every executor fills
+		its free slots however many tests the others hold.
+		"""
+		claimed = []
+		start = 0
+		while len(claimed) < limit:
+			names = get_queued_tests(exclude, start, self.claim_page_length)
+			for name in self.get_unclaimed(names):
+				if len(claimed) < limit and self.claim(name):
+					claimed.append(name)
+			if len(names) < self.claim_page_length:
+				break
+			start += self.claim_page_length
+		return claimed
+
+	async def run_test(self, name: str):
+		browser = None
+		# A single step can take longer than the claim lasts
+		heartbeat = asyncio.create_task(self.keep_claim(name))
+		try:
+			while not self.stopping.is_set():
+				test, step, step_definition = await self.db(self.load_step, name)
+				if not step:
+					break
+
+				if step_definition.type not in NATIVE_STEP_TYPES:
+					# Left to the background job queued by `DriftTest.next`
+					self.handed_off[name] = test.step_cursor
+					break
+
+				if step_definition.type == "Wait":
+					wait_seconds = await self.db(self.run_wait_step, test, step, step_definition)
+					if wait_seconds is None:
+						break
+					await self.sleep(wait_seconds)
+					continue
+
+				if step_definition.type in PAGELESS_STEP_TYPES:
+					await self.db(self.run_pageless_step, test, step, step_definition)
+					attempted_steps = [step]
+				else:
+					if not browser:
+						browser = await self.connect(test)
+
+					if step.parallel_group:
+						attempted_steps, step = await self.run_parallel_group(test, step, browser)
+					else:
+						await self.run_step(test, step, step_definition, browser)
+						attempted_steps = [step]
+
+				if not await self.db(self.complete_steps, test, step, attempted_steps):
+					break
+		except Exception:
+			self.retry_after[name] = time.monotonic() + RETRY_AFTER_ERROR_SECONDS
+			await self.db(
+				frappe.log_error, f"Drift executor failed to run test {name}", traceback.format_exc()
+			)
+		finally:
+			heartbeat.cancel()
+			if browser:
+				# Connected over CDP, so close() only disconnects from the remote browser
+				with contextlib.suppress(Exception):
+					await browser.close()
+			self.release(name)
+
+	def load_step(
+		self, name: str
+	) -> tuple["DriftTest", "DriftTestStep | None", "DriftTestStepDefinition | None"]:
+		"""Returns the test with its step to run next, without a step once the test is done"""
+		test: DriftTest = frappe.get_doc("Drift Test", name)
+		# The request to the agent would hold up the other tests
+		test.flags.destroy_session_in_background = True
+		if test.status != "Running":
+			return test, None, None
+
+		if frappe.db.get_value("Drift Session", test.session, "status") != "Active":
+			test.status = "Stopped"
+			test.persist()
+			return test, None, None
+
+		step = test.current_running_step or test.next_step
+		if not step:
+			test.finish()
+			return test, None, None
+
+		return test, step, frappe.get_doc("Drift Test Step Definition", step.step)
+
+	def run_wait_step(
+		self, test: "DriftTest", step: "DriftTestStep", step_definition: "DriftTestStepDefinition"
+	) -> float | None:
+		"""Returns the seconds to wait before the next step, None if the test was stopped meanwhile"""
+		test._run_wait_step(step, step_definition)
+		if not test.persist(step):
+			return None
+
+		if step.status == "Running":
+			return frappe.utils.time_diff_in_seconds(step.resume_at, frappe.utils.now_datetime())
+
+		# Queues a background job if the next step is a server script
+		test.next()
+		return 0
+
+	def run_pageless_step(
+		self, test: "DriftTest", step: "DriftTestStep", step_definition: "DriftTestStepDefinition"
+	):
+		safe_exec_locals = test._begin_attempt(step)
+		try:
+			safe_exec_locals["doc"] = test
+			safe_exec_locals["result"] = step_definition.execute_without_page(safe_exec_locals)
+			test._complete_attempt(step, step_definition, safe_exec_locals)
+		except Exception as e:
+			test._fail_attempt(step, e)
+		finally:
+			test._end_attempt(step)
+
+	async def run_step(
+		self,
+		test: "DriftTest",
+		step: "DriftTestStep",
+		step_definition: "DriftTestStepDefinition",
+		browser: Browser,
+	):
+		safe_exec_locals = await self.db(test._begin_attempt, step)
+		try:
+			pw_context = browser.contexts[0] if browser.contexts else await browser.new_context()
+			pw_page = pw_context.pages[0] if pw_context.pages else await pw_context.new_page()
+			safe_exec_locals.update({"pw_ctx": pw_context, "pw_page": pw_page, "doc": test})
+
+			# Rendering the call needs frappe, only the call itself runs on the event loop
+			call = await self.db(
+				step_definition.get_playwright_call, safe_exec_locals, test._get_elapsed_seconds(step)
+			)
+			if call:
+				with step_definition.handle_playwright_timeout():
+					await call(pw_page)
+			safe_exec_locals["result"] = (True, False)
+			await self.db(test._complete_attempt, step, step_definition, safe_exec_locals)
+		except Exception as e:
+			test._fail_attempt(step, e)
+		finally:
+			await self.db(test._end_attempt, step)
+
+	async def run_parallel_group(
+		self, test: "DriftTest", first: "DriftTestStep", browser: Browser
+	) -> tuple[list["DriftTestStep"], "DriftTestStep"]:
+		steps, branches, started_at = await self.db(self.prepare_parallel_group, test, first)
+		results = await run_branches(browser, branches)
+		return steps, await self.db(test._complete_parallel_group, steps, results, started_at)
+
+	def prepare_parallel_group(self, test: "DriftTest", first: "DriftTestStep") -> tuple[list, list, tuple]:
+		steps, branches = test._prepare_parallel_group(first)
+		return steps, branches, (frappe.utils.now_datetime(), time.monotonic())
+
+	def complete_steps(
+		self, test: "DriftTest", step: "DriftTestStep", attempted_steps: list["DriftTestStep"]
+	) -> bool:
+		"""Write the attempted steps, returns whether the test goes on"""
+		if step.status == "Failure":
+			test.finish(save=False)
+			test.persist(*attempted_steps)
+			return False
+
+		if not test.persist(*attempted_steps):
+			# Stopped or cancelled while the step ran
+			return False
+
+		# Queues a background job if the next step is a server script
+		test.next()
+		return True
+
+	async def connect(self, test: "DriftTest") -> Browser:
+		cdp_endpoint, headers = await self.db(self.get_connection_params, test)
+		return await self.playwright.chromium.connect_over_cdp(cdp_endpoint, headers=headers)
+
+	def get_connection_params(self, test: "DriftTest") -> tuple[str, dict]:
+		session = test.session_doc
+		return session.cdp_endpoint, {"Authorization": f"Bearer {session.get_password('session_token')}"}
+
+	async def sleep(self, seconds: float):
+		"""Wait, unless the executor is stopped meanwhile"""
+		with contextlib.suppress(asyncio.TimeoutError):
+			await asyncio.wait_for(self.stopping.wait(), timeout=max(seconds, 0))
+
+	async def keep_claim(self, name: str):
+		"""Refresh the claim of a test for as long as its task runs"""
+		while True:
+			with contextlib.suppress(Exception):
+				frappe.cache.expire(self.claim_key(name), CLAIM_TTL)
+			await asyncio.sleep(CLAIM_TTL / 4)
+
+	def get_unclaimed(self, names: list[str]) -> list[str]:
+		if not names:
+			return []
+		pipeline = frappe.cache.pipeline()
+		for name in names:
+			pipeline.exists(self.claim_key(name))
+		return [name for name, claimed in zip(names, pipeline.execute(), strict=True) if not claimed]
+
+	def claim(self, name: str) -> bool:
+		return bool(frappe.cache.set(self.claim_key(name), self.executor_id, nx=True, ex=CLAIM_TTL))
+
+	def release(self, name: str):
+		with contextlib.suppress(Exception):
+			key = self.claim_key(name)
+			if frappe.safe_decode(frappe.cache.get(key)) == self.executor_id:
+				frappe.cache.delete(key)
+
+	def claim_key(self, name: str) -> str:
+		return frappe.cache.make_key(f"drift_executor_claim|{name}")
+
+
+def get_queued_tests(
+	exclude: list[str] | None = None, start: int = 0, page_length: int = 100, run: bool = True
+) -> list[str] | str:
+	"""A page of the running tests of the async executor, oldest first"""
+	filters = [["status", "=", "Running"], ["execution_mode", "=", "Async Executor"]]
+	if exclude:
+		filters.append(["name", "not in", exclude])
+	return frappe.get_all(
+		"Drift Test",
+		filters=filters,
+		order_by="creation asc",
+		limit_start=start,
+		limit_page_length=page_length,
+		pluck="name",
+		run=run,
+	)
@@ -0,0 +1,133 @@
+# Copyright (c) 2025, Tanmoy and contributors
+# For license information, please see license.txt
+
+"""
+Parallel step groups
+
+Consecutive steps of a test with the same parallel group run at the same time. Steps of the group
+with the same branch run one after another, every branch in its own page of the session's browser
+context, so the branches share the logged-in state of the steps before the group. Every branch
+page starts at the URL the steps before the group left the test at, unless the branch starts by
+navigating itself. The step after the group starts once all the branches are done.
+
+Only steps which are a single Playwright call can be part of a group. Those calls are prepared
+upfront, as rendering those needs frappe, and the branches run on an event loop without it.
+"""
+
+import asyncio
+import time
+import traceback
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from playwright.async_api import async_playwright
+
+from drift.drift.doctype.drift_test_step_definition.drift_test_step_definition import (
+	DriftStepTimeoutError,
+	PlaywrightCall,
+)
+
+if TYPE_CHECKING:
+	from playwright.async_api import Browser
+
+	from drift.drift.doctype.drift_test_step.drift_test_step import DriftTestStep
+
+PARALLEL_STEP_TYPES = ("Playwright Action", "UI Navigation", "Playwright Wait")
+
+# A branch is a list of (step name, prepared call, timeout handler) to run in order
+Branch = list[tuple[str, PlaywrightCall | None, Callable]]
+
+
+def get_group_steps(steps: list["DriftTestStep"], first: "DriftTestStep") -> list["DriftTestStep"]:
+	"""Steps of the parallel group which starts at `first`"""
+	group = []
+	for step in steps[first.idx - 1 :]:
+		if step.parallel_group != first.parallel_group:
+			break
+		group.append(step)
+	return group
+
+
+def get_branches(steps: list["DriftTestStep"]) -> dict[str, list["DriftTestStep"]]:
+	"""Steps of a group by branch, steps without a branch are branches of their own"""
+	branches = {}
+	for step in steps:
+		branches.setdefault(step.parallel_branch or step.name, []).append(step)
+	return branches
+
+
+def run_branches_in_thread(cdp_endpoint: str, headers: dict, branches: list[Branch]) -> dict[str, dict]:
+	"""
+	Run the branches with their own connection to the browser, for the sync workers
+
+	The sync Playwright API of the worker can't be used from an event loop, so the branches run on
+	a loop of another thread.
+	"""
+
+	async def connect_and_run():
+		async with async_playwright() as playwright:
+			browser = await playwright.chromium.connect_over_cdp(cdp_endpoint, headers=headers)
+			try:
+				return await run_branches(browser, branches)
+			finally:
+				# Connected over CDP, so close() only disconnects from the remote browser
+				await browser.close()
+
+	with ThreadPoolExecutor(max_workers=1) as pool:
+		return pool.submit(asyncio.run, connect_and_run()).result()
+
+
+async def run_branches(browser: "Browser", branches: list[Branch]) -> dict[str, dict]:
+	"""
+	Run the branches concurrently, each in a new page of the browser context
+
+	A branch stops at its first failed step. Returns the results of the attempted steps by name,
+	with the times as seconds of `time.monotonic`.
+	"""
+	context = browser.contexts[0] if browser.contexts else await browser.new_context()
+	start_url = context.pages[0].url if context.pages else None
+	results = {}
+
+	async def run_branch(branch: Branch):
+		page = await context.new_page()
+		try:
+			for index, (name, call, handle_timeout) in enumerate(branch):
+				result = results[name] = {"started_at": time.monotonic(), "status": "Success"}
+				try:
+					if index == 0 and _needs_start_url(call, start_url):
+						await page.goto(start_url)
+					if call:
+						with handle_timeout():
+							await call(page)
+				except Exception as e:
+					result["status"] = "Failure"
+					if isinstance(e, DriftStepTimeoutError):
+						result["error"] = str(e)
+					else:
+						result["error"] = str(e).splitlines()[0][:120]
+						result["traceback"] = traceback.format_exc()
+				finally:
+					result["ended_at"] = time.monotonic()
+
+				if result["status"] == "Failure":
+					break
+		finally:
+			await page.close()
+
+	await asyncio.gather(*(_run_safely(run_branch(branch)) for branch in branches))
+	return results
+
+
+def _needs_start_url(first_call: PlaywrightCall | None, start_url: str | None) -> bool:
+	if not start_url or start_url == "about:blank":
+		return False
+	return not (first_call and first_call.method == "goto" and not first_call.locator)
+
+
+async def _run_safely(coroutine: Awaitable):
+	# A branch whose page couldn't be opened or closed shouldn't cancel the other branches
+	try:
+		await coroutine
+	except Exception:
+		pass
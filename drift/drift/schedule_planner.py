@@ -0,0 +1,204 @@
+# Copyright (c) 2025, Tanmoy and contributors
+# For license information, please see license.txt
+
+"""
+Spreads the scheduled runs of the test definitions over time
+
+Every definition runs at a stable phase of its interval, the minutes where
+`minutes since EPOCH % interval == schedule_offset_minutes`. Offsets are picked so the expected
+number of concurrent sessions stays level and within the capacity of the fleet, instead of all
+the definitions created together running in the same minute forever.
+
+Load is simulated over the least common multiple of the intervals, after which every schedule
+repeats. That is capped at MAX_HORIZON_MINUTES, the load of intervals which don't divide the cap is
+approximated by wrapping it around the end.
+"""
+
+import math
+from collections.abc import Iterable
+from datetime import datetime, timedelta
+
+import frappe
+from frappe.query_builder.functions import Avg
+
+# Phases are counted from this minute
+EPOCH = datetime(2025, 1, 1)
+
+# Longest period the load is simulated over
+MAX_HORIZON_MINUTES = 7 * 24 * 60
+
+# The forecast shows at least a day
+FORECAST_MINUTES = 24 * 60
+
+# Session duration assumed for definitions which haven't run yet
+DEFAULT_DURATION_MINUTES = 2
+
+
+def get_next_execution_on(after: datetime, interval: int, offset: int) -> datetime:
+	"""First minute of the definition's phase which is later than `after`"""
+	after = after.replace(second=0, microsecond=0)
+	minute = int((after - EPOCH).total_seconds() // 60)
+	wait = (offset - minute) % interval or interval
+	return after + timedelta(minutes=wait)
+
+
+def get_horizon(intervals: Iterable[int]) -> int:
+	"""Minutes after which the schedules of all the intervals repeat, at most MAX_HORIZON_MINUTES"""
+	horizon = 1
+	for interval in intervals:
+		horizon = math.lcm(horizon, interval)
+		if horizon > MAX_HORIZON_MINUTES:
+			return MAX_HORIZON_MINUTES
+	return horizon
+
+
+def assign_offset(definition: str, interval: int) -> int:
+	"""Offset with the least load for a definition, against the current schedule of the others"""
+	definitions = [d for d in _get_scheduled_definitions() if d.name != definition]
+	durations = _get_durations([d.name for d in definitions] + [definition])
+	load = [0] * get_horizon([interval, *(d.interval_minutes for d in definitions)])
+	for d in definitions:
+		_add_load(load, d.interval_minutes, d.schedule_offset_minutes or 0, durations[d.name])
+	return _choose_offset(load, interval, durations[definition], _get_capacity())
+
+
+@frappe.whitelist()
+def rebalance_schedule_offsets() -> dict:
+	"""
+	Pick the offsets of all the enabled definitions again, the largest demands first
+
+	Offsets are kept within the capacity of the fleet where possible, the definitions which don't
+	fit at any offset are returned as `over_capacity`.
+	"""
+	frappe.only_for("System Manager")
+
+	definitions = _get_scheduled_definitions()
+	durations = _get_durations([d.name for d in definitions])
+	definitions.sort(key=lambda d: durations[d.name] / d.interval_minutes, reverse=True)
+
+	capacity = _get_capacity()
+	load = [0] * get_horizon(d.interval_minutes for d in definitions)
+	now = frappe.utils.now_datetime()
+	updates = {}
+	over_capacity = []
+	for d in definitions:
+		offset = _choose_offset(load, d.interval_minutes, durations[d.name], capacity)
+		_add_load(load, d.interval_minutes, offset, durations[d.name])
+		if capacity and max(_get_run_load(load, d.interval_minutes, offset, durations[d.name])) > capacity:
+			over_capacity.append(d.name)
+		if offset != d.schedule_offset_minutes:
+			updates[d.name] = {
+				"schedule_offset_minutes": offset,
+				"next_execution_on": get_next_execution_on(now, d.interval_minutes, offset),
+			}
+
+	if updates:
+		frappe.db.bulk_update("Drift Test Definition", updates, update_modified=False)
+
+	return {"rescheduled": len(updates), "over_capacity": over_capacity, **get_schedule_forecast()}
+
+
+@frappe.whitelist()
+def get_schedule_forecast() -> dict:
+	"""
+	Expected concurrent sessions of the current schedules, over a day or the period after which
+	the schedules repeat if that is longer
+
+	returns the peak, the fleet capacity and the peak load of every bucket of the period
+	"""
+	frappe.only_for("System Manager")
+
+	definitions = _get_scheduled_definitions()
+	durations = _get_durations([d.name for d in definitions])
+	load = [0] * get_horizon(d.interval_minutes for d in definitions)
+	for d in definitions:
+		_add_load(load, d.interval_minutes, d.schedule_offset_minutes or 0, durations[d.name])
+
+	# Load repeats every horizon, so a shorter one is repeated over the day
+	minutes = max(len(load), FORECAST_MINUTES)
+	bucket_minutes = 10 * math.ceil(minutes / FORECAST_MINUTES)
+	return {
+		"peak": max(load),
+		"average": sum(load) / len(load),
+		"capacity": _get_capacity(),
+		"horizon_minutes": minutes,
+		"bucket_minutes": bucket_minutes,
+		"buckets": [
+			max(load[minute % len(load)] for minute in range(start, min(start + bucket_minutes, minutes)))
+			for start in range(0, minutes, bucket_minutes)
+		],
+	}
+
+
+def _get_scheduled_definitions() -> list[frappe._dict]:
+	return frappe.get_all(
+		"Drift Test Definition",
+		filters={"enabled": 1, "interval_minutes": (">", 0)},
+		fields=["name", "interval_minutes", "schedule_offset_minutes"],
+	)
+
+
+def _get_capacity() -> int:
+	return sum(
+		server.max_sessions or 0
+		for server in frappe.get_cached_doc("Drift Settings").servers
+		if server.status != "Disabled"
+	)
+
+
+def _get_durations(definitions: list[str]) -> dict[str, int]:
+	"""Average session duration in minutes of the recent tests of the definitions"""
+	durations = dict.fromkeys(definitions, DEFAULT_DURATION_MINUTES)
+	if not definitions:
+		return durations
+
+	DRIFT_TEST = frappe.qb.DocType("Drift Test")
+	DRIFT_SESSION = frappe.qb.DocType("Drift Session")
+	for definition, seconds in (
+		frappe.qb.from_(DRIFT_TEST)
+		.join(DRIFT_SESSION)
+		.on(DRIFT_SESSION.name == DRIFT_TEST.session)
+		.select(DRIFT_TEST.definition, Avg(DRIFT_SESSION.duration))
+		.where(DRIFT_TEST.definition.isin(definitions))
+		.where(DRIFT_TEST.creation > frappe.utils.add_days(None, -7))
+		.where(DRIFT_SESSION.duration > 0)
+		.groupby(DRIFT_TEST.definition)
+	).run():
+		if seconds:
+			durations[definition] = max(1, round(float(seconds) / 60))
+	return durations
+
+
+def _get_run_minutes(horizon: int, interval: int, offset: int, duration: int) -> Iterable[int]:
+	"""Minutes of the horizon in which a run of the definition is in progress"""
+	# Intervals beyond the horizon still run once, wrapped into it
+	first = offset % interval
+	for start in range(first, max(horizon, first + 1), interval):
+		for minute in range(start, start + min(duration, interval)):
+			yield minute % horizon
+
+
+def _get_run_load(load: list[int], interval: int, offset: int, duration: int) -> list[int]:
+	return [load[minute] for minute in _get_run_minutes(len(load), interval, offset, duration)]
+
+
+def _add_load(load: list[int], interval: int, offset: int, duration: int):
+	for minute in _get_run_minutes(len(load), interval, offset, duration):
+		load[minute] += 1
+
+
+def _choose_offset(load: list[int], interval: int, duration: int, capacity: int = 0) -> int:
+	"""
+	Offset which keeps the load lowest
+
+	Offsets are compared by the session minutes they would add beyond the `capacity` of the fleet,
+	then by the peak load and then by the total load they add to.
+	"""
+	best_offset, best_cost = 0, None
+	for offset in range(interval):
+		run_load = _get_run_load(load, interval, offset, duration)
+		overflow = sum(max(0, value + 1 - capacity) for value in run_load) if capacity else 0
+		cost = (overflow, max(run_load, default=0), sum(run_load))
+		if best_cost is None or cost < best_cost:
+			best_offset, best_cost = offset, cost
+	return best_offset
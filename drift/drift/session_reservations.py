@@ -0,0 +1,119 @@
+# Copyright (c) 2025, Tanmoy and contributors
+# For license information, please see license.txt
+
+"""
+Capacity of the Drift Servers, tracked in redis
+
+Every server has a sorted set of reservations, scored by the time those expire. A reservation is
+taken before a session is created on the server. It starts as a short lived pending reservation,
+so it expires on its own if the creation fails, and is confirmed under the name of the session
+once it is created. Confirmed reservations are released when the session stops, and are kept in
+sync with the active sessions by the fleet poller.
+"""
+
+import time
+
+import frappe
+
+# Pending reservations expire after these many seconds, if those are not confirmed
+PENDING_RESERVATION_TTL = 120
+
+# Confirmed reservations are refreshed by every fleet poller tick, these expire only if that stops
+CONFIRMED_RESERVATION_TTL = 6 * 60 * 60
+
+PENDING_PREFIX = "pending|"
+
+# Picks the least loaded server relative to its capacity and reserves a slot on it.
+# KEYS are the reservations of the servers, ARGV are now, the expiry, the token
+# and the capacities of the servers in the same order as KEYS.
+RESERVE_SCRIPT = """
+	local best, best_load = -1, nil
+	for index, key in ipairs(KEYS) do
+		redis.call("ZREMRANGEBYSCORE", key, "-inf", ARGV[1])
+		local capacity = tonumber(ARGV[index + 3])
+		local count = redis.call("ZCARD", key)
+		if count < capacity then
+			local load = count / capacity
+			if best_load == nil or load < best_load then
+				best, best_load = index, load
+			end
+		end
+	end
+	if best == -1 then
+		return -1
+	end
+	redis.call("ZADD", KEYS[best], ARGV[2], ARGV[3])
+	return best - 1
+"""
+
+
+def reserve(capacities: dict[str, int]) -> tuple[str, str] | None:
+	"""
+	Reserve a slot on the least loaded server, `capacities` maps the servers to their capacity
+
+	returns the server and the token of the pending reservation,
+	or None if all the servers are at capacity
+	"""
+	servers = [server for server, capacity in capacities.items() if capacity > 0]
+	if not servers:
+		return None
+
+	token = f"{PENDING_PREFIX}{frappe.generate_hash(length=16)}"
+	now = time.time()
+	index = frappe.cache.eval(
+		RESERVE_SCRIPT,
+		len(servers),
+		*[get_key(server) for server in servers],
+		now,
+		now + PENDING_RESERVATION_TTL,
+		token,
+		*[capacities[server] for server in servers],
+	)
+	if index < 0:
+		return None
+	return servers[index], token
+
+
+def confirm(server: str, token: str, session: str):
+	"""Replace the pending reservation by one for the created session"""
+	pipeline = frappe.cache.pipeline()
+	pipeline.zrem(get_key(server), token)
+	pipeline.zadd(get_key(server), {session: time.time() + CONFIRMED_RESERVATION_TTL})
+	pipeline.execute()
+
+
+def release(server: str, *members: str):
+	"""Release the reservations of sessions or pending reservations"""
+	if server and members:
+		frappe.cache.zrem(get_key(server), *members)
+
+
+def sync(active_sessions: dict[str, list[str]]):
+	"""
+	Make the confirmed reservations match the active sessions of the servers
+
+	Pending reservations are left as they are, those expire on their own.
+	"""
+	expires_on = time.time() + CONFIRMED_RESERVATION_TTL
+	pipeline = frappe.cache.pipeline()
+	for server, sessions in active_sessions.items():
+		key = get_key(server)
+		stale = [
+			member
+			for member in map(frappe.safe_decode, frappe.cache.zrange(key, 0, -1))
+			if not member.startswith(PENDING_PREFIX) and member not in sessions
+		]
+		if stale:
+			pipeline.zrem(key, *stale)
+		if sessions:
+			pipeline.zadd(key, dict.fromkeys(sessions, expires_on))
+	pipeline.execute()
+
+
+def get_usage(servers: list[str]) -> dict[str, int]:
+	now = time.time()
+	return {server: frappe.cache.zcount(get_key(server), now, "+inf") for server in servers}
+
+
+def get_key(server: str) -> str:
+	return frappe.cache.make_key(f"drift_session_reservations|{server}")
@@ -1,6 +1,34 @@
+import functools
+import hashlib
+import time
+from collections import OrderedDict
+from collections.abc import Hashable
+from contextlib import contextmanager
+from typing import Any
+
 import frappe
 from frappe.auth import CookieManager, LoginManager
 from frappe.utils import set_request
+from frappe.utils.safe_exec import safe_exec
+
+try:
+	# Internals of frappe's safe_exec (frappe 15), used to run the code compiled once
+	from frappe.utils.safe_exec import (
+		SAFE_EXEC_FILENAME,
+		FrappeTransformer,
+		ServerScriptNotEnabled,
+		compile_restricted,
+		get_safe_globals,
+		is_safe_exec_enabled,
+		patched_qb,
+		safe_exec_flags,
+	)
+
+	SAFE_EXEC_INTERNALS_AVAILABLE = True
+except ImportError:
+	SAFE_EXEC_INTERNALS_AVAILABLE = False
+
+from drift.drift.variable_store import VariableStore
 
 
 def prepare_safe_exec_locals(variables: dict) -> dict:
@@ -10,7 +38,10 @@ def prepare_safe_exec_locals(variables: dict) -> dict:
 
 	from playwright import sync_api
 
-	locals_data = {"variables": frappe._dict(variables or {})}
+	# The variable store of a test is passed as is, so it can track what the code changes
+	locals_data = {
+		"variables": variables if isinstance(variables, VariableStore) else frappe._dict(variables or {})
+	}
 
 	locals_data["pw"] = frappe._dict(
 		{attr: getattr(sync_api, attr) for attr in sync_api.__all__ if not attr.startswith("_")}
@@ -36,3 +67,238 @@ def get_login_sid(user: str) -> str | None:
 		return None
 	finally:
 		frappe.set_user(current_user)
+
+
+def record_stats(name: str, **values: float):
+	"""Increment the counters of a stats bucket shared by all the workers of the site"""
+	try:
+		key = frappe.cache.make_key(f"drift_stats|{name}")
+		pipeline = frappe.cache.pipeline()
+		for field, value in values.items():
+			pipeline.hincrbyfloat(key, field, value)
+		pipeline.execute()
+	except Exception:
+		# Stats are best effort, never fail the caller because of those
+		pass
+
+
+def get_stats(name: str) -> dict:
+	key = frappe.cache.make_key(f"drift_stats|{name}")
+	# Read raw like `record_stats` writes, `frappe.cache.hgetall` would prefix the key again and unpickle
+	(values,) = frappe.cache.pipeline().hgetall(key).execute()
+	return {frappe.safe_decode(field): float(value) for field, value in (values or {}).items()}
+
+
+def reset_stats(name: str):
+	frappe.cache.delete(frappe.cache.make_key(f"drift_stats|{name}"))
+
+
+class RedisSemaphore:
+	"""
+	Semaphore shared by all the workers of the site
+
+	Slots are leases which expire on their own, so slots of crashed workers are freed eventually.
+	The key is computed upfront, so the semaphore can be used from other threads.
+	"""
+
+	ACQUIRE_SCRIPT = """
+		redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", ARGV[1])
+		if redis.call("ZCARD", KEYS[1]) < tonumber(ARGV[2]) then
+			redis.call("ZADD", KEYS[1], ARGV[3], ARGV[4])
+			redis.call("EXPIRE", KEYS[1], ARGV[5])
+			return 1
+		end
+		return 0
+	"""
+
+	def __init__(self, name: str, limit: int, lease_seconds: int = 3600):
+		self.cache = frappe.cache
+		self.key = frappe.cache.make_key(f"drift_semaphore|{name}")
+		self.limit = limit
+		self.lease_seconds = lease_seconds
+
+	def acquire(self, poll_interval: float = 1.0) -> str:
+		token = frappe.generate_hash(length=16)
+		while True:
+			now = time.time()
+			acquired = self.cache.eval(
+				self.ACQUIRE_SCRIPT,
+				1,
+				self.key,
+				now,
+				self.limit,
+				now + self.lease_seconds,
+				token,
+				self.lease_seconds,
+			)
+			if acquired:
+				return token
+			time.sleep(poll_interval)
+
+	def release(self, token: str):
+		self.cache.zrem(self.key, token)
+
+	@contextmanager
+	def slot(self):
+		token = self.acquire()
+		try:
+			yield
+		finally:
+			self.release(token)
+
+
+class RateLimiter:
+	"""
+	Limits the units (bytes, launches...) consumed per second by all the workers of the site,
+	with one second windows
+
+	The key is computed upfront, so the limiter can be used from other threads.
+	"""
+
+	def __init__(self, name: str, limit_per_second: int):
+		self.cache = frappe.cache
+		self.key = frappe.cache.make_key(f"drift_rate_limit|{name}")
+		self.limit_per_second = limit_per_second
+
+	def consume(self, units: int = 1):
+		while True:
+			now = time.time()
+			key = f"{self.key}|{int(now)}"
+			pipeline = self.cache.pipeline()
+			pipeline.incrby(key, units)
+			pipeline.expire(key, 2)
+			used, _ = pipeline.execute()
+			if used <= self.limit_per_second or used == units:
+				# Units larger than the limit are let through in an empty window
+				return
+
+			# Window is full, give back the units and retry in the next window
+			self.cache.decrby(key, units)
+			time.sleep(1 - (now % 1))
+
+
+class LRUCache:
+	"""
+	Bounded, worker local LRU cache which records its hits and misses in a stats bucket
+
+	Hits and misses are counted locally and added to the bucket at most every
+	`stats_flush_interval` seconds, so lookups don't wait on redis.
+	"""
+
+	stats_flush_interval = 30
+
+	def __init__(self, name: str, maxsize: int = 256):
+		self.name = name
+		self.maxsize = maxsize
+		self.data: OrderedDict[Hashable, Any] = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.stats_flushed_on = time.monotonic()
+
+	def get(self, key: Hashable) -> Any:
+		value = None
+		if key in self.data:
+			self.data.move_to_end(key)
+			self.hits += 1
+			value = self.data[key]
+		else:
+			self.misses += 1
+
+		if time.monotonic() - self.stats_flushed_on >= self.stats_flush_interval:
+			self.flush_stats()
+		return value
+
+	def flush_stats(self):
+		if self.hits or self.misses:
+			record_stats(self.name, hits=self.hits, misses=self.misses)
+		self.hits = self.misses = 0
+		self.stats_flushed_on = time.monotonic()
+
+	def set(self, key: Hashable, value: Any):
+		self.data[key] = value
+		self.data.move_to_end(key)
+		while len(self.data) > self.maxsize:
+			self.data.popitem(last=False)
+
+	def discard(self, prefix: Hashable):
+		"""Drop all the entries whose tuple key starts with `prefix`"""
+		for key in [k for k in self.data if isinstance(k, tuple) and k and k[0] == prefix]:
+			del self.data[key]
+
+	def clear(self):
+		self.data.clear()
+
+
+jinja_template_cache = LRUCache("jinja_template_cache", maxsize=512)
+compiled_code_cache = LRUCache("compiled_code_cache", maxsize=256)
+
+
+def get_source_hash(source: str) -> str:
+	return hashlib.sha1(source.encode()).hexdigest()
+
+
+def render_template_cached(template: str, context: dict, cache_key: tuple) -> str:
+	"""
+	Render a jinja template like frappe's render_template, the compiled code of the template
+	is cached against the `cache_key` along with the hash of the template
+
+	Only the code is cached. The template is built on the jinja environment of the current
+	request or job, as the globals of the environment are bound to those.
+	"""
+	from frappe.utils.jinja import get_jenv
+	from jinja2 import TemplateError
+
+	if not template:
+		return ""
+
+	if ".__" in template:
+		frappe.throw("Illegal template")
+
+	jenv = get_jenv()
+	key = (*cache_key, get_source_hash(template))
+	try:
+		code = jinja_template_cache.get(key)
+		if code is None:
+			code = jenv.compile(template)
+			jinja_template_cache.set(key, code)
+		return jenv.template_class.from_code(jenv, code, jenv.make_globals(None)).render(context)
+	except TemplateError:
+		frappe.throw(
+			title="Jinja Template Error",
+			msg=f"<pre>{template}</pre><pre>{frappe.get_traceback()}</pre>",
+		)
+
+
+def safe_exec_cached(script: str, _locals: dict, cache_key: tuple):
+	"""
+	Same as frappe's safe_exec, but the code compiled by RestrictedPython
+	is cached against the `cache_key` along with the hash of the script
+
+	Falls back to safe_exec, which compiles the code on every call, on versions of frappe
+	without its internals.
+	"""
+	if not SAFE_EXEC_INTERNALS_AVAILABLE:
+		_warn_safe_exec_fallback()
+		return safe_exec(script, _locals=_locals)
+
+	# Same checks as safe_exec, so the errors are the same too
+	if not is_safe_exec_enabled():
+		frappe.throw(frappe._("Please Enable Server Scripts"), ServerScriptNotEnabled)
+
+	key = (*cache_key, get_source_hash(script))
+	code = compiled_code_cache.get(key)
+	if code is None:
+		code = compile_restricted(script, filename=SAFE_EXEC_FILENAME, policy=FrappeTransformer)
+		compiled_code_cache.set(key, code)
+
+	exec_globals = get_safe_globals()
+	with safe_exec_flags(), patched_qb():
+		exec(code, exec_globals, _locals)
+	return exec_globals, _locals
+
+
+@functools.cache
+def _warn_safe_exec_fallback():
+	frappe.logger("drift").warning(
+		"Internals of frappe's safe_exec are not available, code of the steps is compiled on every run"
+	)
@@ -0,0 +1,182 @@
+# Copyright (c) 2025, Tanmoy and contributors
+# For license information, please see license.txt
+
+"""
+Variables of a Drift Test
+
+Variables are stored on the test as compact JSON. Values which are larger than OFFLOAD_BYTES when
+serialized are written to private files attached to the test, the JSON only keeps a reference to
+the file, which is loaded on first access.
+
+The store tracks what a step could have changed: keys which were set or deleted, and keys whose
+dicts or lists were handed out, as those can be changed in place. Nothing is serialized again if a
+step only read scalars.
+"""
+
+import hashlib
+import json
+from typing import Any
+
+import frappe
+
+# Serialized values larger than this are offloaded to files
+OFFLOAD_BYTES = 64 * 1024
+
+# Key of the reference stored instead of an offloaded value
+FILE_REFERENCE_KEY = "$drift_file"
+
+
+class VariableStore(frappe._dict):
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		# Set on the instance, as attributes of `frappe._dict` are its keys
+		object.__setattr__(self, "_changed", set(self.keys()))
+		object.__setattr__(self, "_touched", set())
+		object.__setattr__(self, "_references", {})
+
+	@classmethod
+	def loads(cls, raw: str | None) -> "VariableStore":
+		"""Store of serialized variables, nothing is marked as changed"""
+		try:
+			store = cls(json.loads(raw) if raw else {})
+		except json.JSONDecodeError:
+			store = cls()
+		store._changed.clear()
+		return store
+
+	def __getitem__(self, key):
+		value = super().__getitem__(key)
+		if _is_reference(value):
+			self._references[key] = value
+			value = json.loads(frappe.get_doc("File", value[FILE_REFERENCE_KEY]).get_content())
+			super().__setitem__(key, value)
+		if isinstance(value, dict | list):
+			self._touched.add(key)
+		return value
+
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	__getattr__ = get
+
+	def __setitem__(self, key, value):
+		self._replace(key)
+		super().__setitem__(key, value)
+
+	__setattr__ = __setitem__
+
+	def __delitem__(self, key):
+		self._replace(key)
+		super().__delitem__(key)
+
+	__delattr__ = __delitem__
+
+	def setdefault(self, key, default=None):
+		if key not in self:
+			self[key] = default
+		return self[key]
+
+	def pop(self, key, *default):
+		if key in self:
+			value = self[key]
+			del self[key]
+			return value
+		return super().pop(key, *default)
+
+	def popitem(self):
+		key = next(reversed(self.keys()))
+		return key, self.pop(key)
+
+	def update(self, *args, **kwargs):
+		for key, value in dict(*args, **kwargs).items():
+			self[key] = value
+		return self
+
+	def clear(self):
+		for key in list(self.keys()):
+			del self[key]
+
+	def items(self):
+		return [(key, self[key]) for key in self.keys()]
+
+	def values(self):
+		return [self[key] for key in self.keys()]
+
+	def copy(self) -> dict:
+		return dict(self.items())
+
+	def _replace(self, key):
+		# Files of offloaded values which were never loaded are deleted once the value is replaced
+		value = dict.get(self, key)
+		if _is_reference(value):
+			self._references[key] = value
+		self._changed.add(key)
+
+	@property
+	def is_dirty(self) -> bool:
+		return bool(self._changed or self._touched)
+
+	def dumps(self, test: str) -> str:
+		"""
+		Compact JSON of the variables, large changed values are offloaded to files attached to the test
+
+		Files of values which were replaced are deleted.
+		"""
+		serialized, replaced = {}, []
+		for key in self.keys():
+			value = dict.__getitem__(self, key)
+			if _is_reference(value):
+				# Never loaded, so unchanged
+				serialized[key] = value
+				continue
+
+			reference = self._references.get(key)
+			if reference and key not in self._changed and key not in self._touched:
+				serialized[key] = reference
+				continue
+
+			content = json.dumps(value, separators=(",", ":"))
+			if len(content) <= OFFLOAD_BYTES:
+				serialized[key] = value
+				continue
+
+			content_hash = hashlib.md5(content.encode()).hexdigest()
+			if reference and reference.get("hash") == content_hash:
+				serialized[key] = reference
+			else:
+				if reference:
+					replaced.append(reference)
+				serialized[key] = self._references[key] = _offload(test, key, content, content_hash)
+
+		for key, reference in list(self._references.items()):
+			if serialized.get(key) is not reference:
+				replaced.append(reference)
+				del self._references[key]
+
+		for reference in replaced:
+			frappe.delete_doc("File", reference[FILE_REFERENCE_KEY], ignore_permissions=True, force=True)
+
+		self._changed.clear()
+		self._touched.clear()
+		return json.dumps(serialized, separators=(",", ":"))
+
+
+def _is_reference(value: Any) -> bool:
+	return isinstance(value, dict) and FILE_REFERENCE_KEY in value
+
+
+def _offload(test: str, key: str, content: str, content_hash: str) -> dict:
+	file = frappe.get_doc(
+		{
+			"doctype": "File",
+			"file_name": f"{test}-{key}.json",
+			"attached_to_doctype": "Drift Test",
+			"attached_to_name": test,
+			"is_private": True,
+			"content": content,
+		}
+	).insert(ignore_permissions=True)
+	return {FILE_REFERENCE_KEY: file.name, "hash": content_hash, "size": len(content)}
@@ -0,0 +1,190 @@
+# Copyright (c) 2025, Tanmoy and contributors
+# For license information, please see license.txt
+
+import time
+from collections.abc import Iterator
+from typing import TYPE_CHECKING
+
+import frappe
+from frappe.query_builder import Order
+from frappe.query_builder.functions import Coalesce, Max, Sum
+
+from drift.drift.utils import record_stats
+
+if TYPE_CHECKING:
+	from drift.drift.doctype.drift_session.drift_session import DriftSession
+
+# Videos of these many tests are looked at per query while evicting
+EVICTION_BATCH_SIZE = 100
+
+
+class RetentionTimeBudgetExceeded(Exception):
+	pass
+
+
+def apply_video_retention():
+	"""
+	Delete downloaded videos according to the retention rules
+
+	Rules of the test definitions are applied first, then the least recently viewed videos are
+	deleted until the downloaded videos fit in the storage budget of Drift Settings. The used
+	storage is the sum of the sizes recorded on the video rows, so the files are never scanned.
+
+	Videos are deleted per test, as a reused session holds the videos of several tests. Only the
+	videos already purged from the agent are deleted, so those are never left on the agent alone.
+
+	Runs under a time budget, whatever is left is deleted by the next run.
+	"""
+	deadline = time.monotonic() + (frappe.conf.drift_video_retention_time_budget or 60)
+	try:
+		for definition in frappe.get_all(
+			"Drift Test Definition",
+			or_filters={
+				"keep_last_failed_videos": (">", 0),
+				"keep_last_successful_videos": (">", 0),
+				"delete_videos_after_days": (">", 0),
+			},
+			fields=[
+				"name",
+				"keep_last_failed_videos",
+				"keep_last_successful_videos",
+				"delete_videos_after_days",
+			],
+		):
+			for status, keep in (
+				("Failure", definition.keep_last_failed_videos),
+				("Success", definition.keep_last_successful_videos),
+			):
+				if keep:
+					evict_videos(_get_tests_beyond_last(definition.name, status, keep), deadline)
+
+			if definition.delete_videos_after_days:
+				evict_videos(
+					_get_tests_older_than(definition.name, definition.delete_videos_after_days), deadline
+				)
+
+		budget_gb = frappe.db.get_single_value("Drift Settings", "video_storage_budget_gb")
+		if budget_gb:
+			budget = budget_gb * 1024 * 1024 * 1024
+			used = get_video_storage_used()
+			if used > budget:
+				evict_videos(_get_least_recently_viewed_tests(), deadline, bytes_to_free=used - budget)
+	except RetentionTimeBudgetExceeded:
+		pass
+
+
+def evict_videos(
+	tests: Iterator[tuple[str, str | None, int]], deadline: float, bytes_to_free: int | None = None
+):
+	"""
+	Delete the downloaded videos of the (session, test) pairs, until enough bytes are freed if a
+	limit is given. Videos synced before those were assigned to the tests have no test.
+	"""
+	freed = 0
+	for session, test, size in tests:
+		if bytes_to_free is not None and freed >= bytes_to_free:
+			return
+		if time.monotonic() > deadline:
+			raise RetentionTimeBudgetExceeded
+
+		try:
+			session_doc: DriftSession = frappe.get_doc("Drift Session", session)
+			session_doc._delete_downloaded_videos(
+				[video for video in session_doc.videos if (video.test or None) == test]
+			)
+			frappe.db.commit()
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(f"Failed to delete videos of test {test} of session {session}")
+			continue
+
+		freed += size or 0
+		record_stats("video_retention", evicted_tests=1, freed_bytes=size or 0)
+
+
+def get_video_storage_used() -> int:
+	DRIFT_SESSION_VIDEO = frappe.qb.DocType("Drift Session Video")
+	result = (
+		frappe.qb.from_(DRIFT_SESSION_VIDEO)
+		.select(Sum(DRIFT_SESSION_VIDEO.file_size))
+		.where(DRIFT_SESSION_VIDEO.status == "Downloaded")
+	).run()
+	return int(result[0][0] or 0)
+
+
+@frappe.whitelist()
+def get_video_storage_usage() -> dict:
+	frappe.only_for("System Manager")
+
+	budget_gb = frappe.db.get_single_value("Drift Settings", "video_storage_budget_gb") or 0
+	return {
+		"used_bytes": get_video_storage_used(),
+		"budget_bytes": int(budget_gb * 1024 * 1024 * 1024),
+	}
+
+
+def _get_tests_beyond_last(definition: str, status: str, keep: int) -> Iterator[tuple[str, str, int]]:
+	DRIFT_TEST = frappe.qb.DocType("Drift Test")
+	query = (
+		_downloaded_videos_query()
+		.join(DRIFT_TEST)
+		.on(DRIFT_TEST.name == frappe.qb.DocType("Drift Session Video").test)
+		.where(DRIFT_TEST.definition == definition)
+		.where(DRIFT_TEST.status == status)
+		.orderby(Max(DRIFT_TEST.creation), order=Order.desc)
+	)
+	# Videos of the newest `keep` tests are always skipped
+	return _iterate(query, offset=keep)
+
+
+def _get_tests_older_than(definition: str, days: int) -> Iterator[tuple[str, str, int]]:
+	DRIFT_TEST = frappe.qb.DocType("Drift Test")
+	query = (
+		_downloaded_videos_query()
+		.join(DRIFT_TEST)
+		.on(DRIFT_TEST.name == frappe.qb.DocType("Drift Session Video").test)
+		.where(DRIFT_TEST.definition == definition)
+		.where(DRIFT_TEST.creation < frappe.utils.add_days(frappe.utils.now_datetime(), -days))
+		.orderby(Max(DRIFT_TEST.creation))
+	)
+	return _iterate(query)
+
+
+def _get_least_recently_viewed_tests() -> Iterator[tuple[str, str | None, int]]:
+	DRIFT_SESSION = frappe.qb.DocType("Drift Session")
+	DRIFT_SESSION_VIDEO = frappe.qb.DocType("Drift Session Video")
+	query = (
+		_downloaded_videos_query()
+		.orderby(Max(Coalesce(DRIFT_SESSION.last_viewed_on, DRIFT_SESSION.ended_on)))
+		.orderby(Max(DRIFT_SESSION_VIDEO.creation))
+	)
+	return _iterate(query)
+
+
+def _downloaded_videos_query():
+	DRIFT_SESSION = frappe.qb.DocType("Drift Session")
+	DRIFT_SESSION_VIDEO = frappe.qb.DocType("Drift Session Video")
+	return (
+		frappe.qb.from_(DRIFT_SESSION_VIDEO)
+		.join(DRIFT_SESSION)
+		.on(DRIFT_SESSION.name == DRIFT_SESSION_VIDEO.parent)
+		.select(DRIFT_SESSION_VIDEO.parent, DRIFT_SESSION_VIDEO.test, Sum(DRIFT_SESSION_VIDEO.file_size))
+		.where(DRIFT_SESSION_VIDEO.status == "Downloaded")
+		# The agent still has the videos of the sessions which are not purged yet
+		.where(DRIFT_SESSION.purged_videos_from_server == 1)
+		.groupby(DRIFT_SESSION_VIDEO.parent, DRIFT_SESSION_VIDEO.test)
+	)
+
+
+def _iterate(query, offset: int = 0) -> Iterator[tuple[str, str | None, int]]:
+	# Evicted tests drop out of the query, tests which failed to be evicted show up again. Those
+	# are skipped, and the offset is moved past them so the tests after those are still read.
+	seen = set()
+	while True:
+		rows = query.limit(EVICTION_BATCH_SIZE).offset(offset).run()
+		if not rows:
+			return
+		batch = [row for row in rows if (row[0], row[1]) not in seen]
+		offset += len(rows) - len(batch)
+		seen.update((row[0], row[1]) for row in batch)
+		yield from batch
@@ -148,17 +148,21 @@ scheduler_events = {
 	"hourly": [],
 	"cron": {
 		"* * * * * 0/5": [
-			"drift.drift.doctype.drift_settings.drift_settings.sync_servers",
-			"drift.drift.doctype.drift_settings.drift_settings.sync_sessions",
+			"drift.drift.doctype.drift_settings.drift_settings.poll_fleet",
+			"drift.drift.doctype.drift_test.drift_test.resume_deferred_steps",
 		],
 		"*/5 * * * *": [
 			"drift.drift.doctype.drift_session.drift_session.trigger_sync_video_ids_and_download",
+			"drift.drift.video_retention.apply_video_retention",
 		],
 		"* * * * *": [
 			"drift.drift.doctype.drift_session.drift_session.sync_video_download_status",
 			"drift.drift.doctype.drift_session_video.drift_session_video.download_session_videos",
 			"drift.drift.doctype.drift_session.drift_session.purge_downloaded_remote_videos",
 			"drift.drift.doctype.drift_test_definition.drift_test_definition.auto_trigger_tests",
+			"drift.drift.doctype.drift_settings.drift_settings.fill_warm_pools",
+			"drift.drift.doctype.drift_test_definition.drift_test_definition.destroy_expired_reusable_sessions",
+			"drift.drift.doctype.drift_test_run.drift_test_run.launch_queued_shards",
             "drift.drift.doctype.drift_test.drift_test.bulk_garbage_collect_tests",
             "drift.drift.doctype.drift_test.drift_test.bulk_cleanup_tests",
 		],
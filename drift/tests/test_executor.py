@@ -0,0 +1,88 @@
+# Copyright (c) 2025, Tanmoy and Contributors
+# See license.txt
+
+import asyncio
+from unittest.mock import patch
+
+import frappe
+from frappe.tests import IntegrationTestCase
+
+from drift.drift.executor import DriftTestExecutor
+
+
+class IntegrationTestDriftTestExecutor(IntegrationTestCase):
+	def setUp(self):
+		# Only the tests of this case are up for claims
+		frappe.db.delete("Drift Test", {"status": "Running", "execution_mode": "Async Executor"})
+		self.tests = []
+		for _ in range(5):
+			test = frappe.get_doc(
+				{
+					"doctype": "Drift Test",
+					"definition": "_Test Drift Test Definition",
+					"status": "Running",
+					"execution_mode": "Async Executor",
+					"step_cursor": 1,
+					"variables": "{}",
+				}
+			)
+			test.db_insert()
+			self.tests.append(test.name)
+		self.executors = []
+
+	def tearDown(self):
+		for executor in self.executors:
+			for name in self.tests:
+				executor.release(name)
+			executor.db_thread.shutdown()
+
+	def get_executor(self, concurrency: int) -> DriftTestExecutor:
+		executor = DriftTestExecutor(concurrency=concurrency)
+		# Small pages, so the claims of the others span several pages
+		executor.claim_page_length = 1
+		self.executors.append(executor)
+		return executor
+
+	def test_executors_claim_different_tests(self):
+		first, second = self.get_executor(2), self.get_executor(2)
+
+		first_claims = first.claim_queued_tests(first.concurrency, [])
+		second_claims = second.claim_queued_tests(second.concurrency, [])
+		self.assertEqual(len(first_claims), 2)
+		self.assertEqual(len(second_claims), 2)
+		self.assertFalse(set(first_claims) & set(second_claims))
+
+		# The oldest tests go first, to whichever executor asks first
+		self.assertEqual(first_claims + second_claims, self.tests[:4])
+
+		# Only one test left for a third executor
+		self.assertEqual(self.get_executor(2).claim_queued_tests(2, []), self.tests[4:])
+
+	def test_excluded_tests_are_not_claimed(self):
+		executor = self.get_executor(2)
+		self.assertEqual(executor.claim_queued_tests(2, self.tests[:3]), self.tests[3:])
+
+	def test_handed_off_test_is_picked_up_once_its_step_is_done(self):
+		executor = self.get_executor(2)
+		name = self.tests[0]
+		self.assertEqual(executor.get_handed_off_tests({name: 1}), {name: 1})
+
+		# The background job ran the step and moved the cursor
+		frappe.db.set_value("Drift Test", name, "step_cursor", 2)
+		self.assertEqual(executor.get_handed_off_tests({name: 1}), {})
+
+	@patch("drift.drift.executor.CLAIM_TTL", 1)
+	def test_claim_is_kept_while_a_step_runs(self):
+		executor = self.get_executor(1)
+		name = self.tests[0]
+		self.assertTrue(executor.claim(name))
+
+		async def run_long_step():
+			heartbeat = asyncio.create_task(executor.keep_claim(name))
+			# Longer than the claim lasts on its own
+			await asyncio.sleep(1.5)
+			heartbeat.cancel()
+
+		asyncio.run(run_long_step())
+		self.assertEqual(executor.get_unclaimed([name]), [])
+		self.assertFalse(self.get_executor(1).claim(name))
@@ -0,0 +1,86 @@
+# Copyright (c) 2025, Tanmoy and Contributors
+# See license.txt
+
+import asyncio
+import contextlib
+from unittest.mock import AsyncMock, MagicMock
+
+import frappe
+from frappe.tests import UnitTestCase
+
+from drift.drift.doctype.drift_test_step_definition.drift_test_step_definition import PlaywrightCall
+from drift.drift.parallel_steps import get_branches, get_group_steps, run_branches
+
+
+def get_steps(*groups: tuple[str | None, str | None]) -> list[frappe._dict]:
+	return [
+		frappe._dict(name=f"step-{idx}", idx=idx, parallel_group=group, parallel_branch=branch)
+		for idx, (group, branch) in enumerate(groups, 1)
+	]
+
+
+class UnitTestParallelSteps(UnitTestCase):
+	def test_group_ends_at_the_first_step_of_another_group(self):
+		steps = get_steps((None, None), ("a", "1"), ("a", "2"), ("a", "1"), ("b", "1"), ("a", "1"))
+		self.assertEqual([s.idx for s in get_group_steps(steps, steps[1])], [2, 3, 4])
+		self.assertEqual([s.idx for s in get_group_steps(steps, steps[4])], [5])
+
+	def test_steps_are_split_by_branch_in_order(self):
+		steps = get_steps(("a", "1"), ("a", "2"), ("a", "1"), ("a", None), ("a", None))
+		self.assertEqual(
+			{branch: [s.idx for s in branch_steps] for branch, branch_steps in get_branches(steps).items()},
+			{"1": [1, 3], "2": [2], "step-4": [4], "step-5": [5]},
+		)
+
+	def test_branch_stops_at_its_first_failure(self):
+		page = MagicMock(close=AsyncMock())
+		browser = MagicMock(contexts=[MagicMock(pages=[], new_page=AsyncMock(return_value=page))])
+
+		async def fail(page):
+			raise ValueError("Element not found\nCall log")
+
+		def call():
+			return AsyncMock()
+
+		branches = [
+			[("step-1", call(), contextlib.nullcontext), ("step-2", fail, contextlib.nullcontext)],
+			[("step-3", fail, contextlib.nullcontext), ("step-4", call(), contextlib.nullcontext)],
+			[("step-5", None, contextlib.nullcontext), ("step-6", call(), contextlib.nullcontext)],
+		]
+		results = asyncio.run(run_branches(browser, branches))
+
+		self.assertEqual(
+			{name: result["status"] for name, result in results.items()},
+			{
+				"step-1": "Success",
+				"step-2": "Failure",
+				"step-3": "Failure",
+				"step-5": "Success",
+				"step-6": "Success",
+			},
+		)
+		self.assertEqual(results["step-2"]["error"], "Element not found")
+		self.assertIn("ValueError", results["step-3"]["traceback"])
+		# Every branch closes its own page
+		self.assertEqual(page.close.await_count, 3)
+
+	def test_branches_start_at_the_url_of_the_test(self):
+		pages = [MagicMock(goto=AsyncMock(), close=AsyncMock()) for _ in range(2)]
+		context = MagicMock(
+			pages=[MagicMock(url="https://site.test/app/todo")], new_page=AsyncMock(side_effect=pages)
+		)
+		click = AsyncMock(method="click", locator=("get_by_text", ("Add",), {}))
+
+		branches = [
+			[("step-1", click, contextlib.nullcontext)],
+			# Navigates on its own, so it isn't sent to the URL of the test first
+			[("step-2", PlaywrightCall("goto", "https://site.test/app/note"), contextlib.nullcontext)],
+		]
+		results = asyncio.run(run_branches(MagicMock(contexts=[context]), branches))
+
+		self.assertEqual(
+			{name: result["status"] for name, result in results.items()},
+			{"step-1": "Success", "step-2": "Success"},
+		)
+		pages[0].goto.assert_awaited_once_with("https://site.test/app/todo")
+		pages[1].goto.assert_awaited_once_with("https://site.test/app/note")
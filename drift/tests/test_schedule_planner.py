@@ -0,0 +1,61 @@
+# Copyright (c) 2025, Tanmoy and Contributors
+# See license.txt
+
+from datetime import datetime
+
+from frappe.tests import UnitTestCase
+
+from drift.drift.schedule_planner import (
+	EPOCH,
+	MAX_HORIZON_MINUTES,
+	_add_load,
+	_choose_offset,
+	get_horizon,
+	get_next_execution_on,
+)
+
+
+class UnitTestSchedulePlanner(UnitTestCase):
+	def test_next_execution_is_at_the_offset(self):
+		self.assertEqual(get_next_execution_on(EPOCH, 60, 15), datetime(2025, 1, 1, 0, 15))
+		self.assertEqual(
+			get_next_execution_on(datetime(2025, 1, 1, 0, 16), 60, 15), datetime(2025, 1, 1, 1, 15)
+		)
+
+	def test_horizon_is_the_lcm_of_the_intervals(self):
+		self.assertEqual(get_horizon([]), 1)
+		self.assertEqual(get_horizon([15, 60]), 60)
+		self.assertEqual(get_horizon([7, 60]), 420)
+		self.assertEqual(get_horizon([7, 11, 13, 1440]), MAX_HORIZON_MINUTES)
+
+	def test_load_of_intervals_which_dont_divide_a_day(self):
+		schedules = [(7, 3, 2), (45, 10, 5)]
+		load = [0] * get_horizon(interval for interval, _, _ in schedules)
+		for interval, offset, duration in schedules:
+			_add_load(load, interval, offset, duration)
+
+		# Every minute of the horizon matches the runs in progress at that minute
+		for minute, value in enumerate(load):
+			running = sum((minute - offset) % interval < duration for interval, offset, duration in schedules)
+			self.assertEqual(value, running)
+
+	def test_offsets_are_spread(self):
+		load = [0] * 60
+		offsets = []
+		for _ in range(4):
+			offset = _choose_offset(load, 60, 15)
+			_add_load(load, 60, offset, 15)
+			offsets.append(offset)
+
+		self.assertEqual(sorted(offsets), [0, 15, 30, 45])
+		self.assertEqual(max(load), 1)
+
+	def test_offset_stays_within_capacity(self):
+		load = [4] * 60
+		# Minutes 0-9 have the lowest peak, but every one of them is at the capacity
+		load[0:10] = [2] * 10
+		# Minutes 20-29 have a higher peak in one minute, and room in the rest
+		load[20:30] = [1] * 9 + [3]
+
+		self.assertEqual(_choose_offset(load, 60, 10), 0)
+		self.assertEqual(_choose_offset(load, 60, 10, capacity=2), 20)
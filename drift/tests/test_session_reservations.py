@@ -0,0 +1,63 @@
+# Copyright (c) 2025, Tanmoy and Contributors
+# See license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests import IntegrationTestCase
+
+from drift.drift import session_reservations
+
+
+class IntegrationTestSessionReservations(IntegrationTestCase):
+	def setUp(self):
+		self.small, self.large = (f"_Test Drift Server {frappe.generate_hash(length=6)}" for _ in range(2))
+		self.addCleanup(
+			frappe.cache.delete, *(session_reservations.get_key(s) for s in (self.small, self.large))
+		)
+
+	def reserve(self, capacities: dict[str, int]) -> str | None:
+		reservation = session_reservations.reserve(capacities)
+		return reservation and reservation[0]
+
+	def test_least_loaded_server_is_reserved(self):
+		capacities = {self.small: 2, self.large: 4}
+		servers = [self.reserve(capacities) for _ in range(7)]
+		self.assertEqual(
+			servers,
+			[self.small, self.large, self.large, self.small, self.large, self.large, None],
+		)
+		self.assertEqual(session_reservations.get_usage([self.small, self.large]), capacities)
+
+	def test_servers_without_capacity_are_skipped(self):
+		self.assertEqual(self.reserve({self.small: 0, self.large: 1}), self.large)
+		self.assertIsNone(self.reserve({self.small: 0}))
+
+	def test_expired_pending_reservations_are_dropped(self):
+		with patch("drift.drift.session_reservations.PENDING_RESERVATION_TTL", -1):
+			self.assertEqual(self.reserve({self.small: 1}), self.small)
+		# Expired, so the slot is free again
+		self.assertEqual(self.reserve({self.small: 1}), self.small)
+		self.assertIsNone(self.reserve({self.small: 1}))
+
+	def test_confirmed_reservation_is_released(self):
+		server, token = session_reservations.reserve({self.small: 1})
+		session_reservations.confirm(server, token, "session-1")
+		self.assertIsNone(self.reserve({self.small: 1}))
+
+		session_reservations.release(server, "session-1")
+		self.assertEqual(session_reservations.get_usage([server]), {server: 0})
+
+	def test_sync_keeps_active_sessions_and_pending_reservations(self):
+		capacities = {self.small: 3}
+		for session in ("session-1", "session-2"):
+			server, token = session_reservations.reserve(capacities)
+			session_reservations.confirm(server, token, session)
+		_, pending = session_reservations.reserve(capacities)
+
+		session_reservations.sync({self.small: ["session-2"]})
+		members = {
+			frappe.safe_decode(m)
+			for m in frappe.cache.zrange(session_reservations.get_key(self.small), 0, -1)
+		}
+		self.assertEqual(members, {"session-2", pending})
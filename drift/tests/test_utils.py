@@ -0,0 +1,111 @@
+# Copyright (c) 2025, Tanmoy and Contributors
+# See license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests import IntegrationTestCase, UnitTestCase
+
+from drift.drift import utils
+from drift.drift.utils import (
+	LRUCache,
+	get_stats,
+	record_stats,
+	render_template_cached,
+	reset_stats,
+	safe_exec_cached,
+)
+
+
+class UnitTestLRUCache(UnitTestCase):
+	def test_evicts_least_recently_used(self):
+		cache = LRUCache("test_lru_cache", maxsize=2)
+		cache.set("a", 1)
+		cache.set("b", 2)
+		self.assertEqual(cache.get("a"), 1)
+
+		cache.set("c", 3)
+		self.assertIsNone(cache.get("b"))
+		self.assertEqual(cache.get("a"), 1)
+		self.assertEqual(cache.get("c"), 3)
+
+	def test_discard_by_prefix(self):
+		cache = LRUCache("test_lru_cache")
+		cache.set(("step-1", "v1"), 1)
+		cache.set(("step-1", "v2"), 2)
+		cache.set(("step-2", "v1"), 3)
+
+		cache.discard("step-1")
+		self.assertEqual(list(cache.data), [("step-2", "v1")])
+
+	def test_stats_are_flushed_in_batches(self):
+		cache = LRUCache("test_lru_cache")
+		cache.set("a", 1)
+		with patch("drift.drift.utils.record_stats") as record_stats:
+			cache.get("a")
+			cache.get("a")
+			cache.get("b")
+			record_stats.assert_not_called()
+
+			cache.stats_flushed_on -= cache.stats_flush_interval
+			cache.get("b")
+
+		record_stats.assert_called_once_with("test_lru_cache", hits=2, misses=2)
+		self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+
+@patch("drift.drift.utils.is_safe_exec_enabled", lambda: True)
+class IntegrationTestStats(IntegrationTestCase):
+	def setUp(self):
+		self.name = f"test_stats_{frappe.generate_hash(length=6)}"
+		self.addCleanup(reset_stats, self.name)
+
+	def test_recorded_stats_are_read_back(self):
+		self.assertEqual(get_stats(self.name), {})
+
+		record_stats(self.name, hits=2, misses=1)
+		record_stats(self.name, hits=1, seconds=0.5)
+		self.assertEqual(get_stats(self.name), {"hits": 3.0, "misses": 1.0, "seconds": 0.5})
+
+		reset_stats(self.name)
+		self.assertEqual(get_stats(self.name), {})
+
+
+class IntegrationTestCachedExecution(IntegrationTestCase):
+	def setUp(self):
+		utils.compiled_code_cache.clear()
+		utils.jinja_template_cache.clear()
+
+	def test_code_is_compiled_once(self):
+		with patch(
+			"drift.drift.utils.compile_restricted", wraps=utils.compile_restricted
+		) as compile_restricted:
+			for value in (1, 2):
+				_locals = {"value": value}
+				safe_exec_cached("result = value * 2", _locals, ("step-1", "v1"))
+				self.assertEqual(_locals["result"], value * 2)
+
+			safe_exec_cached("result = value * 3", _locals, ("step-1", "v1"))
+			self.assertEqual(_locals["result"], 6)
+
+		# Once for each version of the script
+		self.assertEqual(compile_restricted.call_count, 2)
+
+	def test_disabled_server_scripts(self):
+		with patch("drift.drift.utils.is_safe_exec_enabled", lambda: False):
+			with self.assertRaises(utils.ServerScriptNotEnabled):
+				safe_exec_cached("result = 1", {}, ("step-1", "v1"))
+
+	def test_template_is_rendered_with_current_context(self):
+		for name in ("first", "second"):
+			self.assertEqual(
+				render_template_cached("Hello {{ name }}", {"name": name}, ("step-1", "v1")),
+				f"Hello {name}",
+			)
+		self.assertEqual(len(utils.jinja_template_cache.data), 1)
+
+	def test_template_errors(self):
+		with self.assertRaises(frappe.ValidationError):
+			render_template_cached("{% if %}", {}, ("step-1", "v1"))
+		with self.assertRaises(frappe.ValidationError):
+			render_template_cached("{{ ''.__class__ }}", {}, ("step-1", "v1"))
@@ -0,0 +1,108 @@
+# Copyright (c) 2025, Tanmoy and Contributors
+# See license.txt
+
+import json
+from unittest.mock import patch
+
+import frappe
+from frappe.tests import IntegrationTestCase, UnitTestCase
+
+from drift.drift.variable_store import FILE_REFERENCE_KEY, VariableStore
+
+
+class UnitTestVariableStore(UnitTestCase):
+	def test_loaded_store_is_clean(self):
+		store = VariableStore.loads('{"count": 1, "name": "x"}')
+		self.assertFalse(store.is_dirty)
+		self.assertEqual(store.count, 1)
+		self.assertEqual(store["name"], "x")
+		# Reading scalars can't change anything
+		self.assertFalse(store.is_dirty)
+
+	def test_invalid_json_is_an_empty_store(self):
+		store = VariableStore.loads("not json")
+		self.assertEqual(store, {})
+		self.assertFalse(store.is_dirty)
+
+	def test_changes_make_the_store_dirty(self):
+		for change in (
+			lambda store: store.__setitem__("count", 2),
+			lambda store: setattr(store, "name", "y"),
+			lambda store: store.pop("count"),
+			lambda store: store.update(extra=1),
+			lambda store: store.setdefault("new", 0),
+			lambda store: store.clear(),
+		):
+			store = VariableStore.loads('{"count": 1, "name": "x"}')
+			change(store)
+			self.assertTrue(store.is_dirty)
+
+	def test_containers_handed_out_make_the_store_dirty(self):
+		store = VariableStore.loads('{"items": [1], "count": 1}')
+		store["items"].append(2)
+		self.assertTrue(store.is_dirty)
+		self.assertEqual(json.loads(store.dumps("test")), {"items": [1, 2], "count": 1})
+
+	def test_dumps_cleans_the_store(self):
+		store = VariableStore.loads('{"count": 1}')
+		store.count = 2
+		self.assertEqual(store.dumps("test"), '{"count":2}')
+		self.assertFalse(store.is_dirty)
+
+	def test_new_store_is_dirty(self):
+		self.assertTrue(VariableStore({"count": 1}).is_dirty)
+		self.assertFalse(VariableStore().is_dirty)
+
+
+@patch("drift.drift.variable_store.OFFLOAD_BYTES", 32)
+class IntegrationTestVariableStore(IntegrationTestCase):
+	def setUp(self):
+		test = frappe.get_doc(
+			{"doctype": "Drift Test", "definition": "_Test Drift Test Definition", "variables": "{}"}
+		)
+		test.db_insert()
+		self.test = test.name
+
+	def get_files(self) -> list[str]:
+		return frappe.get_all(
+			"File", filters={"attached_to_doctype": "Drift Test", "attached_to_name": self.test}, pluck="name"
+		)
+
+	def test_large_values_are_offloaded(self):
+		rows = [{"index": index} for index in range(10)]
+		raw = VariableStore({"rows": rows, "count": 1}).dumps(self.test)
+
+		serialized = json.loads(raw)
+		self.assertEqual(serialized["count"], 1)
+		self.assertIn(FILE_REFERENCE_KEY, serialized["rows"])
+		self.assertEqual(self.get_files(), [serialized["rows"][FILE_REFERENCE_KEY]])
+
+		# Loaded again on first access
+		self.assertEqual(VariableStore.loads(raw)["rows"], rows)
+
+	def test_unchanged_offloaded_values_are_kept(self):
+		raw = VariableStore({"rows": list(range(20))}).dumps(self.test)
+
+		store = VariableStore.loads(raw)
+		store.count = 1
+		self.assertEqual(json.loads(store.dumps(self.test))["rows"], json.loads(raw)["rows"])
+
+		# Read but not changed, so the content hash matches and no file is written again
+		store = VariableStore.loads(raw)
+		self.assertEqual(store["rows"], list(range(20)))
+		self.assertEqual(json.loads(store.dumps(self.test))["rows"], json.loads(raw)["rows"])
+		self.assertEqual(len(self.get_files()), 1)
+
+	def test_files_of_replaced_values_are_deleted(self):
+		raw = VariableStore({"rows": list(range(20))}).dumps(self.test)
+		(first_file,) = self.get_files()
+
+		store = VariableStore.loads(raw)
+		store.rows = list(range(30))
+		store.dumps(self.test)
+		self.assertNotIn(first_file, self.get_files())
+		self.assertEqual(len(self.get_files()), 1)
+
+		store.rows = "small"
+		self.assertEqual(json.loads(store.dumps(self.test)), {"rows": "small"})
+		self.assertEqual(self.get_files(), [])
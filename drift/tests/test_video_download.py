@@ -0,0 +1,112 @@
+# Copyright (c) 2025, Tanmoy and Contributors
+# See license.txt
+
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import ClassVar
+from unittest.mock import patch
+
+from frappe.tests import UnitTestCase
+
+from drift.drift.doctype.drift_server.drift_server import DriftServerClient, VideoDownloadError
+
+VIDEO = os.urandom(300_000)
+
+
+class StubVideoHandler(BaseHTTPRequestHandler):
+	"""Serves `VIDEO` with Range support, after failing the first `failures` requests"""
+
+	failures: ClassVar[list[int]] = []
+	requests: ClassVar[list[str | None]] = []
+
+	def do_GET(self):
+		self.requests.append(self.headers.get("Range"))
+		if self.failures:
+			self.send_response(self.failures.pop(0))
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+			return
+
+		start = 0
+		if range_header := self.headers.get("Range"):
+			start = int(range_header.removeprefix("bytes=").split("-")[0])
+			if start >= len(VIDEO):
+				self.send_response(416)
+				self.send_header("Content-Range", f"bytes */{len(VIDEO)}")
+				self.send_header("Content-Length", "0")
+				self.end_headers()
+				return
+			self.send_response(206)
+			self.send_header("Content-Range", f"bytes {start}-{len(VIDEO) - 1}/{len(VIDEO)}")
+		else:
+			self.send_response(200)
+		self.send_header("Content-Length", str(len(VIDEO) - start))
+		self.end_headers()
+		self.wfile.write(VIDEO[start:])
+
+	def log_message(self, *args):
+		pass
+
+
+@patch("drift.drift.doctype.drift_server.drift_server.VIDEO_DOWNLOAD_RETRY_BACKOFF", 0)
+class UnitTestVideoDownload(UnitTestCase):
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.agent = ThreadingHTTPServer(("127.0.0.1", 0), StubVideoHandler)
+		threading.Thread(target=cls.agent.serve_forever, daemon=True).start()
+		cls.client = DriftServerClient(
+			f"http://127.0.0.1:{cls.agent.server_port}/",
+			"stub-agent-token",
+			pool_size=1,
+			max_retries=0,
+			backoff_factor=0,
+		)
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.client.close()
+		cls.agent.shutdown()
+		cls.agent.server_close()
+		super().tearDownClass()
+
+	def setUp(self):
+		StubVideoHandler.failures = []
+		StubVideoHandler.requests = []
+		self.directory = tempfile.TemporaryDirectory()
+		self.file_path = os.path.join(self.directory.name, "video.webm")
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def write_part(self, content: bytes):
+		with open(f"{self.file_path}.part", "wb") as f:
+			f.write(content)
+
+	def assert_downloaded(self, result: tuple[str, int]):
+		self.assertEqual(result[1], len(VIDEO))
+		with open(self.file_path, "rb") as f:
+			self.assertEqual(f.read(), VIDEO)
+		self.assertFalse(os.path.exists(f"{self.file_path}.part"))
+
+	def test_partial_file_is_resumed(self):
+		self.write_part(VIDEO[:1000])
+		self.assert_downloaded(self.client.fetch_video("session", "video", self.file_path))
+		self.assertEqual(StubVideoHandler.requests, ["bytes=1000-"])
+
+	def test_oversized_partial_file_starts_over(self):
+		self.write_part(VIDEO + b"stale")
+		self.assert_downloaded(self.client.fetch_video("session", "video", self.file_path))
+		self.assertEqual(StubVideoHandler.requests, [f"bytes={len(VIDEO) + 5}-", None])
+
+	def test_server_errors_are_retried(self):
+		StubVideoHandler.failures = [503, 500]
+		self.assert_downloaded(self.client.fetch_video("session", "video", self.file_path))
+		self.assertEqual(len(StubVideoHandler.requests), 3)
+
+	def test_gives_up_after_all_attempts(self):
+		StubVideoHandler.failures = [500, 500, 500]
+		with self.assertRaises(VideoDownloadError):
+			self.client.fetch_video("session", "video", self.file_path)
@@ -0,0 +1,124 @@
+# Copyright (c) 2025, Tanmoy and Contributors
+# See license.txt
+
+import time
+from unittest.mock import patch
+
+import frappe
+from frappe.tests import IntegrationTestCase, UnitTestCase
+
+from drift.drift.video_retention import _get_tests_beyond_last, _iterate, evict_videos
+
+DEFINITION = "_Test Retention Definition"
+
+
+class EvictionQuery:
+	"""Stands in for the query of the downloaded videos, evicted tests drop out of it"""
+
+	def __init__(self, rows: list[tuple]):
+		self.rows = rows
+
+	def limit(self, limit: int) -> "EvictionQuery":
+		self._limit = limit
+		return self
+
+	def offset(self, offset: int) -> "EvictionQuery":
+		self._offset = offset
+		return self
+
+	def run(self) -> list[tuple]:
+		return self.rows[self._offset : self._offset + self._limit]
+
+
+class UnitTestVideoRetention(UnitTestCase):
+	@patch("drift.drift.video_retention.EVICTION_BATCH_SIZE", 2)
+	def test_tests_after_failed_evictions_are_read(self):
+		rows = [(f"session-{index}", f"test-{index}", 1) for index in range(7)]
+		query = EvictionQuery(list(rows))
+		failing = {rows[0], rows[1], rows[4]}
+
+		read = []
+		for row in _iterate(query):
+			read.append(row)
+			if row not in failing:
+				query.rows.remove(row)
+
+		self.assertEqual(read, rows)
+		self.assertEqual(query.rows, [rows[0], rows[1], rows[4]])
+
+
+class IntegrationTestVideoRetention(IntegrationTestCase):
+	def setUp(self):
+		settings = frappe.get_single("Drift Settings")
+		settings.servers = []
+		settings.append(
+			"servers",
+			{"scheme": "http", "host": "127.0.0.1:1", "auth_token": "stub-agent-token", "status": "Disabled"},
+		)
+		settings.save()
+		self.server = settings.servers[0].name
+
+	def insert_test(self, minutes_ago: int) -> str:
+		test = frappe.get_doc(
+			{
+				"doctype": "Drift Test",
+				"definition": DEFINITION,
+				"status": "Failure",
+				"variables": "{}",
+				"creation": frappe.utils.add_to_date(minutes=-minutes_ago),
+			}
+		)
+		test.db_insert()
+		return test.name
+
+	def insert_session(self, videos: dict[str, str], purged: bool = True):
+		"""Insert a stopped session with the downloaded videos, `videos` is the test of every video"""
+		session = frappe.get_doc(
+			{
+				"doctype": "Drift Session",
+				"status": "Stopped",
+				"server": self.server,
+				"session_id": frappe.generate_hash(length=32),
+				"session_token": "stub-session-token",
+				"cdp_endpoint": "ws://127.0.0.1/devtools/browser",
+				"started_on": frappe.utils.add_to_date(minutes=-30),
+				"ended_on": frappe.utils.now_datetime(),
+				"video_download_status": "Downloaded",
+				"purged_videos_from_server": purged,
+			}
+		)
+		for video_id, test in videos.items():
+			file = frappe.get_doc(
+				{"doctype": "File", "file_name": video_id, "content": b"video", "is_private": 1}
+			).insert(ignore_permissions=True)
+			session.append(
+				"videos",
+				{"id": video_id, "test": test, "status": "Downloaded", "file": file.name, "file_size": 5},
+			)
+		session.insert(ignore_permissions=True)
+		for test in set(videos.values()):
+			frappe.db.set_value("Drift Test", test, "session", session.name)
+		return session
+
+	def get_video_statuses(self, session) -> dict[str, str]:
+		session.reload()
+		return {video.id: video.status for video in session.videos}
+
+	def test_videos_of_newer_tests_of_a_reused_session_are_kept(self):
+		old_test, new_test = self.insert_test(minutes_ago=20), self.insert_test(minutes_ago=10)
+		session = self.insert_session({"old.webm": old_test, "new.webm": new_test})
+
+		evict_videos(_get_tests_beyond_last(DEFINITION, "Failure", 1), time.monotonic() + 60)
+
+		self.assertEqual(self.get_video_statuses(session), {"old.webm": "Deleted", "new.webm": "Downloaded"})
+		self.assertEqual(session.video_download_status, "Downloaded")
+		self.assertFalse(frappe.db.exists("File", {"file_name": "old.webm"}))
+
+	def test_videos_not_purged_from_agent_are_kept(self):
+		old_test, new_test = self.insert_test(minutes_ago=20), self.insert_test(minutes_ago=10)
+		session = self.insert_session({"old.webm": old_test}, purged=False)
+		self.insert_session({"new.webm": new_test})
+
+		evict_videos(_get_tests_beyond_last(DEFINITION, "Failure", 0), time.monotonic() + 60)
+
+		self.assertEqual(self.get_video_statuses(session), {"old.webm": "Downloaded"})